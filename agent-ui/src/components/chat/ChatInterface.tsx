@@ -51,7 +51,21 @@ export default function ChatInterface() {
     
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      setEvents(prev => [...prev, data]);
+      setEvents(prev => {
+        if (data.type === 'message_delta') {
+          // deltas of one streamed message share the id, glue them together
+          const last = prev[prev.length - 1];
+          if (last && last.type === 'message_delta' && last.id === data.id) {
+            return [...prev.slice(0, -1), { ...last, delta: last.delta + data.delta }];
+          }
+          return [...prev, data];
+        }
+        if (data.type === 'message') {
+          // the complete message replaces its streamed parts
+          return [...prev.filter(e => e.type !== 'message_delta'), data];
+        }
+        return [...prev, data];
+      });
     };
     
     setWs(websocket);
@@ -1,4 +1,5 @@
 import 'highlight.js/styles/github-dark.css';
+import ReactMarkdown from 'react-markdown';
 import { Event, ToolResultEvent } from '../../types/events';
 import { MessageRenderer } from './renderers/MessageRenderer';
 import { ToolCallRenderer } from './renderers/ToolCallRenderer';
@@ -15,6 +16,14 @@ export function EventRenderer({ event, matchingToolResult, ws }: EventRendererPr
     case 'message':
       return <MessageRenderer event={event} />;
 
+    case 'message_delta':
+      // the answer of the structured message while it is generated
+      return (
+        <div className="text-gray-600 prose prose-invert max-w-none">
+          <ReactMarkdown>{event.delta}</ReactMarkdown>
+        </div>
+      );
+
     case 'prompt':
       return (
         <div className="text-gray-300">
@@ -1,8 +1,13 @@
 import { useState } from 'react';
 import { ToolCallEvent, ToolResultEvent } from '../../../types/events';
-import { extractColumnsFromQuery, highlightSQL, formatSQL } from '../../../utils/sqlUtils';
+import { highlightSQL, formatSQL } from '../../../utils/sqlUtils';
+import { parseQueryResult } from '../../../utils/queryResultUtils';
 import SpreadGrid from 'react-spread-grid';
 import { HeartIcon, PencilSquareIcon } from '@heroicons/react/24/outline';
+import { useConfig } from '@/hooks/useConfig';
+
+// tools whose output is a query result in csv
+const QUERY_TOOLS = ['execute_sql_query', 'aggregate_mongodb'];
 
 interface ToolCallRendererProps {
   event: ToolCallEvent;
@@ -13,6 +18,7 @@ interface ToolCallRendererProps {
 export function ToolCallRenderer({ event, matchingToolResult, ws }: ToolCallRendererProps) {
   const [isEditing, setIsEditing] = useState(false);
   const [editedQuery, setEditedQuery] = useState(event.parameters.query);
+  const { config } = useConfig();
 
   const handleLikeSQL = () => {
     if (ws) {
@@ -104,82 +110,42 @@ export function ToolCallRenderer({ event, matchingToolResult, ws }: ToolCallRend
   const renderToolResult = () => {
     if (!matchingToolResult) return null;
 
-    try {
-      const data = JSON.parse(matchingToolResult.output);
-      if (Array.isArray(data) && data.length > 0) {
-        const columns = event.tool_name === 'execute_sql_query'
-          ? extractColumnsFromQuery(event.parameters.query)
-          : [];
+    const table = QUERY_TOOLS.includes(event.tool_name)
+      ? parseQueryResult(matchingToolResult.output)
+      : null;
 
-        if (data.length === 1) {
-          return (
-            <div className="bg-gray-800 p-4 rounded">
-              {columns.length > 0 && (
-                <div className="mb-3 text-sm text-gray-500">
-                  Columns: {columns.join(', ')}
-                </div>
-              )}
-              {Object.entries(data[0]).map(([key, value]) => (
-                <div key={key} className="mb-2">
-                  <span className="text-gray-400 font-semibold">{key}: </span>
-                  <span className="text-gray-200">{String(value)}</span>
-                </div>
-              ))}
+    if (table && table.rows.length === 1) {
+      return (
+        <div className="bg-gray-800 p-4 rounded">
+          {table.columns.map((column, index) => (
+            <div key={column} className="mb-2">
+              <span className="text-gray-400 font-semibold">{column}: </span>
+              <span className="text-gray-200">{table.rows[0][index]}</span>
             </div>
-          );
-        }
-
-        console.log(columns);
-        console.log(data);
-        if (data.length > 0) {
-          console.log(columns.length);
-          console.log(data[0].length);
-          if (columns.length === data[0].length) {
-            console.log(data[0].length);
-            const gridData = data.map(row => {
-              const formattedRow: Record<string, any> = {};
-              columns.forEach((col, index) => {
-                formattedRow[col] = row[index];
-              });
-              return formattedRow;
-            });
-            console.log(gridData);
-            console.log('Attempting to render SpreadGrid with data:', gridData);
-            console.log('First row sample:', gridData[0]);
-            console.log('GridData structure:', {
-              numberOfRows: gridData.length,
-              sampleRow: gridData[0],
-              allColumns: Object.keys(gridData[0])
-            });
-            return (<div className="mt-4">
-              <SpreadGrid
-                data={gridData}
-                className="w-full bg-white rounded shadow"
-              />
-            </div>)
-          } else {
-            const gridData = data
-            return (
-              <div className="overflow-x-auto">
-                <pre className="text-sm bg-gray-800 p-2 rounded">
-                  {matchingToolResult.output}
-                </pre>
-                <SpreadGrid data={gridData} />
-              </div>
-            );
-
-          }
-        }
+          ))}
+        </div>
+      );
+    }
 
-        // Fallback to raw output display if columns or data are empty
-        return (
-          <pre className="text-sm bg-gray-800 p-2 rounded">
-            {matchingToolResult.output}
-          </pre>
-        );
-      }
-    } catch (e) {
-      console.error(e);
+    if (table && table.rows.length > 1) {
+      const gridData = table.rows.map(row => {
+        const formattedRow: Record<string, string> = {};
+        table.columns.forEach((column, index) => {
+          formattedRow[column] = row[index];
+        });
+        return formattedRow;
+      });
+      return (
+        <div className="mt-4">
+          <SpreadGrid
+            data={gridData}
+            className="w-full bg-white rounded shadow"
+          />
+          {table.notes.map(note => (
+            <div key={note} className="mt-2 text-xs text-gray-500">{note}</div>
+          ))}
+        </div>
+      );
     }
 
     return (
@@ -197,7 +163,17 @@ export function ToolCallRenderer({ event, matchingToolResult, ws }: ToolCallRend
       {renderToolParameters()}
       {matchingToolResult && (
         <div className="mt-2 border-l-4 border-green-500 pl-2">
-          <div className="font-bold text-green-500">Result:</div>
+          <div className="font-bold text-green-500">
+            Result:
+            {matchingToolResult.result_id && (
+              <a
+                href={`http://${config.agentApiUrl}/results/${matchingToolResult.result_id}`}
+                className="ml-2 text-sm font-normal text-blue-500 hover:underline"
+              >
+                Download all rows (csv)
+              </a>
+            )}
+          </div>
           <div className="mt-2">
             {renderToolResult()}
           </div>
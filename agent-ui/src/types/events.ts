@@ -34,7 +34,8 @@ export interface ToolCallEvent extends BaseEvent {
   type: 'tool_call';
   tool_call_id: string;
   tool_name: string;
-  parameters: Record<string, string>;
+  // json arguments of the call: strings, arrays, null...
+  parameters: Record<string, any>;
 }
 
 export interface ToolResultEvent extends BaseEvent {
@@ -42,6 +43,12 @@ export interface ToolResultEvent extends BaseEvent {
   tool_call_id: string;
   tool_name: string;
   output: string;
+  result_id?: string;
+}
+
+export interface MessageDeltaEvent extends BaseEvent {
+  type: 'message_delta';
+  delta: string;
 }
 
 export interface UserEvent extends BaseEvent {
@@ -50,7 +57,7 @@ export interface UserEvent extends BaseEvent {
 }
 
 
-export type Event = MessageEvent | PromptEvent | LogEvent | ToolCallEvent | ToolResultEvent | UserEvent;
+export type Event = MessageEvent | MessageDeltaEvent | PromptEvent | LogEvent | ToolCallEvent | ToolResultEvent | UserEvent;
 
 export interface ExpandableProps {
   title: string | ReactNode;
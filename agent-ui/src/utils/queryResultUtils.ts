@@ -0,0 +1,70 @@
+export interface QueryResultTable {
+  columns: string[];
+  rows: string[][];
+  // "# ..." lines the agent appends when only the first rows are shown
+  notes: string[];
+}
+
+const NOTE_PREFIXES = ['# Only the first ', '# The whole result is stored '];
+
+// Splits csv text (quoted fields, doubled quotes, newlines inside quotes) into rows of fields
+export const parseCsv = (text: string): string[][] => {
+  const rows: string[][] = [];
+  let row: string[] = [];
+  let field = '';
+  let quoted = false;
+
+  for (let i = 0; i < text.length; i++) {
+    const char = text[i];
+    if (quoted) {
+      if (char === '"' && text[i + 1] === '"') {
+        field += '"';
+        i++;
+      } else if (char === '"') {
+        quoted = false;
+      } else {
+        field += char;
+      }
+    } else if (char === '"') {
+      quoted = true;
+    } else if (char === ',') {
+      row.push(field);
+      field = '';
+    } else if (char === '\n') {
+      row.push(field.replace(/\r$/, ''));
+      rows.push(row);
+      row = [];
+      field = '';
+    } else {
+      field += char;
+    }
+  }
+  if (field !== '' || row.length > 0) {
+    row.push(field);
+    rows.push(row);
+  }
+  return rows;
+};
+
+// Output of execute_sql_query / aggregate_mongodb: csv with a header row, then optional notes
+export const parseQueryResult = (output: string): QueryResultTable | null => {
+  if (!output || output.startsWith('Error')) return null;
+
+  const lines = output.split('\n');
+  const notes: string[] = [];
+  while (lines.length > 0) {
+    const last = lines[lines.length - 1];
+    if (last === '') {
+      lines.pop();
+    } else if (NOTE_PREFIXES.some(prefix => last.startsWith(prefix))) {
+      notes.unshift(last.slice(2));
+      lines.pop();
+    } else {
+      break;
+    }
+  }
+
+  const [columns, ...rows] = parseCsv(lines.join('\n'));
+  if (!columns || rows.some(row => row.length !== columns.length)) return null;
+  return { columns, rows, notes };
+};
@@ -0,0 +1,306 @@
+"""
+End-to-end benchmark of the agent tool loop, offline.
+
+Runs the questions of corpus.py against a generated sqlite dataset with
+a scripted fake OpenAI server, through ChatOpenAIDatasourceAgent.process (chat)
+and QuestionProcessor.process (task). Reports p50/p95 per stage over all runs,
+tokens, tool rounds and peak memory (in a separate tracemalloc pass,
+so that tracing doesn't distort the timings).
+
+Needs a mongodb, a temporary database is created and dropped afterwards:
+
+    MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_agents.py --iterations 5
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from corpus import CORPUS  # noqa: E402
+from dataset import generate  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+
+STAGES = ["datasources", "prompt", "llm", "sql", "serialization", "mongo"]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class StageRecorder:
+    """
+    Times calls of wrapped functions per stage for the current run.
+    Stage times of calls running concurrently (parallel tool calls) are summed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._restore: List[Callable] = []
+        self.run = self._empty()
+
+    @staticmethod
+    def _empty() -> Dict:
+        return {
+            "stages": defaultdict(float),
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+            "llm_calls": 0,
+            "tool_rounds": 0,
+        }
+
+    def take(self) -> Dict:
+        with self._lock:
+            run, self.run = self.run, self._empty()
+        return run
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.run["stages"][stage] += seconds
+
+    def timed(self, stage: str, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    def wrap(self, owner, attr: str, stage: str):
+        """Times a method of a class or an instance until restore"""
+        original = owner.__dict__[attr] if isinstance(owner, type) else getattr(owner, attr)
+        setattr(owner, attr, self.timed(stage, getattr(owner, attr)))
+        self._restore.append(lambda: setattr(owner, attr, original))
+
+    def wrap_item(self, mapping: Dict, key: str, stage: str):
+        original = mapping[key]
+        mapping[key] = self.timed(stage, original)
+        self._restore.append(lambda: mapping.__setitem__(key, original))
+
+    def restore(self):
+        for restore in reversed(self._restore):
+            restore()
+        self._restore.clear()
+
+    def _usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = details.get("cached_tokens", 0) if isinstance(details, dict) else getattr(details, "cached_tokens", 0)
+        with self._lock:
+            self.run["prompt_tokens"] += usage.prompt_tokens
+            self.run["completion_tokens"] += usage.completion_tokens
+            self.run["cached_tokens"] += cached or 0
+
+    def _called(self, tool_calls: bool):
+        with self._lock:
+            self.run["llm_calls"] += 1
+            self.run["tool_rounds"] += int(tool_calls)
+
+    def wrap_llm(self, client):
+        """Times the llm including reading the stream, counts tokens and tool rounds"""
+        create = client.chat.completions.create
+
+        def timed_stream(stream):
+            tool_calls = False
+            iterator = iter(stream)
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    self.add("llm", time.perf_counter() - start)
+                if chunk.choices and chunk.choices[0].delta.tool_calls:
+                    tool_calls = True
+                self._usage(chunk.usage)
+                yield chunk
+            self._called(tool_calls)
+
+        def wrapper(**kwargs):
+            start = time.perf_counter()
+            response = create(**kwargs)
+            self.add("llm", time.perf_counter() - start)
+            if kwargs.get("stream"):
+                return timed_stream(response)
+            self._usage(response.usage)
+            self._called(bool(response.choices[0].message.tool_calls))
+            return response
+
+        client.chat.completions.create = wrapper
+
+
+def summarize(runs: List[Dict]) -> Dict:
+    stages = {
+        stage: {
+            "p50_ms": percentile([r["stages"].get(stage, 0.0) * 1000 for r in runs], 50),
+            "p95_ms": percentile([r["stages"].get(stage, 0.0) * 1000 for r in runs], 95),
+        }
+        for stage in STAGES + ["total"]
+    }
+    return {
+        "runs": len(runs),
+        "stages": stages,
+        "prompt_tokens_p50": percentile([r["prompt_tokens"] for r in runs], 50),
+        "completion_tokens_p50": percentile([r["completion_tokens"] for r in runs], 50),
+        "cached_tokens_p50": percentile([r["cached_tokens"] for r in runs], 50),
+        "tool_rounds_mean": sum(r["tool_rounds"] for r in runs) / max(len(runs), 1),
+        "llm_calls_mean": sum(r["llm_calls"] for r in runs) / max(len(runs), 1),
+    }
+
+
+def print_summary(mode: str, summary: Dict):
+    print(f"\n== {mode}: {summary['runs']} runs")
+    print(f"{'stage':<16}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, timing in summary["stages"].items():
+        print(f"{stage:<16}{timing['p50_ms']:>10.2f}{timing['p95_ms']:>10.2f}")
+    print(
+        f"tokens p50: {summary['prompt_tokens_p50']} prompt "
+        f"({summary['cached_tokens_p50']} cached), {summary['completion_tokens_p50']} completion"
+    )
+    print(f"llm calls/run: {summary['llm_calls_mean']:.2f}, tool rounds/run: {summary['tool_rounds_mean']:.2f}")
+    if "peak_memory_kb" in summary:
+        print(f"peak memory: p50 {summary['peak_memory_kb']['p50']:.0f} KiB, max {summary['peak_memory_kb']['max']:.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["chat", "task", "both"], default="both")
+    parser.add_argument("--iterations", type=int, default=5, help="runs of every question")
+    parser.add_argument("--orders", type=int, default=100_000, help="rows of the orders table")
+    parser.add_argument("--llm-delay", type=float, default=0.0, help="seconds the fake llm waits per call")
+    parser.add_argument("--warm-query-cache", action="store_true", help="keep cached query results between runs")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--mongodb-uri", default=os.getenv("MONGODB_URI"))
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    if not args.mongodb_uri:
+        parser.error("set MONGODB_URI or --mongodb-uri")
+
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    db_path = generate(os.path.join(workdir, "bench.db"), orders=args.orders)
+    fake = FakeOpenAI(CORPUS, delay=args.llm_delay).start()
+
+    # before the application modules read their configuration
+    os.environ["OPENAI_BASE_URL"] = fake.base_url
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_REQUESTS_PER_MINUTE"] = "0"
+    os.environ["LLM_CACHE_MODE"] = "off"
+
+    from bson import ObjectId
+    from pymongo import MongoClient
+
+    from agents.chat_agent import ChatOpenAIDatasourceAgent
+    from agents.datasource_agents.question_agent import QuestionProcessor
+    from chat_processor import Conversation, ensure_event_indexes
+    from datasource_registry import DatasourceRegistry
+    from models.query_result import QueryResult
+    from tools import tools
+    from tools.query_cache import query_cache
+    from tools.schema_introspection import SchemaIndexer
+
+    client = MongoClient(args.mongodb_uri)
+    db_name = f"bench_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    recorder = StageRecorder()
+    results = {}
+    try:
+        datasource_id = db.datasources.insert_one(
+            {"name": "bench", "type": "sqlite", "position": 0, "path": db_path}
+        ).inserted_id
+        ds_ids = [str(datasource_id)]
+        ensure_event_indexes(db)
+        registry = DatasourceRegistry(db)
+        SchemaIndexer(db).refresh(registry.get_many(ds_ids)[0])
+        registry.invalidate()
+
+        recorder.wrap_item(tools.TOOLS_MAPPING, tools.SQL_QUERY_TOOL, "sql")
+        recorder.wrap(QueryResult, "to_prompt", "serialization")
+        for method in ("_push_event", "_push_events", "load_older"):
+            recorder.wrap(Conversation, method, "mongo")
+
+        question_processor = QuestionProcessor(db, registry)
+        recorder.wrap(question_processor, "_get_datasources", "datasources")
+        recorder.wrap(question_processor, "_prepare_messages", "prompt")
+        recorder.wrap_llm(question_processor.client)
+
+        def run_chat(question: str):
+            conversation = Conversation.create(db, str(ObjectId()))
+            conversation.add_user_message(db, {"content": question, "datasourceIds": ds_ids})
+            agent = ChatOpenAIDatasourceAgent(db, conversation, registry)
+            recorder.wrap(agent, "_get_datasources", "datasources")
+            recorder.wrap(agent, "_prepare_messages", "prompt")
+            recorder.wrap_llm(agent.client)
+            for _ in agent.process(question, ds_ids):
+                pass
+
+        def run_task(question: str):
+            result = question_processor.process({"query": question, "datasourceIds": ds_ids})
+            start = time.perf_counter()
+            db.tasks.insert_one({"query": question, "result": result})
+            recorder.add("mongo", time.perf_counter() - start)
+
+        modes = {"chat": run_chat, "task": run_task}
+        for mode in (["chat", "task"] if args.mode == "both" else [args.mode]):
+            run = modes[mode]
+            runs = []
+            for _ in range(args.iterations):
+                for entry in CORPUS:
+                    if not args.warm_query_cache:
+                        query_cache.invalidate(str(datasource_id))
+                    recorder.take()
+                    start = time.perf_counter()
+                    run(entry["question"])
+                    total = time.perf_counter() - start
+                    record = recorder.take()
+                    record["stages"]["total"] = total
+                    runs.append(record)
+            summary = summarize(runs)
+
+            if not args.no_memory:
+                peaks = []
+                tracemalloc.start()
+                for entry in CORPUS:
+                    query_cache.invalidate(str(datasource_id))
+                    tracemalloc.reset_peak()
+                    run(entry["question"])
+                    peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+                tracemalloc.stop()
+                recorder.take()
+                summary["peak_memory_kb"] = {"p50": percentile(peaks, 50), "max": max(peaks)}
+
+            results[mode] = summary
+            print_summary(mode, summary)
+    finally:
+        recorder.restore()
+        client.drop_database(db_name)
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Fixed questions with the tool calls the fake llm answers them with.
+rounds: llm responses with tool calls, the queries of one round are called in parallel.
+"""
+
+CORPUS = [
+    {
+        "question": "How many orders are there?",
+        "rounds": [["SELECT COUNT(id) AS orders FROM orders"]],
+    },
+    {
+        "question": "Which countries have the most customers?",
+        "rounds": [
+            [
+                "SELECT country, COUNT(id) AS customers FROM customers "
+                "GROUP BY country ORDER BY customers DESC"
+            ]
+        ],
+    },
+    {
+        "question": "What is the revenue per product category?",
+        "rounds": [
+            ["SELECT DISTINCT category FROM products"],
+            [
+                "SELECT p.category, SUM(o.quantity * p.price) AS revenue FROM orders o "
+                "JOIN products p ON p.id = o.product_id GROUP BY p.category ORDER BY revenue DESC"
+            ],
+        ],
+    },
+    {
+        "question": "Do customers from Germany order more items per order than customers from the US?",
+        "rounds": [
+            [
+                "SELECT c.country, AVG(o.quantity) AS avg_quantity FROM orders o "
+                "JOIN customers c ON c.id = o.customer_id WHERE c.country IN ('DE', 'US') "
+                "GROUP BY c.country",
+                "SELECT c.country, COUNT(o.id) AS orders FROM orders o "
+                "JOIN customers c ON c.id = o.customer_id WHERE c.country IN ('DE', 'US') "
+                "GROUP BY c.country",
+            ]
+        ],
+    },
+    {
+        "question": "Show the monthly number of orders",
+        "rounds": [
+            [
+                "SELECT substr(created_at, 1, 7) AS month, COUNT(id) AS orders FROM orders "
+                "GROUP BY month ORDER BY month"
+            ]
+        ],
+    },
+    {
+        "question": "List the orders of the biggest customer",
+        "rounds": [
+            [
+                "SELECT customer_id, COUNT(id) AS orders FROM orders "
+                "GROUP BY customer_id ORDER BY orders DESC LIMIT 1"
+            ],
+            # wide result, exercises row/byte truncation
+            ["SELECT id, customer_id, product_id, quantity, created_at FROM orders"],
+        ],
+    },
+    {
+        "question": "What is the average product price?",
+        "rounds": [
+            [
+                "SELECT AVG(price) AS avg_price FROM products",
+                "SELECT category, AVG(price) AS avg_price FROM products GROUP BY category",
+                "SELECT MIN(price) AS min_price, MAX(price) AS max_price FROM products",
+            ]
+        ],
+    },
+    {
+        "question": "When did the first customer sign up?",
+        "rounds": [["SELECT MIN(signup_date) AS first_signup FROM customers"]],
+    },
+]
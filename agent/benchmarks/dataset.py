@@ -0,0 +1,78 @@
+"""Deterministic sqlite dataset for the benchmarks"""
+import random
+import sqlite3
+from datetime import date, timedelta
+
+COUNTRIES = ["US", "DE", "FR", "GB", "PL", "ES", "IT", "NL", "SE", "JP"]
+CATEGORIES = ["books", "electronics", "garden", "toys", "food", "sports", "beauty"]
+
+
+def generate(path: str, orders: int = 100_000, seed: int = 42) -> str:
+    """Creates customers, products and orders, about one customer per 10 orders"""
+    rng = random.Random(seed)
+    customers = max(orders // 10, 10)
+    products = max(orders // 100, 10)
+    start = date(2022, 1, 1)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS orders;
+        DROP TABLE IF EXISTS customers;
+        DROP TABLE IF EXISTS products;
+        CREATE TABLE customers (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            country TEXT NOT NULL,
+            signup_date TEXT NOT NULL
+        );
+        CREATE TABLE products (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            price REAL NOT NULL
+        );
+        CREATE TABLE orders (
+            id INTEGER PRIMARY KEY,
+            customer_id INTEGER NOT NULL REFERENCES customers(id),
+            product_id INTEGER NOT NULL REFERENCES products(id),
+            quantity INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+    conn.executemany(
+        "INSERT INTO customers VALUES (?, ?, ?, ?)",
+        (
+            (
+                i,
+                f"customer {i}",
+                rng.choice(COUNTRIES),
+                (start + timedelta(days=rng.randrange(730))).isoformat(),
+            )
+            for i in range(1, customers + 1)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO products VALUES (?, ?, ?, ?)",
+        (
+            (i, f"product {i}", rng.choice(CATEGORIES), round(rng.uniform(1, 500), 2))
+            for i in range(1, products + 1)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO orders VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                i,
+                rng.randint(1, customers),
+                rng.randint(1, products),
+                rng.randint(1, 5),
+                (start + timedelta(days=rng.randrange(730))).isoformat(),
+            )
+            for i in range(1, orders + 1)
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return path
@@ -0,0 +1,189 @@
+"""
+Scripted stand-in for the OpenAI chat completions api, stdlib only.
+
+The question (last user message) is looked up in the corpus, every response
+calls the tools of the next round of the script, after the last round
+the answer is an example object of the requested response_format.
+Supports stream=True (server-sent events) with stream_options.include_usage.
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+DATASOURCE_ID_RE = re.compile(r"<datasourceId>([^<]+)</datasourceId>")
+
+
+def example(schema: Dict, name: str = "value"):
+    """Smallest object valid for a json schema"""
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        schema_type = schema_type[0]
+    if schema_type == "object":
+        return {key: example(value, key) for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [example(schema.get("items", {}), name)]
+    if schema_type in ("number", "integer"):
+        return 0
+    if schema_type == "boolean":
+        return False
+    if schema_type == "null":
+        return None
+    return f"benchmark {name}"
+
+
+def _content(message) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+class FakeOpenAI:
+    def __init__(self, corpus: List[Dict], delay: float = 0.0):
+        self.scripts = {entry["question"]: entry["rounds"] for entry in corpus}
+        self.delay = delay
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, request: Dict) -> Dict:
+        """Assistant message for the request: tool calls of the next round or the answer"""
+        messages = request["messages"]
+        last_user = max(i for i, m in enumerate(messages) if m["role"] == "user")
+        question = _content(messages[last_user])
+        rounds = self.scripts.get(question, [])
+        done = sum(
+            1 for m in messages[last_user:] if m["role"] == "assistant" and m.get("tool_calls")
+        )
+        if done < len(rounds):
+            ids = DATASOURCE_ID_RE.findall(" ".join(_content(m) for m in messages))
+            datasource_id = ids[0] if ids else ""
+            return {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{uuid.uuid4().hex[:12]}",
+                        "type": "function",
+                        "function": {
+                            "name": "execute_sql_query",
+                            "arguments": json.dumps({"query": query, "datasourceId": datasource_id}),
+                        },
+                    }
+                    for query in rounds[done]
+                ],
+            }
+        response_format = request.get("response_format") or {}
+        schema = response_format.get("json_schema", {}).get("schema")
+        content = json.dumps(example(schema)) if schema else f"benchmark answer to {question}"
+        return {"role": "assistant", "content": content}
+
+    @staticmethod
+    def usage(request: Dict, message: Dict) -> Dict:
+        prompt_tokens = len(json.dumps(request["messages"])) // 4
+        completion_tokens = len(json.dumps(message)) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+    def completion(self, request: Dict, message: Dict) -> Dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+                }
+            ],
+            "usage": self.usage(request, message),
+        }
+
+    def chunks(self, request: Dict, message: Dict) -> List[Dict]:
+        base = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+        }
+        deltas = [{"role": "assistant", "content": ""}]
+        if message.get("tool_calls"):
+            deltas += [
+                {"tool_calls": [{"index": i, **tool_call}]}
+                for i, tool_call in enumerate(message["tool_calls"])
+            ]
+            finish_reason = "tool_calls"
+        else:
+            content = message["content"]
+            deltas += [{"content": content[i:i + 16]} for i in range(0, len(content), 16)]
+            finish_reason = "stop"
+        chunks = [
+            {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            for delta in deltas
+        ]
+        chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunks.append({**base, "choices": [], "usage": self.usage(request, message)})
+        return chunks
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fake._lock:
+                    fake.requests += 1
+                if fake.delay:
+                    time.sleep(fake.delay)
+                message = fake.respond(request)
+
+                if request.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.end_headers()
+                    for chunk in fake.chunks(request, message):
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    return
+
+                body = json.dumps(fake.completion(request, message)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
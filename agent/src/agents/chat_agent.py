@@ -1,17 +1,51 @@
+import asyncio
 import logging
-from typing import Any, Dict, Generator, List
+import threading
+import uuid
+from typing import Any, AsyncGenerator, Dict, Generator, List
 
-from bson import ObjectId
-from openai import OpenAI
+from openai.types.chat import ChatCompletion
 from pymongo.database import Database
 
-from chat_processor import Conversation
-from config import OPENAI_CONFIG, SYSTEM_PROMPT, MAX_TOOL_CALLS
-from models.datasource import DataSource, create_datasource
+import cancellation
+from chat_processor import Conversation, UserEvent
+from datasource_registry import DatasourceRegistry
+from llm_client import create_async_client, create_client
+from agents.history import history_messages, split_history, summary_request
+from agents.prompt_builder import build_messages, log_usage
+from agents.streaming import STREAM_OPTIONS, ChatCompletionAccumulator
+from config import (
+    HISTORY_PAGE_SIZE,
+    HISTORY_SUMMARY_CONFIG,
+    MAX_TOOL_CALLS,
+    OPENAI_CONFIG,
+    STREAM_RESPONSES,
+    SYSTEM_PROMPT,
+)
+from models.datasource import DataSource
 from schemes.question import QUESTION_OUTPUT_SCHEME
 from tools import tools
 
 
+# conversations whose history summary is being refreshed, one refresh at a time
+_summarizing: set[str] = set()
+_summarizing_lock = threading.Lock()
+_summary_tasks: set[asyncio.Task] = set()
+
+
+def _claim_summary(conversation_id: str) -> bool:
+    with _summarizing_lock:
+        if conversation_id in _summarizing:
+            return False
+        _summarizing.add(conversation_id)
+        return True
+
+
+def _release_summary(conversation_id: str):
+    with _summarizing_lock:
+        _summarizing.discard(conversation_id)
+
+
 class ChatOpenAIDatasourceAgent:
     """
     Agent allowed to use tools.
@@ -21,42 +55,131 @@ class ChatOpenAIDatasourceAgent:
     """
 
     response_format = QUESTION_OUTPUT_SCHEME
+    # stream=True, yields MessageDeltaEvent while the answer is generated
+    stream = STREAM_RESPONSES
+    # field of the structured response streamed to the client, the rest arrives with the message
+    stream_field = "answer"
+    # background refresh of the history summary started by this agent, if any
+    summary_refresh = None
 
-    def __init__(self, mongodb: Database, conversation: Conversation):
+    def __init__(
+        self,
+        mongodb: Database,
+        conversation: Conversation,
+        registry: DatasourceRegistry | None = None,
+    ):
         self.mongodb = mongodb
-        self.client = OpenAI()
+        self.client = create_client()
         self.conversation = conversation
+        self.registry = registry or DatasourceRegistry(mongodb)
 
     def _get_datasources(self, datasource_ids: List[str]) -> List[DataSource]:
-        """Fetch and prepare datasources for the hypothesis"""
-        datasources = []
-        for ds_id in datasource_ids:
-            datasource_raw = self.mongodb.datasources.find_one({"_id": ObjectId(ds_id)})
-            if datasource_raw:
-                datasource = create_datasource(datasource_raw)
-                context = self.mongodb["datasource-contexts"].find_one(
-                    {"_id": ObjectId(ds_id)}
+        """Fetch and prepare datasources for the question"""
+        return self.registry.get_many(datasource_ids)
+
+    def _previous_events(self) -> List[Any]:
+        """Loaded events before the last user event, which is the question being processed"""
+        events = self.conversation.events
+        current = max(
+            (i for i, e in enumerate(events) if isinstance(e, UserEvent)),
+            default=len(events),
+        )
+        return events[:current]
+
+    def _summary_seq(self, events: List[Any]) -> tuple[int, List[Dict]]:
+        """Seq before which the events are summarized, and the turns sent as they are"""
+        older, kept = split_history(events)
+        return self.conversation.first_seq + older, kept
+
+    def _history(self) -> List[Dict]:
+        """
+        Messages of the previous turns, the turns that don't fit the history budget
+        are replaced by their stored summary. The turn doesn't wait for the llm:
+        the summary is refreshed in background after each answer, events it doesn't
+        cover yet (the refresh is still running or failed) are left out of this turn.
+        """
+        seq, kept = self._summary_seq(self._previous_events())
+        if seq == 0:
+            return history_messages(kept)
+        cached = self.conversation.history_summary(self.mongodb)
+        if not cached or cached["seq"] < seq:
+            logging.info(f"History of {self.conversation.id} before seq {seq} isn't summarized yet")
+            self._start_summary(seq)
+        return history_messages(kept, cached["text"] if cached else None)
+
+    def _summarize_history(self):
+        """After an answer, so the next question finds the summary ready"""
+        seq, _ = self._summary_seq(self.conversation.events)
+        if seq:
+            self._start_summary(seq)
+
+    def _start_summary(self, seq: int):
+        if not _claim_summary(self.conversation.id):
+            return
+        self.summary_refresh = threading.Thread(
+            target=self._refresh_summary, args=(seq,), name=f"summary-{self.conversation.id}", daemon=True
+        )
+        self.summary_refresh.start()
+
+    def _refresh_summary(self, seq: int):
+        """
+        Extends the stored summary to cover the stored events before seq, one page
+        of events per llm call. Events are read by seq, also those older than the
+        loaded page, each is summarized once.
+        """
+        try:
+            cached = self.conversation.history_summary(self.mongodb) or {}
+            summary, covered = cached.get("text"), cached.get("seq", 0)
+            while covered < seq:
+                end = min(seq, covered + HISTORY_PAGE_SIZE)
+                events = self.conversation.load_events(self.mongodb, covered, end)
+                response = self.client.chat.completions.create(
+                    messages=summary_request(summary, events), **HISTORY_SUMMARY_CONFIG
                 )
-                datasource.meta = context if context else {}
-                datasources.append(datasource)
-        return datasources
+                log_usage(response, "history summary")
+                summary, covered = response.choices[0].message.content, end
+                self.conversation.save_history_summary(self.mongodb, summary, covered)
+        except Exception as e:
+            logging.warning(f"History summary of {self.conversation.id} failed: {e}")
+        finally:
+            _release_summary(self.conversation.id)
 
     def _prepare_messages(
-        self, question: Dict, datasources: List[DataSource]
+        self, question: str, datasources: List[DataSource], history: List[Dict] = ()
     ) -> List[Dict]:
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": question},
-        ]
-
-        if datasources:
-            datasources_explanation = "You have the following datasources:\n"
-            datasources_explanation += "\n".join(
-                ds.context_prompt() for ds in datasources
+        return build_messages(SYSTEM_PROMPT, question, datasources, self.registry, history)
+
+    def _complete(self, messages: List[Dict]) -> Generator[Any, Any, ChatCompletion]:
+        """
+        Calls the llm and returns the complete response.
+        In stream mode yields content deltas while the response is generated.
+        """
+        if not self.stream:
+            response = self.client.chat.completions.create(
+                messages=messages,
+                response_format=self.response_format,
+                tools=tools.TOOLS,  # TODO! define in function to allow for customization
+                **OPENAI_CONFIG,
             )
-            messages.append({"role": "system", "content": datasources_explanation})
+            log_usage(response, "chat")
+            return response
 
-        return messages
+        accumulator = ChatCompletionAccumulator(self.stream_field)
+        stream_id = str(uuid.uuid4())
+        for chunk in self.client.chat.completions.create(
+            messages=messages,
+            response_format=self.response_format,
+            tools=tools.TOOLS,
+            stream=True,
+            stream_options=STREAM_OPTIONS,
+            **OPENAI_CONFIG,
+        ):
+            delta = accumulator.add(chunk)
+            if delta:
+                yield self.conversation.message_delta(stream_id, delta)
+        response = accumulator.completion()
+        log_usage(response, "chat")
+        return response
 
     def process(self, question, datasourceIds: list[str]) -> Generator[Any, Any, Any]:
         """Process a single hypothesis using OpenAI and return the results"""
@@ -68,18 +191,18 @@ class ChatOpenAIDatasourceAgent:
         # if conversation iniciated by user
         # else try to process the message
         datasources = self._get_datasources(datasourceIds)
-        messages = self._prepare_messages(question, datasources)
+        self.conversation.ensure_history(self.mongodb)
+        history = self._history()
+        messages = self._prepare_messages(question, datasources, history)
         for message in messages:
+            if any(message is h for h in history):
+                # already stored as events of the previous turns
+                continue
             event = self.conversation.add_prompt_message(self.mongodb, message)
             if message["role"] != "user":
                 yield event
 
-        response = self.client.chat.completions.create(
-            messages=messages,
-            response_format=self.response_format,
-            tools=tools.TOOLS,  # TODO! define in function to allow for customization
-            **OPENAI_CONFIG,
-        )
+        response = yield from self._complete(messages)
 
         tool_calls_count = 0
         while response.choices[0].message.tool_calls:
@@ -97,16 +220,154 @@ class ChatOpenAIDatasourceAgent:
             ):
                 yield event
 
-            response = self.client.chat.completions.create(
+            cancellation.check()
+            response = yield from self._complete(messages)
+            tool_calls_count += 1
+
+        try:
+            event = self.conversation.add_message(
+                self.mongodb, dict(response.choices[0].message)
+            )
+            yield event
+
+        except Exception as e:
+            logging.error(f"Error processing hypothesis: {e}")
+            raise
+        self._summarize_history()
+
+
+class AsyncChatOpenAIDatasourceAgent(ChatOpenAIDatasourceAgent):
+    """
+    Same as ChatOpenAIDatasourceAgent, but never blocks the event loop:
+    expects an async mongodb (AsyncMongoClient), talks to OpenAI with AsyncOpenAI
+    and runs tools in worker threads.
+    """
+
+    def __init__(self, mongodb, conversation: Conversation, registry: DatasourceRegistry):
+        """registry needs a sync database, it's used from a worker thread"""
+        self.mongodb = mongodb
+        self.client = create_async_client()
+        self.conversation = conversation
+        self.registry = registry
+
+    async def _get_datasources(self, datasource_ids: List[str]) -> List[DataSource]:
+        """Fetch and prepare datasources for the question"""
+        return await asyncio.to_thread(self.registry.get_many, datasource_ids)
+
+    async def _history(self) -> List[Dict]:
+        """Same as ChatOpenAIDatasourceAgent._history"""
+        seq, kept = self._summary_seq(self._previous_events())
+        if seq == 0:
+            return history_messages(kept)
+        cached = await self.conversation.ahistory_summary(self.mongodb)
+        if not cached or cached["seq"] < seq:
+            logging.info(f"History of {self.conversation.id} before seq {seq} isn't summarized yet")
+            self._start_summary(seq)
+        return history_messages(kept, cached["text"] if cached else None)
+
+    def _start_summary(self, seq: int):
+        if not _claim_summary(self.conversation.id):
+            return
+        self.summary_refresh = asyncio.create_task(self._refresh_summary(seq))
+        # the loop keeps only weak references to tasks
+        _summary_tasks.add(self.summary_refresh)
+        self.summary_refresh.add_done_callback(_summary_tasks.discard)
+
+    async def _refresh_summary(self, seq: int):
+        """Same as ChatOpenAIDatasourceAgent._refresh_summary"""
+        try:
+            cached = await self.conversation.ahistory_summary(self.mongodb) or {}
+            summary, covered = cached.get("text"), cached.get("seq", 0)
+            while covered < seq:
+                end = min(seq, covered + HISTORY_PAGE_SIZE)
+                events = await self.conversation.aload_events(self.mongodb, covered, end)
+                response = await self.client.chat.completions.create(
+                    messages=summary_request(summary, events), **HISTORY_SUMMARY_CONFIG
+                )
+                log_usage(response, "history summary")
+                summary, covered = response.choices[0].message.content, end
+                await self.conversation.save_history_summary(self.mongodb, summary, covered)
+        except Exception as e:
+            logging.warning(f"History summary of {self.conversation.id} failed: {e}")
+        finally:
+            _release_summary(self.conversation.id)
+
+    async def _complete(self, messages: List[Dict]) -> AsyncGenerator[Any, Any]:
+        """
+        Calls the llm, the complete response is the last yielded item.
+        In stream mode content deltas are yielded before it.
+        """
+        if not self.stream:
+            response = await self.client.chat.completions.create(
                 messages=messages,
                 response_format=self.response_format,
                 tools=tools.TOOLS,
                 **OPENAI_CONFIG,
             )
+            log_usage(response, "chat")
+            yield response
+            return
+
+        accumulator = ChatCompletionAccumulator(self.stream_field)
+        stream_id = str(uuid.uuid4())
+        async for chunk in await self.client.chat.completions.create(
+            messages=messages,
+            response_format=self.response_format,
+            tools=tools.TOOLS,
+            stream=True,
+            stream_options=STREAM_OPTIONS,
+            **OPENAI_CONFIG,
+        ):
+            delta = accumulator.add(chunk)
+            if delta:
+                yield self.conversation.message_delta(stream_id, delta)
+        response = accumulator.completion()
+        log_usage(response, "chat")
+        yield response
+
+    async def process(self, question, datasourceIds: list[str]) -> AsyncGenerator[Any, Any]:
+        """Process a single question using OpenAI and stream the resulting events"""
+        datasources = await self._get_datasources(datasourceIds)
+        await self.conversation.aensure_history(self.mongodb)
+        history = await self._history()
+        # ranking tables of large schemas is cpu bound
+        messages = await asyncio.to_thread(self._prepare_messages, question, datasources, history)
+        for message in messages:
+            if any(message is h for h in history):
+                # already stored as events of the previous turns
+                continue
+            event = await self.conversation.add_prompt_message(self.mongodb, message)
+            if message["role"] != "user":
+                yield event
+
+        tool_calls_count = 0
+        while True:
+            async for item in self._complete(messages):
+                if isinstance(item, ChatCompletion):
+                    response = item
+                else:
+                    yield item
+
+            if not response.choices[0].message.tool_calls:
+                break
+
+            logging.info("Processing tool calls...")
+            if tool_calls_count >= MAX_TOOL_CALLS:
+                logging.error("Too many function calls")
+                raise Exception("Too many function calls")
+
+            async for event in tools.ahandle_tools(
+                response,
+                messages,
+                datasources,
+                conversation=self.conversation,
+                mongodb=self.mongodb,
+            ):
+                yield event
             tool_calls_count += 1
 
         try:
-            event = self.conversation.add_message(
+            event = await self.conversation.add_message(
                 self.mongodb, dict(response.choices[0].message)
             )
             yield event
@@ -114,3 +375,4 @@ class ChatOpenAIDatasourceAgent:
         except Exception as e:
             logging.error(f"Error processing hypothesis: {e}")
             raise
+        self._summarize_history()
@@ -3,12 +3,15 @@ import json
 import logging
 from typing import Dict, List
 
-from bson import ObjectId
-from openai import OpenAI
 from pymongo.database import Database
 
+import cancellation
+from agents.prompt_builder import build_messages, log_usage
 from config import OPENAI_CONFIG, SYSTEM_PROMPT, MAX_TOOL_CALLS
-from models.datasource import DataSource, create_datasource
+from datasource_registry import DatasourceRegistry
+from llm_client import create_client
+from models.datasource import DataSource
+from rate_limit import openai_rate_limiter
 from tools import tools
 
 
@@ -22,40 +25,19 @@ class BaseOpenAIDatasourceAgent:
 
     response_format: dict
 
-    def __init__(self, mongodb: Database):
+    def __init__(self, mongodb: Database, registry: DatasourceRegistry | None = None):
         self.mongodb = mongodb
-        self.client = OpenAI()
+        self.client = create_client()
+        self.registry = registry or DatasourceRegistry(mongodb)
 
     def _get_datasources(self, datasource_ids: List[str]) -> List[DataSource]:
         """Fetch and prepare datasources for the hypothesis"""
-        datasources = []
-        for ds_id in datasource_ids:
-            datasource_raw = self.mongodb.datasources.find_one({"_id": ObjectId(ds_id)})
-            if datasource_raw:
-                datasource = create_datasource(datasource_raw)
-                context = self.mongodb["datasource-contexts"].find_one(
-                    {"_id": ObjectId(ds_id)}
-                )
-                datasource.meta = context if context else {}
-                datasources.append(datasource)
-        return datasources
+        return self.registry.get_many(datasource_ids)
 
     def _prepare_messages(
         self, hypothesis: Dict, datasources: List[DataSource]
     ) -> List[Dict]:
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": hypothesis["query"]},
-        ]
-
-        if datasources:
-            datasources_explanation = "You have the following datasources:\n"
-            datasources_explanation += "\n".join(
-                ds.context_prompt() for ds in datasources
-            )
-            messages.append({"role": "system", "content": datasources_explanation})
-
-        return messages
+        return build_messages(SYSTEM_PROMPT, hypothesis["query"], datasources, self.registry)
 
     def process(self, hypothesis: Dict) -> Dict:
         """Process a single hypothesis using OpenAI and return the results"""
@@ -63,12 +45,14 @@ class BaseOpenAIDatasourceAgent:
         messages = self._prepare_messages(hypothesis, datasources)
         used_tools = []
 
+        openai_rate_limiter.acquire()
         response = self.client.chat.completions.create(
             messages=messages,
             response_format=self.response_format,
             tools=tools.TOOLS,  # TODO! define in function to allow for customization
             **OPENAI_CONFIG,
         )
+        log_usage(response, self.__class__.__name__)
 
         tool_calls_count = 0
         while response.choices[0].message.tool_calls:
@@ -79,12 +63,15 @@ class BaseOpenAIDatasourceAgent:
 
             used_tools.extend(tools.handle_tools(response, messages, datasources))
 
+            cancellation.check()
+            openai_rate_limiter.acquire()
             response = self.client.chat.completions.create(
                 messages=messages,
                 response_format=self.response_format,
                 tools=tools.TOOLS,
                 **OPENAI_CONFIG,
             )
+            log_usage(response, self.__class__.__name__)
             tool_calls_count += 1
 
         try:
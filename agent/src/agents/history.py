@@ -0,0 +1,111 @@
+import json
+from typing import Dict, List, Tuple
+
+from chat_processor import EventTypes, MessageEvent, ToolCallEvent, ToolResultEvent, UserEvent
+from config import HISTORY_SUMMARY_RESULT_CHARS, HISTORY_SUMMARY_TOKEN_BUDGET, HISTORY_TOKEN_BUDGET
+
+SUMMARY_PROMPT = """You summarize the earlier part of a conversation between a user and a data analyst assistant.
+The summary replaces that part, the assistant only sees the summary and the newest messages.
+Keep what later questions may refer to: the questions asked, the datasources, tables and columns used,
+the SQL queries and aggregation pipelines that worked, the key numbers of their results and the conclusions.
+Drop greetings and failed attempts. Answer with the summary only, at most {tokens} tokens."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, good enough for budgeting (~4 chars per token)"""
+    return len(text) // 4 + 1
+
+
+def _answer_text(event: MessageEvent) -> str:
+    message = event.message
+    content = getattr(message, "content", None)
+    if content is None:
+        # structured answer already parsed
+        return message.answer
+    try:
+        return json.loads(content)["answer"]
+    except (ValueError, TypeError, KeyError):
+        return content
+
+
+def _turns(events: List[EventTypes]) -> List[Tuple[int, Dict]]:
+    """
+    Question/answer messages of the conversation with the index of their event,
+    tool calls and prompts are skipped
+    """
+    turns = []
+    for i, event in enumerate(events):
+        if isinstance(event, UserEvent):
+            turns.append((i, {"role": "user", "content": event.message}))
+        elif isinstance(event, MessageEvent):
+            turns.append((i, {"role": "assistant", "content": _answer_text(event)}))
+    return turns
+
+
+def split_history(
+    events: List[EventTypes], token_budget: int = HISTORY_TOKEN_BUDGET
+) -> Tuple[int, List[Dict]]:
+    """
+    Splits previous turns of the conversation into the older events, which are summarized,
+    and the newest turns sent as is while they fit into token_budget.
+    Returns the number of older events and the messages of the kept turns.
+    events must not contain the question being answered.
+    """
+    turns = _turns(events)
+    kept = []
+    tokens = 0
+    for turn in reversed(turns):
+        tokens += estimate_tokens(turn[1]["content"])
+        if tokens > token_budget:
+            break
+        kept.append(turn)
+    kept.reverse()
+    # don't start with an answer whose question was cut off
+    while kept and kept[0][1]["role"] == "assistant":
+        kept.pop(0)
+
+    older = kept[0][0] if kept else len(events)
+    return older, [message for _, message in kept]
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit] + "\n..."
+
+
+def _transcript_line(event: EventTypes) -> str | None:
+    if isinstance(event, UserEvent):
+        return f"User: {event.message}"
+    if isinstance(event, MessageEvent):
+        return f"Assistant: {_answer_text(event)}"
+    if isinstance(event, ToolCallEvent):
+        parameters = json.dumps(event.parameters, ensure_ascii=False, default=str)
+        return f"Tool call {event.tool_name}: {parameters}"
+    if isinstance(event, ToolResultEvent):
+        return f"Tool result {event.tool_name}:\n{_clip(event.output, HISTORY_SUMMARY_RESULT_CHARS)}"
+    return None
+
+
+def summary_request(
+    previous: str | None,
+    events: List[EventTypes],
+    token_budget: int = HISTORY_SUMMARY_TOKEN_BUDGET,
+) -> List[Dict]:
+    """
+    Messages asking the llm to summarize events, tool calls and their results included.
+    The previous summary covers the events before them and is extended.
+    """
+    transcript = "\n\n".join(filter(None, map(_transcript_line, events)))
+    if previous:
+        transcript = f"Summary so far:\n{previous}\n\nContinuation:\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(tokens=token_budget)},
+        {"role": "user", "content": transcript},
+    ]
+
+
+def history_messages(kept: List[Dict], summary: str | None = None) -> List[Dict]:
+    """Previous turns as llm messages, the summary of the older turns goes first"""
+    if not summary:
+        return list(kept)
+    message = {"role": "system", "content": "Summary of the earlier conversation:\n" + summary}
+    return [message] + kept
@@ -0,0 +1,61 @@
+import logging
+from typing import Dict, List, Sequence
+
+from metrics import cached_tokens
+from models.datasource import DataSource
+from tools.schema_retrieval import schema_retriever
+
+DATASOURCES_HEADER = "You have the following datasources:\n"
+RELEVANT_DATASOURCES_HEADER = "Relevant part of the following datasources:\n"
+
+
+def _sorted(datasources: Sequence[DataSource]) -> List[DataSource]:
+    return sorted(datasources, key=lambda ds: ds.id)
+
+
+def build_messages(
+    system_prompt: str,
+    question: str,
+    datasources: Sequence[DataSource],
+    registry=None,
+    history: Sequence[Dict] = (),
+) -> List[Dict]:
+    """
+    Messages ordered from the most to the least stable, so that requests about
+    the same datasources share the longest possible prefix for provider prompt caching:
+
+    system prompt, full context of datasources sorted by id,
+    history of the conversation, contexts pruned for this question, the question.
+    The tools sent with the request are a constant, the provider puts them before the messages.
+    """
+    stable, pruned = [], []
+    for ds in _sorted(datasources):
+        context = schema_retriever.context_prompt(ds, question)
+        if context is None:
+            stable.append(registry.context_prompt(ds) if registry else ds.context_prompt())
+        else:
+            pruned.append(context)
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if stable:
+        messages.append({"role": "system", "content": DATASOURCES_HEADER + "\n".join(stable)})
+    messages.extend(history)
+    if pruned:
+        messages.append(
+            {"role": "system", "content": RELEVANT_DATASOURCES_HEADER + "\n".join(pruned)}
+        )
+    messages.append({"role": "user", "content": question})
+    return messages
+
+
+def log_usage(response, label: str):
+    """Logs prompt, cached and completion tokens of an llm response"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    cached = cached_tokens(usage)
+    ratio = cached / usage.prompt_tokens if usage.prompt_tokens else 0
+    logging.info(
+        f"{label}: {usage.prompt_tokens} prompt tokens ({cached} cached, {ratio:.0%}), "
+        f"{usage.completion_tokens} completion tokens"
+    )
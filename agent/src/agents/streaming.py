@@ -0,0 +1,176 @@
+import json
+import time
+from typing import Dict, List
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
+
+STREAM_OPTIONS = {"include_usage": True}
+
+
+class JsonFieldStream:
+    """
+    Decodes one top level string field of a json object while the object is streamed.
+    Structured answers are generated as json, the client gets only the text of the field.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self._depth = 0
+        self._after_colon = False
+        self._in_string = False
+        # "key", "value" (of the field) or None while in a string
+        self._mode = None
+        self._key: List[str] = []
+        self._last_key = ""
+        self._escape = ""
+
+    def feed(self, text: str) -> str:
+        """Adds the next part of the json, returns the newly decoded part of the field"""
+        out = []
+        for char in text:
+            if self._in_string:
+                self._string_char(char, out)
+            elif char == '"':
+                self._in_string = True
+                self._mode = None
+                if self._depth == 1 and not self._after_colon:
+                    self._mode = "key"
+                    self._key = []
+                elif self._depth == 1 and self._last_key == self.field:
+                    self._mode = "value"
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and char == ":":
+                self._after_colon = True
+            elif self._depth == 1 and char == ",":
+                self._after_colon = False
+        return "".join(out)
+
+    def _string_char(self, char: str, out: List[str]):
+        if self._escape:
+            self._escape += char
+            if not self._escape_complete():
+                return
+            try:
+                decoded = json.loads(f'"{self._escape}"')
+            except ValueError:
+                # invalid escape, the complete message is parsed and shown at the end anyway
+                decoded = ""
+            self._escape = ""
+        elif char == "\\":
+            self._escape = char
+            return
+        elif char == '"':
+            self._in_string = False
+            if self._mode == "key":
+                self._last_key = "".join(self._key)
+            return
+        else:
+            decoded = char
+
+        if self._mode == "key":
+            self._key.append(decoded)
+        elif self._mode == "value":
+            out.append(decoded)
+
+    def _escape_complete(self) -> bool:
+        escape = self._escape
+        if escape[1] != "u":
+            return True
+        if len(escape) < 6:
+            return False
+        # a high surrogate is decoded together with the low one that follows it
+        if 0xD800 <= int(escape[2:6], 16) <= 0xDBFF:
+            return len(escape) == 12 or (len(escape) == 7 and escape[6] != "\\")
+        return True
+
+
+class ChatCompletionAccumulator:
+    """
+    Collects chunks of a streamed chat completion (stream=True)
+    and assembles the same ChatCompletion a non-streamed call would return,
+    so the tool loop doesn't care whether the response was streamed.
+    With field set (structured answers) add returns only the decoded
+    delta of that string field of the json content.
+    """
+
+    def __init__(self, field: str | None = None):
+        self.id = ""
+        self.model = ""
+        self.created = int(time.time())
+        self.content = ""
+        self.refusal = None
+        self.finish_reason = None
+        self.usage = None
+        # tool call fragments by their index in the response
+        self.tool_calls: Dict[int, dict] = {}
+        self._field = JsonFieldStream(field) if field else None
+
+    def add(self, chunk: ChatCompletionChunk) -> str:
+        """Adds the chunk, returns the content delta (can be empty)"""
+        self.id = chunk.id or self.id
+        self.model = chunk.model or self.model
+        self.created = chunk.created or self.created
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return ""
+
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+
+        delta = choice.delta
+        if delta.refusal:
+            self.refusal = (self.refusal or "") + delta.refusal
+        for fragment in delta.tool_calls or []:
+            tool_call = self.tool_calls.setdefault(
+                fragment.index, {"id": "", "name": "", "arguments": ""}
+            )
+            if fragment.id:
+                tool_call["id"] = fragment.id
+            if fragment.function:
+                tool_call["name"] += fragment.function.name or ""
+                tool_call["arguments"] += fragment.function.arguments or ""
+
+        if delta.content:
+            self.content += delta.content
+            return self._field.feed(delta.content) if self._field else delta.content
+        return ""
+
+    def completion(self) -> ChatCompletion:
+        tool_calls = [
+            ChatCompletionMessageToolCall(
+                id=tool_call["id"],
+                type="function",
+                function=Function(name=tool_call["name"], arguments=tool_call["arguments"]),
+            )
+            for _, tool_call in sorted(self.tool_calls.items())
+        ]
+        message = ChatCompletionMessage(
+            role="assistant",
+            content=self.content or None,
+            refusal=self.refusal,
+            tool_calls=tool_calls or None,
+        )
+        return ChatCompletion(
+            id=self.id,
+            object="chat.completion",
+            created=self.created,
+            model=self.model,
+            choices=[
+                Choice(
+                    index=0,
+                    finish_reason=self.finish_reason or "stop",
+                    message=message,
+                )
+            ],
+            usage=self.usage,
+        )
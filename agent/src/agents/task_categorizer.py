@@ -1,12 +1,77 @@
+import hashlib
 import json
+import logging
+import re
+import threading
+import time
+from datetime import datetime
 
-from openai import OpenAI
+from pymongo.database import Database
 
+from agents.prompt_builder import log_usage
+from agents.text_similarity import TfidfIndex, tokenize
+from config import (
+    CATEGORIZER_CACHE_SIZE,
+    CATEGORIZER_CORPUS_SIZE,
+    CATEGORIZER_CORPUS_TTL,
+    CATEGORIZER_KEYWORD_CONFIDENCE,
+    CATEGORIZER_NEIGHBOUR_CONFIDENCE,
+)
+from llm_client import create_client
+from rate_limit import openai_rate_limiter
 from schemes.task_categorizer import TaskCategories, CATEGORIZER_OUTPUT_SCHEME
 
+# phrases typical for each category, weighted
+KEYWORDS = {
+    TaskCategories.HYPOTHESIS: {
+        "hypothesis": 3,
+        "hypothesize": 3,
+        "correlate": 2,
+        "correlated": 2,
+        "correlation": 2,
+        "relationship": 2,
+        "impact": 2,
+        "affect": 2,
+        "affects": 2,
+        "influence": 2,
+        "cause": 2,
+        "causes": 2,
+        "more likely": 2,
+        "less likely": 2,
+        "higher than": 1,
+        "lower than": 1,
+        "whether": 1,
+        "because": 1,
+    },
+    TaskCategories.GENERAL_QUESTION: {
+        "how many": 3,
+        "what is": 2,
+        "what are": 2,
+        "which": 2,
+        "list": 2,
+        "show": 2,
+        "top": 1,
+        "count": 1,
+        "average": 1,
+        "total": 1,
+        "when": 1,
+        "where": 1,
+    },
+}
+
+
+def normalize_task_query(task_query: str) -> str:
+    return " ".join(tokenize(task_query))
+
 
 class TaskCategorizer:
-    """Categorizes tasks based on their content and schema"""
+    """
+    Categorizes tasks based on their content and schema.
+
+    Cheapest answer first: task_type set on the task, exact-match cache,
+    local classifier (nearest neighbour over tasks categorized before, keywords),
+    the llm only when the local classifier isn't confident.
+    """
 
     PROMPT = "Please categorize the task based on the content provided."
     OPENAI_CONFIG = {
@@ -18,25 +83,134 @@ class TaskCategorizer:
         "presence_penalty": 0,
     }
 
-    def __init__(self):
-        self.client = OpenAI()
+    def __init__(self, mongodb: Database | None = None):
+        self.client = create_client()
+        self.collection = mongodb["task-categories"] if mongodb is not None else None
+        self._cache: dict[str, TaskCategories] = {}
+        self._corpus: TfidfIndex[TaskCategories] = TfidfIndex()
+        self._corpus_loaded_at = 0.0
+        # tasks are categorized concurrently: guards the cache and the corpus,
+        # whose search builds the vectors that add() invalidates
+        self._lock = threading.Lock()
 
-    def categorize(self, task_query: str) -> TaskCategories:
+    def ensure_indexes(self):
+        if self.collection is not None:
+            # the corpus is the newest llm categorized tasks
+            self.collection.create_index([("source", 1), ("created_at", -1)])
+
+    def categorize(self, task_query: str, task_type: str | None = None) -> TaskCategories:
         """
         Categorize a task based on its content
         Returns TaskType or None if task type cannot be determined
         """
+        if task_type in {category.value for category in TaskCategories}:
+            return TaskCategories(task_type)
+
+        key = hashlib.sha256(normalize_task_query(task_query).encode()).hexdigest()
+        category = self._cached(key)
+        if category:
+            return category
+
+        category, source = self._classify_locally(task_query), "local"
+        if category is None:
+            category, source = self._categorize_with_llm(task_query), "llm"
+        logging.info(f"Task categorized as {category} ({source})")
+
+        self._remember(key, task_query, category, source)
+        return category
+
+    def _cached(self, key: str) -> TaskCategories | None:
+        with self._lock:
+            category = self._cache.get(key)
+        if category or self.collection is None:
+            return category
+        doc = self.collection.find_one({"_id": key}, {"category": 1})
+        if not doc:
+            return None
+        category = TaskCategories(doc["category"])
+        self._cache_category(key, category)
+        return category
+
+    def _cache_category(self, key: str, category: TaskCategories):
+        with self._lock:
+            if len(self._cache) >= CATEGORIZER_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = category
+
+    def _remember(self, key: str, task_query: str, category: TaskCategories, source: str):
+        self._cache_category(key, category)
+        if self.collection is None:
+            return
+        self.collection.replace_one(
+            {"_id": key},
+            {
+                "query": task_query,
+                "category": category.value,
+                "source": source,
+                "created_at": datetime.utcnow(),
+            },
+            upsert=True,
+        )
+        if source == "llm":
+            with self._lock:
+                self._corpus.add(task_query, category)
+
+    def _load_corpus(self) -> TfidfIndex[TaskCategories]:
+        """Tasks categorized by the llm, reloaded periodically to pick up other workers' results"""
+        with self._lock:
+            if self.collection is None:
+                return self._corpus
+            if time.monotonic() - self._corpus_loaded_at < CATEGORIZER_CORPUS_TTL:
+                return self._corpus
+            corpus = TfidfIndex()
+            docs = (
+                self.collection.find({"source": "llm"}, {"query": 1, "category": 1})
+                .sort("created_at", -1)
+                .limit(CATEGORIZER_CORPUS_SIZE)
+            )
+            for doc in docs:
+                corpus.add(doc["query"], TaskCategories(doc["category"]))
+            self._corpus = corpus
+            self._corpus_loaded_at = time.monotonic()
+            return corpus
+
+    def _classify_locally(self, task_query: str) -> TaskCategories | None:
+        """Returns None when not confident enough"""
+        corpus = self._load_corpus()
+        with self._lock:
+            neighbours = corpus.search(task_query, k=1)
+        if neighbours and neighbours[0][0] >= CATEGORIZER_NEIGHBOUR_CONFIDENCE:
+            return neighbours[0][1]
+
+        text = " " + normalize_task_query(task_query) + " "
+        scores = {
+            category: sum(
+                weight
+                for phrase, weight in keywords.items()
+                if re.search(rf" {phrase} ", text)
+            )
+            for category, keywords in KEYWORDS.items()
+        }
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        best, best_score = ranked[0]
+        second_score = ranked[1][1] if len(ranked) > 1 else 0
+        if best_score - second_score >= CATEGORIZER_KEYWORD_CONFIDENCE:
+            return best
+        return None
 
+    def _categorize_with_llm(self, task_query: str) -> TaskCategories:
         messages = [
             {"role": "system", "content": self.PROMPT},
             {"role": "user", "content": task_query},
         ]
 
+        openai_rate_limiter.acquire()
         response = self.client.chat.completions.create(
             messages=messages,
             response_format=CATEGORIZER_OUTPUT_SCHEME,
             **self.OPENAI_CONFIG,
         )
+        log_usage(response, "categorizer")
         res = json.loads(response.choices[0].message.content)
 
         return TaskCategories(res["category"])
@@ -0,0 +1,57 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Generic, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens, snake_case and camelCase identifiers are split into words"""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return TOKEN_RE.findall(text.lower())
+
+
+class TfidfIndex(Generic[T]):
+    """
+    Small in-memory tf-idf index with cosine similarity search.
+    Not thread safe: search builds the vectors which add invalidates.
+    """
+
+    def __init__(self):
+        self._items: List[T] = []
+        self._counts: List[Counter] = []
+        self._df: Counter = Counter()
+        self._vectors: List[Dict[str, float]] | None = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, text: str, item: T):
+        counts = Counter(tokenize(text))
+        self._items.append(item)
+        self._counts.append(counts)
+        self._df.update(counts.keys())
+        self._vectors = None
+
+    def _idf(self, token: str) -> float:
+        return math.log((1 + len(self._items)) / (1 + self._df.get(token, 0))) + 1
+
+    def _vector(self, counts: Counter) -> Dict[str, float]:
+        vector = {token: tf * self._idf(token) for token, tf in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {token: v / norm for token, v in vector.items()}
+
+    def search(self, text: str, k: int = 5) -> List[Tuple[float, T]]:
+        """Top k items by cosine similarity to text, best first"""
+        if self._vectors is None:
+            self._vectors = [self._vector(counts) for counts in self._counts]
+        query = self._vector(Counter(tokenize(text)))
+        scored = [
+            (sum(weight * vector.get(token, 0.0) for token, weight in query.items()), i)
+            for i, vector in enumerate(self._vectors)
+        ]
+        scored.sort(key=lambda x: x[0], reverse=True)
+        return [(score, self._items[i]) for score, i in scored[:k] if score > 0]
@@ -1,20 +1,28 @@
 import json
 import logging
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
 import os
 from datetime import datetime
-from bson import ObjectId
-from pymongo import MongoClient
-from openai import OpenAI
+from pymongo import AsyncMongoClient, MongoClient
 import asyncio
 from fastapi import WebSocket, WebSocketDisconnect
 from datetime import datetime
 
-from agents.chat_agent import ChatOpenAIDatasourceAgent
-from chat_processor import Conversation
+import cancellation
+from agents.chat_agent import AsyncChatOpenAIDatasourceAgent
+from agents.prompt_builder import log_usage
+from cancellation import CancellationToken
+from chat_processor import Conversation, ensure_event_indexes
+from config import QUERY_CACHE_SHARED
+from datasource_registry import DatasourceRegistry
+from llm_client import create_async_client
+from metrics import CONTENT_TYPE, REGISTRY, init_tracing, span
+from tools.query_cache import query_cache
+from tools.result_store import result_store
+from tools.schema_introspection import SchemaIndexer
 
 app = FastAPI()
 
@@ -27,10 +35,33 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# MongoDB connection
-client = MongoClient(os.getenv("MONGODB_URI"))
+# MongoDB connection, async so request handlers never block the event loop
+client = AsyncMongoClient(os.getenv("MONGODB_URI"))
 db = client["research_db"]
 
+# the query cache and the datasource registry are used from worker threads,
+# so they get a sync client
+sync_db = MongoClient(os.getenv("MONGODB_URI"))["research_db"]
+registry = DatasourceRegistry(sync_db)
+schema_indexer = SchemaIndexer(sync_db)
+
+
+@app.on_event("startup")
+async def startup():
+    init_tracing()
+    await ensure_event_indexes(db)
+    # both create their indexes, so mongodb is first touched here and not on import
+    await asyncio.to_thread(result_store.attach_mongodb, sync_db)
+    if QUERY_CACHE_SHARED:
+        await asyncio.to_thread(query_cache.attach_mongodb, sync_db)
+    registry.start_watching()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics of this process"""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
 
 class DatasourceRequest(BaseModel):
     datasourceIds: List[str]
@@ -53,50 +84,44 @@ async def generate_hypothesis(request: DatasourceRequest):
         raise HTTPException(status_code=400, detail="No datasource IDs provided")
 
     # Fetch datasource contexts
-    datasources = []
-    for ds_id in request.datasourceIds:
-        try:
-            datasource = db.datasources.find_one({"_id": ObjectId(ds_id)})
-            if datasource:
-                datasource["tables"] = (
-                    db["datasource-contexts"]
-                    .find_one({"_id": ObjectId(ds_id)})
-                    .get("tables", [])
-                )
-                datasources.append(datasource)
-        except Exception as e:
-            logging.exception(f"Error fetching datasource context: {str(e)}")
-            raise HTTPException(
-                status_code=404, detail=f"Datasource not found: {ds_id}"
-            )
+    try:
+        datasources = await asyncio.to_thread(registry.get_many, request.datasourceIds)
+    except Exception as e:
+        logging.exception(f"Error fetching datasource context: {str(e)}")
+        raise HTTPException(
+            status_code=404, detail=f"Datasource not found: {request.datasourceIds}"
+        )
 
     if not datasources:
         raise HTTPException(status_code=404, detail="No valid datasources found")
 
-    # Prepare context for OpenAI
+    # Prepare context for OpenAI, sorted so that requests for the same datasources
+    # share the prompt prefix cached by the provider
     datasources_explanation = "Available datasources and their structure:\n"
-    for ds in datasources:
-        datasources_explanation += f"\nDatasource '{ds['name']}':\n"
-        datasources_explanation += f"Tables: {ds['tables']}\n"
+    for ds in sorted(datasources, key=lambda ds: ds.id):
+        datasources_explanation += f"\nDatasource '{ds.name}':\n"
+        datasources_explanation += f"Tables: {ds.meta.get('tables', [])}\n"
 
-    # Prepare messages for OpenAI
+    # Prepare messages for OpenAI, static instructions first
     messages = [
         {
             "role": "system",
-            "content": "You are a data analyst tasked with generating research hypotheses.",
+            "content": "You are a data analyst tasked with generating research hypotheses.\n"
+            + HYPOTHESIS_PROMPT,
         },
         {
             "role": "user",
-            "content": f"{HYPOTHESIS_PROMPT}\n\n{datasources_explanation}",
+            "content": datasources_explanation,
         },
     ]
 
     try:
         # Generate hypothesis using OpenAI
-        client = OpenAI()
-        response = client.chat.completions.create(
+        client = create_async_client()
+        response = await client.chat.completions.create(
             model=MODEL, messages=messages, temperature=1, max_tokens=500
         )
+        log_usage(response, "generate-hypothesis")
 
         # Extract hypothesis from response
         hypothesis = {
@@ -114,16 +139,81 @@ async def generate_hypothesis(request: DatasourceRequest):
         )
 
 
+@app.post("/datasources/{datasource_id}/invalidate-cache")
+async def invalidate_datasource_cache(datasource_id: str):
+    """Drops cached query results of the datasource, e.g. after its data was reloaded"""
+    await asyncio.to_thread(query_cache.invalidate, datasource_id)
+    return {"status": "ok"}
+
+
+@app.post("/datasources/{datasource_id}/introspect")
+async def introspect_datasource(datasource_id: str):
+    """Rebuilds the schema index of the datasource from its catalog"""
+    datasources = await asyncio.to_thread(registry.get_many, [datasource_id])
+    if not datasources:
+        raise HTTPException(status_code=404, detail="Datasource not found")
+    try:
+        index = await asyncio.to_thread(schema_indexer.refresh, datasources[0], True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error introspecting datasource: {str(e)}")
+    if index is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Introspection is not supported for {datasources[0].type.value} datasources",
+        )
+    registry.invalidate(datasource_id)
+    return {"version": index.version, "tables": len(index.tables)}
+
+
+@app.get("/results/{result_id}")
+async def download_result(result_id: str):
+    """Whole query result of a tool call as csv, the llm saw only its first rows"""
+    result = await asyncio.to_thread(result_store.load, result_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    csv = await asyncio.to_thread(result.to_csv)
+    return Response(
+        content=csv,
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="result-{result_id}.csv"'},
+    )
+
+
+async def _send(websocket: WebSocket, text: str):
+    with span("websocket_send"):
+        await websocket.send_text(text)
+
+
+async def _answer(websocket: WebSocket, conversation: Conversation, res, token: CancellationToken):
+    """Runs the agent for one user message, its queries are interrupted once token is cancelled"""
+    with cancellation.bind(token):
+        agent = AsyncChatOpenAIDatasourceAgent(db, conversation, registry)
+        try:
+            async for response in agent.process(res.message, res.datasoruceIds):
+                if response:
+                    await _send(websocket, response.model_dump_json())
+        except Exception as e:
+            await _send(websocket, json.dumps({
+                "type": "error",
+                "content": str(e)
+            }))
+
 
 @app.websocket("/ws/{conversation_id}")
 async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
     await websocket.accept()
     
-    conversation = Conversation.create(db, conversation_id)
+    conversation = await Conversation.acreate(db, conversation_id)
 
+    # the socket is read while the agent works, so a disconnect is noticed
+    # and the running llm call and queries are abandoned
+    receiving = None
     try:
         while True:
-            data = await websocket.receive_text()
+            if receiving is None:
+                receiving = asyncio.ensure_future(websocket.receive_text())
+            data = await receiving
+            receiving = None
             message = json.loads(data)
             
             if message.get('type') == 'fix_sql':
@@ -156,31 +246,32 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
                 #         "content": str(e)
                 #     }))
                 # continue
-            res = conversation.add_user_message(db, message)
-            await websocket.send_text(res.model_dump_json())
+            res = await conversation.add_user_message(db, message)
+            await _send(websocket, res.model_dump_json())
 
             if len(res.datasoruceIds) == 0:
-                await websocket.send_text(json.dumps({
+                await _send(websocket, json.dumps({
                     "type": "error",
                     "content": "No datasource IDs provided"
                 }))
                 continue
 
-            agent = ChatOpenAIDatasourceAgent(db, conversation)
-            try:
-                for response in agent.process(res.message, res.datasoruceIds):
-                    if response:
-                        await websocket.send_text(response.model_dump_json())
-                        # Give other tasks a chance to run
-                        await asyncio.sleep(0)
-            except Exception as e:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "content": str(e)
-                }))
+            token = CancellationToken()
+            processing = asyncio.create_task(_answer(websocket, conversation, res, token))
+            # a message sent meanwhile is handled in the next iteration
+            receiving = asyncio.ensure_future(websocket.receive_text())
+            await asyncio.wait({processing, receiving}, return_when=asyncio.FIRST_COMPLETED)
+            if receiving.done() and receiving.exception() is not None:
+                token.cancel("client disconnected")
+                processing.cancel()
+                receiving.result()
+            await processing
                 
     except WebSocketDisconnect:
         print(f"Client disconnected from conversation {conversation_id}")
+    finally:
+        if receiving is not None and not receiving.done():
+            receiving.cancel()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import contextvars
+import functools
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List
+
+
+class Cancelled(Exception):
+    """The work was abandoned: the client disconnected or the task lease was lost"""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation of one chat turn or task.
+    Executors check it between batches and register callbacks
+    which interrupt a running query (postgres cancel, mysql KILL QUERY...).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable] = []
+        self._lock = threading.Lock()
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        logging.info(f"Cancelling: {reason}")
+        for callback in callbacks:
+            _call(callback)
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    @contextmanager
+    def on_cancel(self, callback: Callable):
+        """Calls callback if the token is cancelled while the block runs"""
+        with self._lock:
+            cancelled = self._event.is_set()
+            if not cancelled:
+                self._callbacks.append(callback)
+        if cancelled:
+            _call(callback)
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+
+def _call(callback: Callable):
+    try:
+        callback()
+    except Exception as e:
+        logging.warning(f"Cancellation callback failed: {e}")
+
+
+# token of the chat turn / task being processed, worker threads get it
+# by running in a copy of the context (see in_context)
+_current: contextvars.ContextVar[CancellationToken | None] = contextvars.ContextVar(
+    "cancellation_token", default=None
+)
+
+
+def current() -> CancellationToken | None:
+    return _current.get()
+
+
+@contextmanager
+def bind(token: CancellationToken):
+    """Makes token the current one for the block"""
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def check():
+    """Raises Cancelled when the current work was cancelled"""
+    token = _current.get()
+    if token is not None:
+        token.check()
+
+
+def on_cancel(callback: Callable):
+    token = _current.get()
+    return token.on_cancel(callback) if token is not None else nullcontext()
+
+
+def in_context(func: Callable) -> Callable:
+    """
+    func bound to a copy of the current context, for executor.submit / run_in_executor
+    which don't carry the context (and the token) to the worker thread
+    """
+    return functools.partial(contextvars.copy_context().run, func)
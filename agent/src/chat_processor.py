@@ -1,10 +1,15 @@
 from datetime import datetime
 import enum
+import inspect
+import time
 import uuid
-from typing import Literal, Union, List
+from typing import Any, Literal, Union, List
 
 import pydantic
+from pymongo.errors import BulkWriteError
 
+from config import HISTORY_PAGE_SIZE
+from metrics import observe
 from schemes.question import QuestionOutputScheme
 
 
@@ -21,6 +26,7 @@ class EventTypesEnum(enum.StrEnum):
     PROMPT = "prompt"
     TOOL_CALL = "tool_call"
     TOOL_RESULT = "tool_result"
+    MESSAGE_DELTA = "message_delta"
 
 
 class BaseEvent(pydantic.BaseModel):
@@ -59,7 +65,7 @@ class ToolCallEvent(BaseEvent):
     type: Literal[EventTypesEnum.TOOL_CALL] = EventTypesEnum.TOOL_CALL
     tool_call_id: str
     tool_name: str
-    parameters: dict[str, str]
+    parameters: dict[str, Any]
 
 
 class ToolResultEvent(BaseEvent):
@@ -67,6 +73,19 @@ class ToolResultEvent(BaseEvent):
     tool_call_id: str
     tool_name: str
     output: str
+    # full query result in the result store, when output shows only a part of it
+    result_id: str | None = None
+
+
+class MessageDeltaEvent(BaseEvent):
+    """
+    Part of the assistant message while it is streamed.
+    Deltas of one message share the id, they are sent to the client but never stored,
+    the complete message is stored as MessageEvent.
+    """
+
+    type: Literal[EventTypesEnum.MESSAGE_DELTA] = EventTypesEnum.MESSAGE_DELTA
+    delta: str
 
 
 EventTypes = Union[
@@ -80,31 +99,270 @@ EventTypes = Union[
 ]
 
 
+EVENTS_COLLECTION = "conversation_events"
+
+_event_adapter = pydantic.TypeAdapter(EventTypes)
+
+
+def ensure_event_indexes(db):
+    """Events are stored one document per event, addressed by (conversation_id, seq)"""
+    return db[EVENTS_COLLECTION].create_index(
+        [("conversation_id", 1), ("seq", 1)], unique=True
+    )
+
+
+def _event_document(conversation_id: str, seq: int, event: EventTypes) -> dict:
+    return {"conversation_id": conversation_id, "seq": seq, **event.model_dump()}
+
+
+def _parse_event(doc: dict) -> EventTypes:
+    return _event_adapter.validate_python(doc)
+
+
+def _range_filter(conversation_id: str, start_seq: int = 0, end_seq: int | None = None) -> dict:
+    seq = {"$gte": start_seq}
+    if end_seq is not None:
+        seq["$lt"] = end_seq
+    return {"conversation_id": conversation_id, "seq": seq}
+
+
+def _insert_ignoring_duplicates(db, docs: List[dict]):
+    """Unordered bulk insert, already stored events (same seq) are skipped"""
+    try:
+        db[EVENTS_COLLECTION].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+
+
+async def _ainsert_ignoring_duplicates(db, docs: List[dict]):
+    try:
+        await db[EVENTS_COLLECTION].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+
+
+def migrate_embedded_events(db, conversation_id: str):
+    """
+    Moves events of the old layout (array embedded in the conversations document)
+    to the conversation_events collection. Safe to rerun after a failure.
+    """
+    conversation = db.conversations.find_one(
+        {"_id": conversation_id, "events": {"$exists": True}}, {"events": 1}
+    )
+    if not conversation:
+        return
+    docs = [
+        {"conversation_id": conversation_id, "seq": seq, **event}
+        for seq, event in enumerate(conversation["events"])
+    ]
+    if docs:
+        _insert_ignoring_duplicates(db, docs)
+    db.conversations.update_one({"_id": conversation_id}, {"$unset": {"events": ""}})
+
+
+async def amigrate_embedded_events(db, conversation_id: str):
+    conversation = await db.conversations.find_one(
+        {"_id": conversation_id, "events": {"$exists": True}}, {"events": 1}
+    )
+    if not conversation:
+        return
+    docs = [
+        {"conversation_id": conversation_id, "seq": seq, **event}
+        for seq, event in enumerate(conversation["events"])
+    ]
+    if docs:
+        await _ainsert_ignoring_duplicates(db, docs)
+    await db.conversations.update_one({"_id": conversation_id}, {"$unset": {"events": ""}})
+
+
+def migrate_all_embedded_events(db):
+    """Migrates every conversation still stored in the embedded layout"""
+    for conversation in db.conversations.find({"events": {"$exists": True}}, {"_id": 1}):
+        migrate_embedded_events(db, conversation["_id"])
+
+
+async def _resolve(write, result, operation: str, start: float):
+    try:
+        await write
+    except Exception:
+        observe("mongo_write", time.perf_counter() - start, operation, error=True)
+        raise
+    observe("mongo_write", time.perf_counter() - start, operation)
+    return result
+
+
+def _then(write, result, operation: str, start: float):
+    """
+    Returns result, or an awaitable resolving to it when the write is async.
+    The duration of the write is observed once it completed.
+    """
+    if inspect.isawaitable(write):
+        return _resolve(write, result, operation, start)
+    observe("mongo_write", time.perf_counter() - start, operation)
+    return result
+
+
+def _in_order(writes: list):
+    """
+    One awaitable running the writes of an async database one after another,
+    None when the database is sync and the writes are done already
+    """
+    if not any(inspect.isawaitable(write) for write in writes):
+        return None
+
+    async def run():
+        for write in writes:
+            await write
+
+    return run()
+
+
 class Conversation(pydantic.BaseModel):
     id: str
     started_at: datetime
+    # loaded window of the stored events, events[0] has seq == first_seq
     events: List[EventTypes]
+    first_seq: int = 0
+    next_seq: int = 0
+    _history_loaded: bool = pydantic.PrivateAttr(default=False)
 
     @classmethod
     def create(cls, db, conversation_id: str):
         conversation = db.conversations.find_one({"_id": conversation_id})
         if not conversation:
-            db.conversations.insert_one(
-                {
-                    "_id": conversation_id,
-                    "created_at": datetime.utcnow(),
-                    "events": [],
-                }
-            )
+            db.conversations.insert_one(cls._new_document(conversation_id))
+        elif "events" in conversation:
+            migrate_embedded_events(db, conversation_id)
+
+        last = db[EVENTS_COLLECTION].find_one(
+            {"conversation_id": conversation_id}, {"seq": 1}, sort=[("seq", -1)]
+        )
+        return cls._new(conversation_id, last)
+
+    @classmethod
+    async def acreate(cls, db, conversation_id: str):
+        """Same as create, for an async (AsyncMongoClient) database"""
+        conversation = await db.conversations.find_one({"_id": conversation_id})
+        if not conversation:
+            await db.conversations.insert_one(cls._new_document(conversation_id))
+        elif "events" in conversation:
+            await amigrate_embedded_events(db, conversation_id)
 
-        conversation = cls(id=conversation_id, started_at=datetime.utcnow(), events=[])
-        return conversation
+        last = await db[EVENTS_COLLECTION].find_one(
+            {"conversation_id": conversation_id}, {"seq": 1}, sort=[("seq", -1)]
+        )
+        return cls._new(conversation_id, last)
+
+    @classmethod
+    def _new(cls, conversation_id: str, last_event: dict | None):
+        next_seq = last_event["seq"] + 1 if last_event else 0
+        return cls(
+            id=conversation_id,
+            started_at=datetime.utcnow(),
+            events=[],
+            first_seq=next_seq,
+            next_seq=next_seq,
+        )
+
+    @staticmethod
+    def _new_document(conversation_id: str) -> dict:
+        return {
+            "_id": conversation_id,
+            "created_at": datetime.utcnow(),
+        }
 
     def _push_event(self, db, event: EventTypes):
+        """
+        Stores the event and returns it.
+        With an async database the write is returned as an awaitable resolving to the event,
+        so every add_* method works for both sync and async callers.
+        """
+        doc = _event_document(self.id, self.next_seq, event)
         self.events.append(event)
-        db.conversations.update_one(
-            {"_id": self.id},
-            {"$push": {"events": event.model_dump()}},
+        self.next_seq += 1
+        start = time.perf_counter()
+        return _then(db[EVENTS_COLLECTION].insert_one(doc), event, "insert_event", start)
+
+    def _push_events(self, db, events: List[EventTypes]):
+        """Stores several events with one unordered bulk insert"""
+        docs = [
+            _event_document(self.id, self.next_seq + i, event)
+            for i, event in enumerate(events)
+        ]
+        self.events.extend(events)
+        self.next_seq += len(events)
+        start = time.perf_counter()
+        return _then(
+            db[EVENTS_COLLECTION].insert_many(docs, ordered=False), events, "insert_events", start
+        )
+
+    def load_events(self, db, start_seq: int = 0, end_seq: int | None = None) -> List[EventTypes]:
+        """Reads stored events with start_seq <= seq < end_seq"""
+        cursor = db[EVENTS_COLLECTION].find(
+            _range_filter(self.id, start_seq, end_seq), {"_id": 0}
+        ).sort("seq", 1)
+        return [_parse_event(doc) for doc in cursor]
+
+    async def aload_events(self, db, start_seq: int = 0, end_seq: int | None = None) -> List[EventTypes]:
+        cursor = db[EVENTS_COLLECTION].find(
+            _range_filter(self.id, start_seq, end_seq), {"_id": 0}
+        ).sort("seq", 1)
+        return [_parse_event(doc) async for doc in cursor]
+
+    def load_older(self, db, limit: int = HISTORY_PAGE_SIZE) -> List[EventTypes]:
+        """Prepends the page of stored events right before the loaded window, newest first"""
+        start_seq = max(0, self.first_seq - limit)
+        events = self.load_events(db, start_seq, self.first_seq)
+        self.events = events + self.events
+        self.first_seq = start_seq
+        return events
+
+    async def aload_older(self, db, limit: int = HISTORY_PAGE_SIZE) -> List[EventTypes]:
+        start_seq = max(0, self.first_seq - limit)
+        events = await self.aload_events(db, start_seq, self.first_seq)
+        self.events = events + self.events
+        self.first_seq = start_seq
+        return events
+
+    def ensure_history(self, db):
+        """Lazily loads the newest page of the history stored before this object was created"""
+        if not self._history_loaded:
+            self._history_loaded = True
+            self.load_older(db)
+
+    async def aensure_history(self, db):
+        if not self._history_loaded:
+            self._history_loaded = True
+            await self.aload_older(db)
+
+    def history_summary(self, db) -> dict | None:
+        """
+        Cached summary of the older turns, {"text": ..., "seq": ...}:
+        it covers the stored events with seq lower than "seq"
+        """
+        doc = db.conversations.find_one({"_id": self.id}, {"history_summary": 1})
+        return (doc or {}).get("history_summary")
+
+    async def ahistory_summary(self, db) -> dict | None:
+        doc = await db.conversations.find_one({"_id": self.id}, {"history_summary": 1})
+        return (doc or {}).get("history_summary")
+
+    def save_history_summary(self, db, text: str, seq: int):
+        """Stores the summary unless a summary covering as many events is stored already"""
+        start = time.perf_counter()
+        write = db.conversations.update_one(
+            {"_id": self.id, "history_summary.seq": {"$not": {"$gte": seq}}},
+            {"$set": {"history_summary": {"text": text, "seq": seq}}},
+        )
+        return _then(write, None, "save_history_summary", start)
+
+    def _drop_history_summary(self, db, seq: int):
+        """The cached summary is stale once an event it covers (seq) changed or was removed"""
+        return db.conversations.update_one(
+            {"_id": self.id, "history_summary.seq": {"$gt": seq}},
+            {"$unset": {"history_summary": ""}},
         )
 
     def add_user_message(self, db, data: dict[str, str | list[str]]) -> UserEvent:
@@ -114,8 +372,7 @@ class Conversation(pydantic.BaseModel):
             message=data["content"],
             datasoruceIds=data["datasourceIds"],
         )
-        self._push_event(db, event)
-        return event
+        return self._push_event(db, event)
 
     def add_prompt_message(self, db, message: dict) -> UserEvent:
         event = PromptEvent(
@@ -123,31 +380,39 @@ class Conversation(pydantic.BaseModel):
             timestamp=datetime.utcnow(),
             message=message["content"],
         )
-        self._push_event(db, event)
-        return event
+        return self._push_event(db, event)
 
     def add_message(self, db, message: OpenAIMessage) -> UserEvent:
         event = MessageEvent(
             id=str(uuid.uuid4()), timestamp=datetime.utcnow(), message=message
         )
-        self._push_event(db, event)
-        return event
+        return self._push_event(db, event)
+
+    def message_delta(self, stream_id: str, delta: str) -> MessageDeltaEvent:
+        return MessageDeltaEvent(id=stream_id, timestamp=datetime.utcnow(), delta=delta)
 
     def add_tool_call(
-        self, db, tool_call_id: str, tool_name: str, parameters: dict[str, str]
+        self, db, tool_call_id: str, tool_name: str, parameters: dict[str, Any]
     ) -> UserEvent:
-        event = ToolCallEvent(
+        return self._push_event(db, self._tool_call_event(tool_call_id, tool_name, parameters))
+
+    def add_tool_calls(self, db, tool_calls: List[tuple[str, str, dict[str, Any]]]) -> List[ToolCallEvent]:
+        """Stores the (tool_call_id, tool_name, parameters) calls of one llm response at once"""
+        events = [self._tool_call_event(*tool_call) for tool_call in tool_calls]
+        return self._push_events(db, events)
+
+    @staticmethod
+    def _tool_call_event(tool_call_id: str, tool_name: str, parameters: dict[str, Any]) -> ToolCallEvent:
+        return ToolCallEvent(
             id=str(uuid.uuid4()),
             timestamp=datetime.utcnow(),
             tool_call_id=tool_call_id,
             tool_name=tool_name,
             parameters=parameters,
         )
-        self._push_event(db, event)
-        return event
 
     def add_tool_call_result(
-        self, db, tool_call_id: str, tool_name: str, output: str
+        self, db, tool_call_id: str, tool_name: str, output: str, result_id: str | None = None
     ) -> UserEvent:
         event = ToolResultEvent(
             id=str(uuid.uuid4()),
@@ -155,38 +420,51 @@ class Conversation(pydantic.BaseModel):
             tool_call_id=tool_call_id,
             tool_name=tool_name,
             output=output,
+            result_id=result_id,
         )
-        self._push_event(db, event)
-        return event
+        return self._push_event(db, event)
+
+    def _seq_of(self, event_id) -> int | None:
+        index = next((i for i, e in enumerate(self.events) if e.id == event_id), None)
+        return None if index is None else self.first_seq + index
 
     def remove_events_after(self, db, event_id):
-        """Remove all events after the specified event ID"""
-        # Find the event in the current events list
-        event_index = next((i for i, e in enumerate(self.events) if e.id == event_id), -1)
-        if event_index == -1:
-            return
-
-        # Remove events after this index from the list
-        self.events = self.events[:event_index + 1]
-        
-        # Update the database
-        db.conversations.update_one(
-            {"_id": self.id},
-            {"$set": {"events": [e.model_dump() for e in self.events]}}
-        )
+        """
+        Remove all events after the specified event ID.
+        Awaitable with an async database, like the add_* methods.
+        """
+        seq = self._seq_of(event_id)
+        if seq is None:
+            raise ValueError(f"Event {event_id} is not in the loaded history")
+
+        # Remove events after this event from the list
+        self.events = self.events[: seq - self.first_seq + 1]
+        self.next_seq = seq + 1
+
+        start = time.perf_counter()
+        writes = [
+            db[EVENTS_COLLECTION].delete_many({"conversation_id": self.id, "seq": {"$gt": seq}}),
+            self._drop_history_summary(db, seq + 1),
+        ]
+        return _then(_in_order(writes), None, "remove_events", start)
 
     def update_tool_call_query(self, db, event_id, new_query):
-        """Update the SQL query in a tool call event"""
-        # Update in memory
-        event = next((e for e in self.events if e.id == event_id), None)
-        if event and isinstance(event, ToolCallEvent):
-            event.parameters["query"] = new_query
-        
-        # Update in database
-        db.conversations.update_one(
-            {"_id": self.id},
-            {"$set": {"events": [e.model_dump() for e in self.events]}}
-        )
+        """Update the SQL query in a tool call event, awaitable with an async database"""
+        seq = self._seq_of(event_id)
+        event = None if seq is None else self.events[seq - self.first_seq]
+        if not isinstance(event, ToolCallEvent):
+            raise ValueError(f"Event {event_id} is not a loaded tool call")
+
+        event.parameters["query"] = new_query
+        start = time.perf_counter()
+        writes = [
+            db[EVENTS_COLLECTION].update_one(
+                {"conversation_id": self.id, "seq": seq},
+                {"$set": {"parameters.query": new_query}},
+            ),
+            self._drop_history_summary(db, seq),
+        ]
+        return _then(_in_order(writes), event, "update_tool_call", start)
 
     def get_last_user_message(self, db):
         """Get the last user message from the conversation"""
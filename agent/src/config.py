@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 from typing import Dict
 
@@ -25,5 +26,120 @@ NEVER USE OPERATOR '*' FOR SELECT STATEMENT.
 NEVER DO JOINS BETWEEN DIFFERENT DATASOURCES. MAKE DIFFERENT QUERIES FOR EACH DATASOURCE.
 """
 
+# llm response cache, see llm_client.py
+# off: every call goes to the api, cache: identical requests are answered from LLM_CACHE_DIR,
+# record: every call goes to the api and is stored, replay: only stored responses, never the api
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off")
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm-cache")
+
+# stream llm output to chat clients as it is generated
+STREAM_RESPONSES = True
+
 MAX_TOOL_CALLS = 5
+
+# previous turns of a chat conversation sent to the llm
+HISTORY_PAGE_SIZE = 100  # events loaded from mongodb at once
+HISTORY_TOKEN_BUDGET = 4000
+HISTORY_SUMMARY_TOKEN_BUDGET = 500
+# turns that don't fit HISTORY_TOKEN_BUDGET are summarized by this model
+HISTORY_SUMMARY_CONFIG: Dict = {
+    "model": "gpt-4o-mini",
+    "temperature": 0,
+    "max_tokens": HISTORY_SUMMARY_TOKEN_BUDGET,
+}
+HISTORY_SUMMARY_RESULT_CHARS = 1000  # tool output per result given to the summarizer
 MONITOR_SLEEP_TIME = 1
+
+# connection pool per datasource
+POOL_MAX_SIZE = 4
+POOL_IDLE_TIMEOUT = 300  # seconds
+POOL_CHECKOUT_TIMEOUT = 30  # seconds
+
+# tool calls returned in one llm response are executed concurrently
+TOOL_CALL_WORKERS = 8
+MAX_CONCURRENT_QUERIES_PER_DATASOURCE = POOL_MAX_SIZE
+
+# queries are stopped by the database after this time (postgres statement_timeout,
+# mysql/clickhouse max_execution_time, mongodb maxTimeMS, sqlite progress handler)
+QUERY_TIMEOUT_SECONDS = int(os.getenv("QUERY_TIMEOUT_SECONDS", "60"))
+# sqlite checks the timeout and cancellation every this many vm instructions
+SQLITE_PROGRESS_STEPS = 10_000
+# sqlite files are opened read only and memory mapped, pages are shared by all connections
+# through the os page cache. Immutable files are read without locking, set SQLITE_IMMUTABLE=0
+# for files written while the agent runs (e.g. in WAL mode).
+SQLITE_IMMUTABLE = os.getenv("SQLITE_IMMUTABLE", "1") == "1"
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(1024 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = 32 * 1024  # page cache of each connection
+
+# query results are read in batches and cut at these limits
+FETCH_BATCH_SIZE = 500
+# clickhouse results are read as numpy columns, block by block
+CLICKHOUSE_BLOCK_SIZE = 16_384
+# wire compression of clickhouse results (lz4, lz4hc, zstd), empty disables it
+CLICKHOUSE_COMPRESSION = os.getenv("CLICKHOUSE_COMPRESSION", "lz4")
+MAX_FETCH_ROWS = 100_000
+MAX_FETCH_BYTES = 64 * 1024 * 1024
+# the part of a result shown to the llm, the whole result is kept in the result store
+MAX_RESULT_ROWS = 200
+MAX_RESULT_BYTES = 32_000
+RESULT_STORE_MAX_AGE = 7 * 24 * 3600  # seconds
+
+# queries above these EXPLAIN estimates are rejected by tools.query_guard
+QUERY_GUARD_MAX_ROWS = 50_000_000  # rows scanned (sqlite, clickhouse)
+QUERY_GUARD_MAX_COST = 10_000_000  # planner cost units (postgres, mysql)
+
+# documents sampled per collection to infer its fields
+MONGO_SCHEMA_SAMPLE_SIZE = 200
+
+# analyze_data tool, bounds the size of its summaries
+ANALYSIS_MAX_COLUMNS = 12
+ANALYSIS_MAX_GROUPS = 20
+
+# results of read queries are cached per datasource + normalized query
+QUERY_CACHE_TTL = 600  # seconds
+QUERY_CACHE_MAX_ENTRIES = 512
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# shared tier in mongodb, for all api and task monitor processes
+QUERY_CACHE_SHARED = os.getenv("QUERY_CACHE_SHARED") == "1"
+QUERY_CACHE_SHARED_MAX_BYTES = 1024 * 1024
+
+# task queue, a task is reclaimed by another worker when its lease expires
+TASK_LEASE_SECONDS = 300
+TASK_MAX_ATTEMPTS = 3
+
+# tasks processed at once by one task monitor, 1 processes them one by one
+TASK_CONCURRENCY = int(os.getenv("TASK_CONCURRENCY", "4"))
+TASK_CONCURRENCY_PER_DATASOURCE = 2
+# shared by all tasks of the process, 0 disables the limit
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+
+# the llm categorizes a task only when the local classifier isn't confident
+CATEGORIZER_CACHE_SIZE = 10_000
+CATEGORIZER_CORPUS_SIZE = 2_000  # llm categorized tasks used as nearest neighbours
+CATEGORIZER_CORPUS_TTL = 300  # seconds
+CATEGORIZER_NEIGHBOUR_CONFIDENCE = 0.8  # cosine similarity
+CATEGORIZER_KEYWORD_CONFIDENCE = 3  # keyword score margin
+
+# parsed datasources are cached, re-read after this many seconds without change streams
+DATASOURCE_CACHE_TTL = 60
+# seconds before a failed change stream of the datasources is reopened
+DATASOURCE_WATCH_RETRY = 5
+
+# introspected schema index of each datasource, stored in `datasource-schemas`
+SCHEMA_REFRESH_INTERVAL = 300  # seconds between catalog change checks
+SCHEMA_SAMPLE_COLUMNS = 8  # text columns sampled per table
+SCHEMA_SAMPLE_VALUES = 5  # distinct values per sampled column
+SCHEMA_SAMPLE_MAX_LENGTH = 40  # longer values are not used as samples
+
+# only the tables most relevant to the question are put into the prompt,
+# the rest is available through the describe_tables tool
+SCHEMA_CONTEXT_TOKEN_BUDGET = 2000  # per datasource
+SCHEMA_CONTEXT_TOP_K = 15  # tables
+SCHEMA_CONTEXT_MAX_COLUMNS = 30  # per table
+DESCRIBE_TABLES_LIMIT = 5
+
+# metrics are served on /metrics by the api, by the task monitor on this port when set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# spans are exported with OpenTelemetry when set (needs opentelemetry-sdk and opentelemetry-exporter-otlp)
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "research-agent")
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from bson import ObjectId
+from pymongo.database import Database
+from pymongo.errors import OperationFailure, PyMongoError
+
+from config import DATASOURCE_CACHE_TTL, DATASOURCE_WATCH_RETRY
+from models.datasource import DataSource, create_datasource
+from models.schema import SchemaIndex
+from tools.connection_pool import connection_pool
+from tools.schema_introspection import SCHEMAS_COLLECTION
+
+# change streams need a replica set
+CHANGE_STREAMS_UNSUPPORTED = 40573
+# the resume token fell out of the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class _Entry:
+    def __init__(self, datasource: DataSource, version: str):
+        self.datasource = datasource
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.prompt: str | None = None
+
+
+def _version(datasource_raw: dict, context: dict | None, schema: dict | None) -> str:
+    raw = json.dumps([datasource_raw, context, schema], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class DatasourceRegistry:
+    """
+    Process-wide cache of parsed datasources with their contexts and schema indexes.
+
+    Missing datasources are loaded with one `$in` query per collection.
+    Entries are dropped by a change stream on the same collections,
+    without change streams they are re-read after DATASOURCE_CACHE_TTL
+    and kept (with their rendered prompt) if the documents didn't change.
+    Returned models are shared, don't modify them.
+    """
+
+    def __init__(self, mongodb: Database, ttl: float = DATASOURCE_CACHE_TTL):
+        self.mongodb = mongodb
+        self.ttl = ttl
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, datasource_ids: List[str]):
+        object_ids = [ObjectId(ds_id) for ds_id in datasource_ids]
+        datasources_raw = self.mongodb.datasources.find({"_id": {"$in": object_ids}})
+        contexts = {
+            str(context["_id"]): context
+            for context in self.mongodb["datasource-contexts"].find(
+                {"_id": {"$in": object_ids}}
+            )
+        }
+        schemas = {
+            str(schema["_id"]): schema
+            for schema in self.mongodb[SCHEMAS_COLLECTION].find({"_id": {"$in": object_ids}})
+        }
+        found = set()
+        for datasource_raw in datasources_raw:
+            ds_id = str(datasource_raw["_id"])
+            found.add(ds_id)
+            context = contexts.get(ds_id)
+            schema = schemas.get(ds_id)
+            version = _version(datasource_raw, context, schema and schema.get("version"))
+            with self._lock:
+                entry = self._entries.get(ds_id)
+                if entry and entry.version == version:
+                    entry.loaded_at = time.monotonic()
+                    continue
+            datasource = create_datasource(datasource_raw)
+            datasource.meta = context if context else {}
+            datasource.schema_index = SchemaIndex(**schema) if schema else None
+            with self._lock:
+                self._entries[ds_id] = _Entry(datasource, version)
+
+        # removed datasources
+        for ds_id in set(datasource_ids) - found:
+            self.invalidate(ds_id)
+
+    def get_many(self, datasource_ids: List[str]) -> List[DataSource]:
+        """Datasources in the requested order, unknown ids are skipped"""
+        now = time.monotonic()
+        with self._lock:
+            stale = [
+                ds_id
+                for ds_id in dict.fromkeys(datasource_ids)
+                if ds_id not in self._entries
+                or now - self._entries[ds_id].loaded_at > self.ttl
+            ]
+        if stale:
+            self._load(stale)
+        with self._lock:
+            return [
+                self._entries[ds_id].datasource
+                for ds_id in datasource_ids
+                if ds_id in self._entries
+            ]
+
+    def get_all(self) -> List[DataSource]:
+        ids = [str(doc["_id"]) for doc in self.mongodb.datasources.find({}, {"_id": 1})]
+        return self.get_many(ids)
+
+    def context_prompt(self, datasource: DataSource) -> str:
+        """datasource.context_prompt(), rendered once per datasource version"""
+        with self._lock:
+            entry = self._entries.get(datasource.id)
+        if entry is None or entry.datasource is not datasource:
+            return datasource.context_prompt()
+        if entry.prompt is None:
+            entry.prompt = datasource.context_prompt()
+        return entry.prompt
+
+    def invalidate(self, datasource_id: str | None = None):
+        """Drops one datasource or, without id, everything"""
+        with self._lock:
+            if datasource_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(datasource_id), None)
+
+    def start_watching(self):
+        """Invalidates changed datasources in background, no-op without change streams"""
+        for collection in ("datasources", "datasource-contexts", SCHEMAS_COLLECTION):
+            threading.Thread(
+                target=self._watch,
+                args=(collection,),
+                name=f"{collection}-watcher",
+                daemon=True,
+            ).start()
+
+    def _apply_change(self, collection: str, change: dict):
+        document_key = change.get("documentKey")
+        if document_key is None:
+            # drop, rename, dropDatabase and invalidate concern the whole collection
+            self.invalidate()
+            if collection == "datasources":
+                connection_pool.close_all()
+            return
+        ds_id = str(document_key["_id"])
+        self.invalidate(ds_id)
+        if collection == "datasources":
+            connection_pool.invalidate(ds_id)
+
+    def _watch(self, collection: str):
+        """
+        Applies the changes of collection until change streams turn out to be unsupported.
+        The stream is reopened after the last seen event when it fails or is invalidated.
+        """
+        resume = {}
+        while True:
+            try:
+                with self.mongodb[collection].watch(**resume) as stream:
+                    for change in stream:
+                        self._apply_change(collection, change)
+                        # only start_after gets past an invalidate event
+                        key = "start_after" if change["operationType"] == "invalidate" else "resume_after"
+                        resume = {key: change["_id"]}
+                continue
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logging.warning(
+                        f"Can't watch {collection} ({e}), "
+                        f"datasources are re-read every {self.ttl}s"
+                    )
+                    return
+                logging.warning(f"Change stream of {collection} failed: {e}")
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    resume = {}
+            except Exception:
+                logging.exception(f"Change stream of {collection} failed")
+            if not resume:
+                # changes since the stream was opened may be missed
+                self.invalidate()
+            time.sleep(DATASOURCE_WATCH_RETRY)
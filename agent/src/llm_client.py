@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from enum import Enum
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from pydantic import BaseModel
+
+from config import LLM_CACHE_DIR, LLM_CACHE_MODE
+from metrics import count_usage, observe
+
+
+class LLMCacheMode(str, Enum):
+    OFF = "off"
+    CACHE = "cache"
+    RECORD = "record"
+    REPLAY = "replay"
+
+
+class LLMCacheMiss(Exception):
+    """No stored response for a request in replay mode"""
+
+
+def _jsonable(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump(exclude_none=True)
+    return str(value)
+
+
+class ResponseStore:
+    """
+    Content-addressed llm responses on local disk.
+
+    The key is a hash of all request parameters (model, messages, tools,
+    response_format, sampling parameters, stream), one json file per response.
+    Streamed responses are stored as their list of chunks and replayed as a stream.
+    """
+
+    def __init__(self, directory: str = LLM_CACHE_DIR):
+        self.directory = directory
+
+    @staticmethod
+    def key(request: Dict) -> str:
+        raw = json.dumps(request, sort_keys=True, default=_jsonable)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def load(self, key: str) -> Dict | None:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, request: Dict, response: Dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {"request": request, **response}
+        # atomic, concurrent writers of the same key write the same content
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, default=_jsonable)
+        os.replace(tmp, path)
+
+    def save_completion(self, key: str, request: Dict, completion: ChatCompletion):
+        self.save(key, request, {"response": completion.model_dump()})
+
+    def save_chunks(self, key: str, request: Dict, chunks: List[ChatCompletionChunk]):
+        self.save(key, request, {"chunks": [chunk.model_dump() for chunk in chunks]})
+
+    @staticmethod
+    def completion(record: Dict) -> ChatCompletion:
+        return ChatCompletion.model_validate(record["response"])
+
+    @staticmethod
+    def chunks(record: Dict) -> List[ChatCompletionChunk]:
+        return [ChatCompletionChunk.model_validate(chunk) for chunk in record["chunks"]]
+
+
+class _Completions:
+    def __init__(self, completions, store: ResponseStore, mode: LLMCacheMode):
+        self._completions = completions
+        self._store = store
+        self._mode = mode
+
+    def _lookup(self, kwargs: Dict) -> tuple[str, Dict | None]:
+        key = self._store.key(kwargs)
+        record = None
+        if self._mode in (LLMCacheMode.CACHE, LLMCacheMode.REPLAY):
+            record = self._store.load(key)
+            if record is None and self._mode == LLMCacheMode.REPLAY:
+                raise LLMCacheMiss(f"No recorded llm response {key} in {self._store.directory}")
+        return key, record
+
+    def create(self, **kwargs):
+        model = str(kwargs.get("model", ""))
+        start = time.perf_counter()
+        try:
+            response, cached = self._create(kwargs)
+        except Exception:
+            observe("llm", time.perf_counter() - start, model, error=True)
+            raise
+        stage = "llm_cache" if cached else "llm"
+        if kwargs.get("stream"):
+            return self._observe_stream(response, stage, model, start)
+        observe(stage, time.perf_counter() - start, model)
+        if not cached:
+            count_usage(model, response.usage)
+        return response
+
+    def _create(self, kwargs: Dict) -> tuple[Any, bool]:
+        """Response and whether it came from the store"""
+        if self._mode == LLMCacheMode.OFF:
+            return self._completions.create(**kwargs), False
+
+        key, record = self._lookup(kwargs)
+        if record is not None:
+            logging.debug(f"llm response {key} from cache")
+            if kwargs.get("stream"):
+                return iter(self._store.chunks(record)), True
+            return self._store.completion(record), True
+
+        response = self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(key, kwargs, response), False
+        self._store.save_completion(key, kwargs, response)
+        return response, False
+
+    @staticmethod
+    def _observe_stream(stream, stage: str, model: str, start: float) -> Iterator[ChatCompletionChunk]:
+        """Observes the time to the first chunk and until the stream is consumed"""
+        usage = None
+        error = True
+        try:
+            for i, chunk in enumerate(stream):
+                if i == 0:
+                    observe(f"{stage}_first_chunk", time.perf_counter() - start, model)
+                if chunk.usage:
+                    usage = chunk.usage
+                yield chunk
+            error = False
+        finally:
+            observe(stage, time.perf_counter() - start, model, error)
+            if stage == "llm":
+                count_usage(model, usage)
+
+    def _record_stream(self, key: str, request: Dict, stream) -> Iterator[ChatCompletionChunk]:
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        # only complete streams are stored
+        self._store.save_chunks(key, request, chunks)
+
+
+class _AsyncCompletions(_Completions):
+    async def create(self, **kwargs):
+        model = str(kwargs.get("model", ""))
+        start = time.perf_counter()
+        try:
+            response, cached = await self._acreate(kwargs)
+        except Exception:
+            observe("llm", time.perf_counter() - start, model, error=True)
+            raise
+        stage = "llm_cache" if cached else "llm"
+        if kwargs.get("stream"):
+            return self._aobserve_stream(response, stage, model, start)
+        observe(stage, time.perf_counter() - start, model)
+        if not cached:
+            count_usage(model, response.usage)
+        return response
+
+    async def _acreate(self, kwargs: Dict) -> tuple[Any, bool]:
+        if self._mode == LLMCacheMode.OFF:
+            return await self._completions.create(**kwargs), False
+
+        # the store reads and writes files, kept off the event loop
+        key, record = await asyncio.to_thread(self._lookup, kwargs)
+        if record is not None:
+            logging.debug(f"llm response {key} from cache")
+            if kwargs.get("stream"):
+                return self._replay_stream(self._store.chunks(record)), True
+            return self._store.completion(record), True
+
+        response = await self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._arecord_stream(key, kwargs, response), False
+        await asyncio.to_thread(self._store.save_completion, key, kwargs, response)
+        return response, False
+
+    @staticmethod
+    async def _aobserve_stream(stream, stage: str, model: str, start: float) -> AsyncIterator[ChatCompletionChunk]:
+        usage = None
+        error = True
+        first = True
+        try:
+            async for chunk in stream:
+                if first:
+                    first = False
+                    observe(f"{stage}_first_chunk", time.perf_counter() - start, model)
+                if chunk.usage:
+                    usage = chunk.usage
+                yield chunk
+            error = False
+        finally:
+            observe(stage, time.perf_counter() - start, model, error)
+            if stage == "llm":
+                count_usage(model, usage)
+
+    @staticmethod
+    async def _replay_stream(chunks: List[ChatCompletionChunk]) -> AsyncIterator[ChatCompletionChunk]:
+        for chunk in chunks:
+            yield chunk
+
+    async def _arecord_stream(self, key: str, request: Dict, stream) -> AsyncIterator[ChatCompletionChunk]:
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(self._store.save_chunks, key, request, chunks)
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class LLMClient:
+    """
+    Wraps an OpenAI / AsyncOpenAI client, chat.completions.create goes through
+    the response store according to the cache mode, everything else is passed through.
+    """
+
+    def __init__(self, client, mode: LLMCacheMode | str = LLM_CACHE_MODE, store: ResponseStore | None = None):
+        self._client = client
+        mode = LLMCacheMode(mode)
+        store = store or ResponseStore()
+        completions_class = _AsyncCompletions if isinstance(client, AsyncOpenAI) else _Completions
+        self.chat = _Chat(completions_class(client.chat.completions, store, mode))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _client_kwargs(kwargs: Dict) -> Dict:
+    if LLMCacheMode(LLM_CACHE_MODE) == LLMCacheMode.REPLAY and not os.getenv("OPENAI_API_KEY"):
+        # replay never calls the api, allow running without a key
+        kwargs.setdefault("api_key", "replay")
+    return kwargs
+
+
+def create_client(**kwargs) -> LLMClient:
+    return LLMClient(OpenAI(**_client_kwargs(kwargs)))
+
+
+def create_async_client(**kwargs) -> LLMClient:
+    return LLMClient(AsyncOpenAI(**_client_kwargs(kwargs)))
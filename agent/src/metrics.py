@@ -0,0 +1,242 @@
+import bisect
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+from config import OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME
+
+# seconds, from a cached sql result to a long tool loop
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: Dict[str, str] | None = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """Sample lines of the exposition format"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: counts per bucket (+Inf last), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "agent_stage_duration_seconds",
+        "Duration of instrumented stages (llm, sql, mongo_write, websocket_send, ...)",
+        ["stage", "target"],
+    )
+)
+STAGE_ERRORS = REGISTRY.register(
+    Counter("agent_stage_errors_total", "Instrumented stages which raised", ["stage", "target"])
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter("agent_llm_tokens_total", "Tokens reported by the llm api", ["model", "kind"])
+)
+QUERY_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("agent_query_cache_lookups_total", "Query result cache lookups", ["result"])
+)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def init_tracing():
+    """
+    Exports spans with OpenTelemetry when OTEL_EXPORTER_OTLP_ENDPOINT is set
+    and the opentelemetry sdk and otlp exporter are installed, no-op otherwise.
+    """
+    global _tracer
+    if not OTEL_EXPORTER_OTLP_ENDPOINT or _tracer is not None:
+        return
+    with _tracer_lock:
+        if _tracer is not None:
+            return
+        try:
+            from opentelemetry import trace
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError as e:
+            logging.warning(f"OpenTelemetry is not installed ({e}), spans are not exported")
+            return
+        provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+        _tracer = trace.get_tracer(__name__)
+        logging.info(f"Exporting spans to {OTEL_EXPORTER_OTLP_ENDPOINT}")
+
+
+def observe(stage: str, seconds: float, target: str = "", error: bool = False):
+    STAGE_SECONDS.observe(seconds, stage=stage, target=target)
+    if error:
+        STAGE_ERRORS.inc(stage=stage, target=target)
+
+
+@contextmanager
+def span(stage: str, target: str = "", **attributes):
+    """Times the block into agent_stage_duration_seconds, and an OpenTelemetry span when enabled"""
+    with ExitStack() as stack:
+        if _tracer is not None:
+            stack.enter_context(
+                _tracer.start_as_current_span(
+                    stage, attributes={"target": target, **{k: str(v) for k, v in attributes.items()}}
+                )
+            )
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            observe(stage, time.perf_counter() - start, target, error)
+
+
+def cached_tokens(usage) -> int:
+    """Prompt tokens served from the provider cache"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def count_usage(model: str, usage):
+    """Token counters from response.usage"""
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens, model=model, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens, model=model, kind="completion")
+    cached = cached_tokens(usage)
+    if cached:
+        LLM_TOKENS.inc(cached, model=model, kind="cached")
+
+
+def start_metrics_server(port: int):
+    """Serves /metrics for processes without the api (task monitor)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on :{port}/metrics")
+    return server
@@ -1,7 +1,10 @@
 from enum import Enum
+from typing import Collection, List, Mapping
 from bson import ObjectId
 from pydantic import BaseModel, Field, ValidationError, field_validator
 
+from models.schema import SchemaIndex
+
 
 class DataSourceType(str, Enum):
     MYSQL = "mysql"
@@ -17,6 +20,8 @@ class BaseDataSource(BaseModel):
     type: DataSourceType
     position: int
     meta: dict | None = {}
+    # introspected by tools.schema_introspection, not part of the datasource document
+    schema_index: SchemaIndex | None = None
 
     @field_validator('id', mode='before')
     @classmethod
@@ -25,15 +30,45 @@ class BaseDataSource(BaseModel):
             return str(v)
         return v
 
-    def context_prompt(self) -> str:
+    def table_names(self) -> List[str]:
+        """Tables known from the schema index and the hand-filled context"""
+        names = [table.name for table in self.schema_index.tables] if self.schema_index else []
+        for table in (self.meta or {}).get("tables") or []:
+            if isinstance(table, dict) and table.get("tableName") not in names:
+                names.append(table.get("tableName"))
+        return names
+
+    def context_prompt(self, tables: Mapping[str, Collection[str] | None] | None = None) -> str:
+        """
+        Whole context of the datasource, or only of the given tables -> columns
+        (None for all columns of a table)
+        """
+        meta = self.meta
+        if tables is not None and meta and isinstance(meta.get("tables"), list):
+            meta = {
+                **meta,
+                "tables": [
+                    table for table in meta["tables"]
+                    if isinstance(table, dict) and table.get("tableName") in tables
+                ],
+            }
         context = (
             f"""<datasource_{self.name}>"""
             f"""<datasourceId>{self.id}</datasourceId>"""
             f"""<datasourceType>{self.type}</datasourceType>"""
         )
-        if self.meta:
-            for key, value in self.meta.items():
+        if meta:
+            for key, value in meta.items():
                 context += f"""<{key}>{value}</{key}>"""
+        if self.schema_index and self.schema_index.tables:
+            context += f"""<schema>{self.schema_index.to_prompt(tables)}</schema>"""
+        if tables is not None:
+            omitted = len(self.table_names()) - len(tables)
+            if omitted > 0:
+                context += (
+                    f"""<omittedTables>{omitted} less relevant tables are not shown, """
+                    f"""call describe_tables to search them</omittedTables>"""
+                )
         context += f"""</datasource_{self.name}>"""
         return context
 
@@ -60,6 +95,8 @@ class PostgresDataSource(NetworkDataSource):
 
 class MongoDBDataSource(NetworkDataSource):
     type: DataSourceType = DataSourceType.MONGODB
+    # database of the user's credentials, the driver defaults to admin
+    auth_source: str | None = Field(default=None, alias="authSource")
 
 
 class ClickhouseDataSource(NetworkDataSource):
@@ -0,0 +1,171 @@
+import csv
+import io
+from typing import Any, Iterable, List, Sequence
+
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel, ConfigDict
+
+from config import MAX_RESULT_BYTES, MAX_RESULT_ROWS
+
+_COLUMNS_KEY = "__columns__"
+_NULLS_SUFFIX = "__nulls"
+
+
+class QueryResult(BaseModel):
+    """
+    Result of a query, column by column.
+
+    data holds one numpy array per column, numeric columns get numeric dtypes,
+    everything else stays an object array. At most the configured fetch budget
+    is held, total_rows is known only when the whole result was read.
+    The llm gets a small csv rendering (to_prompt), the whole result is
+    persisted in a compact binary form (to_npz).
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    columns: List[str]
+    data: List[np.ndarray]
+    total_rows: int | None = None
+    truncated: bool = False
+    # id of the persisted result, see tools.result_store
+    result_id: str | None = None
+
+    @classmethod
+    def from_rows(
+        cls,
+        columns: Sequence[str],
+        rows: List[Sequence[Any]],
+        total_rows: int | None = None,
+        truncated: bool = False,
+    ) -> "QueryResult":
+        """Converts rows (tuples) into columns, dtypes are inferred by pandas"""
+        if rows:
+            frame = pd.DataFrame.from_records(rows, columns=range(len(columns)))
+            data = [frame[i].to_numpy() for i in range(len(columns))]
+        else:
+            data = [np.array([], dtype=object) for _ in columns]
+        return cls(columns=list(columns), data=data, total_rows=total_rows, truncated=truncated)
+
+    @classmethod
+    def from_columns(
+        cls,
+        columns: Sequence[str],
+        data: Sequence[Sequence[Any] | np.ndarray],
+        total_rows: int | None = None,
+        truncated: bool = False,
+    ) -> "QueryResult":
+        """For drivers which return columns (clickhouse columnar mode)"""
+        if not data:
+            # no block was received
+            data = [np.array([], dtype=object) for _ in columns]
+        arrays = [
+            value if isinstance(value, np.ndarray) else pd.Series(value).to_numpy()
+            for value in data
+        ]
+        return cls(columns=list(columns), data=arrays, total_rows=total_rows, truncated=truncated)
+
+    @property
+    def row_count(self) -> int:
+        return len(self.data[0]) if self.data else 0
+
+    @property
+    def rows(self) -> List[tuple]:
+        return list(self.iter_rows())
+
+    def iter_rows(self, limit: int | None = None) -> Iterable[tuple]:
+        return zip(*(column[:limit] for column in self.data))
+
+    def _text_rows(self, limit: int | None = None) -> Iterable[list]:
+        """Rows for text output, nulls as empty strings and readable dates"""
+        columns = []
+        for column in self.data:
+            column = column[:limit]
+            if np.issubdtype(column.dtype, np.datetime64):
+                column = np.where(np.isnat(column), "", np.datetime_as_string(column, unit="s"))
+            columns.append(column)
+        for row in zip(*columns):
+            yield ["" if _is_null(v) else v for v in row]
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the columns"""
+        size = 0
+        for column in self.data:
+            size += column.nbytes
+            if column.dtype == object and len(column):
+                sample = column[:100]
+                size += sum(len(str(v)) for v in sample) * len(column) // len(sample)
+        return size
+
+    def to_frame(self) -> pd.DataFrame:
+        frame = pd.DataFrame(dict(enumerate(self.data)))
+        frame.columns = self.columns
+        return frame
+
+    def to_prompt(self, max_rows: int = MAX_RESULT_ROWS, max_bytes: int = MAX_RESULT_BYTES) -> str:
+        """Csv with a header row for the llm, cut at max_rows / max_bytes"""
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(self.columns)
+        shown = 0
+        end = out.tell()
+        for row in self._text_rows(max_rows):
+            writer.writerow(row)
+            if out.tell() > max_bytes:
+                break
+            shown += 1
+            end = out.tell()
+        text = out.getvalue()[:end]
+        if shown < self.row_count or self.truncated:
+            total = self.total_rows if self.total_rows is not None else f"more than {self.row_count}"
+            text += (
+                f"# Only the first {shown} of {total} rows are shown. "
+                "Use aggregations, filters or LIMIT to get a smaller result.\n"
+            )
+            if self.result_id:
+                text += f"# The whole result is stored with resultId {self.result_id}.\n"
+        return text
+
+    def to_csv(self) -> str:
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(self.columns)
+        writer.writerows(self._text_rows())
+        return out.getvalue()
+
+    def to_npz(self) -> bytes:
+        """
+        Compressed numpy archive without pickled objects:
+        object columns are stored as strings with a null mask.
+        """
+        arrays = {_COLUMNS_KEY: np.array(self.columns, dtype=str)}
+        for i, column in enumerate(self.data):
+            if column.dtype == object:
+                nulls = np.fromiter((_is_null(v) for v in column), dtype=bool, count=len(column))
+                arrays[f"c{i}"] = np.array(["" if n else str(v) for v, n in zip(column, nulls)], dtype=str)
+                arrays[f"c{i}{_NULLS_SUFFIX}"] = nulls
+            else:
+                arrays[f"c{i}"] = column
+        out = io.BytesIO()
+        np.savez_compressed(out, **arrays)
+        return out.getvalue()
+
+    @classmethod
+    def from_npz(cls, raw: bytes, total_rows: int | None = None, truncated: bool = False) -> "QueryResult":
+        with np.load(io.BytesIO(raw), allow_pickle=False) as archive:
+            columns = [str(c) for c in archive[_COLUMNS_KEY]]
+            data = []
+            for i in range(len(columns)):
+                column = archive[f"c{i}"]
+                nulls_key = f"c{i}{_NULLS_SUFFIX}"
+                if nulls_key in archive:
+                    column = column.astype(object)
+                    column[archive[nulls_key]] = None
+                data.append(column)
+        return cls(columns=columns, data=data, total_rows=total_rows, truncated=truncated)
+
+
+def _is_null(value) -> bool:
+    return value is None or (isinstance(value, float) and value != value)
@@ -0,0 +1,85 @@
+from datetime import datetime
+from typing import Collection, List, Mapping
+
+from bson import ObjectId
+from pydantic import BaseModel, Field, field_validator
+
+
+class ColumnSchema(BaseModel):
+    name: str
+    type: str
+    nullable: bool | None = None
+    primary_key: bool = False
+    samples: List[str] = []
+
+
+class ForeignKey(BaseModel):
+    column: str
+    ref_table: str
+    ref_column: str
+
+
+class TableSchema(BaseModel):
+    name: str
+    columns: List[ColumnSchema]
+    foreign_keys: List[ForeignKey] = []
+    row_estimate: int | None = None
+    # names of secondary indexes, where the datasource accepts index hints (mongodb)
+    indexes: List[str] = []
+    # hash of the catalog entry the table was introspected from
+    signature: str
+
+    def to_prompt(self, columns: Collection[str] | None = None) -> str:
+        """
+        One line per table: name(~rows): col TYPE PK, col TYPE [a|b]; fk -> table.col; indexes: a_1
+        With columns, other columns are only counted.
+        """
+        shown = [c for c in self.columns if columns is None or c.name in columns]
+        omitted = len(self.columns) - len(shown)
+        columns = []
+        for column in shown:
+            text = f"{column.name} {column.type}"
+            if column.primary_key:
+                text += " PK"
+            if column.samples:
+                text += f" [{'|'.join(column.samples)}]"
+            columns.append(text)
+        line = self.name
+        if self.row_estimate is not None:
+            line += f"(~{self.row_estimate} rows)"
+        line += ": " + ", ".join(columns)
+        if omitted:
+            line += f" (+{omitted} more columns)"
+        if self.foreign_keys:
+            line += "; " + ", ".join(
+                f"{fk.column} -> {fk.ref_table}.{fk.ref_column}" for fk in self.foreign_keys
+            )
+        if self.indexes:
+            line += "; indexes: " + ", ".join(self.indexes)
+        return line
+
+
+class SchemaIndex(BaseModel):
+    """Introspected structure of a datasource, stored in `datasource-schemas`"""
+
+    id: str = Field(alias="_id")
+    version: int = 0
+    tables: List[TableSchema] = []
+    updated_at: datetime | None = None
+
+    @field_validator("id", mode="before")
+    @classmethod
+    def validate_object_id(cls, v):
+        if isinstance(v, ObjectId):
+            return str(v)
+        return v
+
+    def to_prompt(self, tables: Mapping[str, Collection[str] | None] | None = None) -> str:
+        """Compact schema of all tables or of the given tables -> columns (None for all columns)"""
+        if tables is None:
+            return "\n".join(table.to_prompt() for table in self.tables)
+        return "\n".join(
+            table.to_prompt(tables[table.name])
+            for table in self.tables
+            if table.name in tables
+        )
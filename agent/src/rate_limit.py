@@ -0,0 +1,34 @@
+import threading
+import time
+
+from config import OPENAI_REQUESTS_PER_MINUTE
+
+
+class RateLimiter:
+    """Token bucket, allows `rate` calls per `period` seconds across all threads"""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed, rate <= 0 disables the limit"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed = now - self._updated_at
+                self._tokens = min(self.rate, self._tokens + elapsed * self.rate / self.period)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.period / self.rate
+            time.sleep(wait)
+
+
+openai_rate_limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE)
@@ -1,21 +1,39 @@
 import logging
-import logging
 import os
+import signal
+import threading
 import time
 import traceback
-import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
 
 from pymongo import MongoClient
 
+import cancellation
 from agents.datasource_agents.hypothesis_agent import HypothesisProcessor
 from agents.datasource_agents.question_agent import QuestionProcessor
 from agents.task_categorizer import TaskCategorizer
-from agents.chat_agent import ChatAgent
-from config import TaskStatus, MONITOR_SLEEP_TIME
+from cancellation import Cancelled, CancellationToken
+from chat_processor import ensure_event_indexes, migrate_all_embedded_events
+from datasource_registry import DatasourceRegistry
+from config import (
+    TaskStatus,
+    MONITOR_SLEEP_TIME,
+    METRICS_PORT,
+    QUERY_CACHE_SHARED,
+    TASK_CONCURRENCY,
+    TASK_CONCURRENCY_PER_DATASOURCE,
+)
 from init_test_db import import_test_db
 from logs import init_logger
+from metrics import init_tracing, span, start_metrics_server
+from task_queue import TaskQueue
 from schemes.task_categorizer import TaskCategories
+from tools.query_cache import query_cache
+from tools.result_store import result_store
+from tools.schema_introspection import SchemaIndexer
 
 
 class TaskMonitor:
@@ -25,10 +43,20 @@ class TaskMonitor:
         init_logger()
         self.client = MongoClient(os.getenv("MONGODB_URI"))
         self.db = self.client["research_db"]
-        self.hypothesis_processor = HypothesisProcessor(self.db)
-        self.question_processor = QuestionProcessor(self.db)
-        self.categorizer = TaskCategorizer()
-        self.chat_agent = ChatAgent(self.db)
+        self.registry = DatasourceRegistry(self.db)
+        self.hypothesis_processor = HypothesisProcessor(self.db, self.registry)
+        self.question_processor = QuestionProcessor(self.db, self.registry)
+        self.categorizer = TaskCategorizer(self.db)
+        self.queue = TaskQueue(self.db)
+        self.schema_indexer = SchemaIndexer(self.db)
+        self._stopping = threading.Event()
+        self._datasource_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(TASK_CONCURRENCY_PER_DATASOURCE)
+        )
+        self._datasource_slots_lock = threading.Lock()
+        result_store.attach_mongodb(self.db)
+        if QUERY_CACHE_SHARED:
+            query_cache.attach_mongodb(self.db)
 
     def _update_task_status(self, task_id, status, task_type=None, **kwargs):
         """Update task status and additional fields"""
@@ -37,7 +65,12 @@ class TaskMonitor:
             update_data["task_type"] = task_type.value
         update_data.update(kwargs)
 
-        self.db.tasks.update_one({"_id": task_id}, {"$set": update_data})
+        # a task reclaimed by another worker after our lease expired is not ours to update
+        with span("mongo_write", "update_task"):
+            self.db.tasks.update_one(
+                {"_id": task_id, "worker_id": self.queue.worker_id},
+                {"$set": update_data},
+            )
 
     def _mark_task_failed(self, task_id, exc):
         """Mark task as failed with an error message"""
@@ -49,7 +82,7 @@ class TaskMonitor:
         """Process a new task and update its status"""
         logging.info(f"Processing task: {task['_id']}")
 
-        task_type = self.categorizer.categorize(task["query"])
+        task_type = self.categorizer.categorize(task["query"], task.get("task_type"))
         self._update_task_status(task["_id"], TaskStatus.PROCESSING, task_type)
 
         try:
@@ -62,18 +95,14 @@ class TaskMonitor:
             else:
                 logging.error(f"Unknown task type: {task_type}")
                 raise ValueError(f"Unknown task type: {task_type}")
+        except Cancelled:
+            # the lease was lost, the task is retried by whoever reclaims it
+            raise
         except Exception as e:
             self._mark_task_failed(task["_id"], e)
             result = {"error": str(e)}
             raise e
 
-        try:
-            self._update_task_status(
-                task["_id"],
-                TaskStatus.COMPLETED,
-                **result,
-            )
-            logging.info(f"Task {task['_id']} processed")
         try:
             self._update_task_status(
                 task["_id"],
@@ -85,44 +114,83 @@ class TaskMonitor:
         except Exception as e:
             self._mark_task_failed(task["_id"], e)
 
-    def run(self):
-        """Start monitoring for new tasks"""
-        import_test_db(self.db)
-
-        while True:
-            try:
-                # Check for new tasks
-                new_task = self.db.tasks.find_one({"status": "pending"})
-                if new_task:
-                    self._process_new_task(new_task)
-
-                time.sleep(MONITOR_SLEEP_TIME)
+    def _acquire_datasources(self, task, stack: ExitStack):
+        """Limits tasks running at once against the same datasource"""
+        with self._datasource_slots_lock:
+            # sorted, so two tasks never wait on each other's slots
+            slots = [
+                self._datasource_slots[ds_id]
+                for ds_id in sorted(set(task.get("datasourceIds", [])))
+            ]
+        for slot in slots:
+            stack.enter_context(slot)
+
+    def _run_task(self, task):
+        token = CancellationToken()
+        try:
+            with ExitStack() as stack:
+                # queries of a task reclaimed by another worker are interrupted
+                stack.enter_context(self.queue.lease(task, on_lost=lambda: token.cancel("task lease lost")))
+                stack.enter_context(cancellation.bind(token))
+                self._acquire_datasources(task, stack)
+                self._process_new_task(task)
+        except Cancelled as e:
+            logging.warning(f"Task {task['_id']} abandoned: {e}")
+        except Exception as e:
+            logging.exception(f"Task {task['_id']} error: {e}")
 
-            except Exception as e:
-                logging.exception(f"Monitor error: {e}")
-                time.sleep(MONITOR_SLEEP_TIME)
-            self._mark_task_failed(task["_id"], e)
+    def stop(self, *_):
+        """Stop taking new tasks, in-flight tasks are finished"""
+        logging.info("Stopping task monitor, waiting for in-flight tasks")
+        self._stopping.set()
+        self.schema_indexer.stop()
+        self.queue.wake()
 
     def run(self):
         """Start monitoring for new tasks"""
+        init_tracing()
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
         import_test_db(self.db)
-
-        while True:
+        ensure_event_indexes(self.db)
+        migrate_all_embedded_events(self.db)
+        self.queue.ensure_indexes()
+        self.categorizer.ensure_indexes()
+        self.queue.start_watching()
+        self.registry.start_watching()
+        self.schema_indexer.start(self.registry.get_all)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logging.info(
+            f"Task monitor {self.queue.worker_id} started, "
+            f"processing up to {TASK_CONCURRENCY} tasks at once"
+        )
+
+        in_flight = threading.BoundedSemaphore(TASK_CONCURRENCY)
+        executor = ThreadPoolExecutor(max_workers=TASK_CONCURRENCY, thread_name_prefix="task")
+
+        while not self._stopping.is_set():
+            if not in_flight.acquire(timeout=MONITOR_SLEEP_TIME):
+                continue
             try:
-                # Check for new tasks
-                new_task = self.db.tasks.find_one({"status": "pending"})
+                new_task = self.queue.claim()
                 if new_task:
-                    self._process_new_task(new_task)
+                    future = executor.submit(self._run_task, new_task)
+                    future.add_done_callback(lambda _: in_flight.release())
+                    continue
 
-                time.sleep(MONITOR_SLEEP_TIME)
+                in_flight.release()
+                self.queue.fail_exhausted()
+                self.queue.wait()
 
             except Exception as e:
+                in_flight.release()
                 logging.exception(f"Monitor error: {e}")
                 time.sleep(MONITOR_SLEEP_TIME)
 
+        executor.shutdown(wait=True)
+        logging.info("Task monitor stopped")
 
 if __name__ == "__main__":
     monitor = TaskMonitor()
     monitor.run()
-    monitor = TaskMonitor()
-    monitor.run()
@@ -0,0 +1,167 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable
+
+from pymongo import ReturnDocument
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from config import TaskStatus, MONITOR_SLEEP_TIME, TASK_LEASE_SECONDS, TASK_MAX_ATTEMPTS
+
+
+class TaskQueue:
+    """
+    Work queue over the `tasks` collection, safe for any number of workers.
+
+    A task is claimed atomically (pending -> processing) together with a lease,
+    the lease is renewed while the task is processed. Tasks of crashed workers
+    are claimed again when their lease expires.
+    Workers are woken up by a change stream, polling is the fallback
+    for deployments without change streams (standalone mongodb).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        worker_id: str | None = None,
+        lease_seconds: float = TASK_LEASE_SECONDS,
+        poll_interval: float = MONITOR_SLEEP_TIME,
+    ):
+        self.tasks = db.tasks
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+
+    def ensure_indexes(self):
+        self.tasks.create_index([("status", 1), ("lease_expires_at", 1)])
+
+    def _lease_expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def claim(self) -> dict | None:
+        """Takes the oldest pending task or a task with an expired lease"""
+        now = datetime.utcnow()
+        return self.tasks.find_one_and_update(
+            {
+                "$or": [
+                    {"status": TaskStatus.PENDING.value},
+                    {
+                        "status": TaskStatus.PROCESSING.value,
+                        "lease_expires_at": {"$lt": now},
+                        "attempts": {"$lt": TASK_MAX_ATTEMPTS},
+                    },
+                ]
+            },
+            {
+                "$set": {
+                    "status": TaskStatus.PROCESSING.value,
+                    "worker_id": self.worker_id,
+                    "lease_expires_at": self._lease_expiry(),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def renew(self, task_id) -> bool:
+        """Extends the lease, False if the task isn't ours anymore"""
+        result = self.tasks.update_one(
+            {
+                "_id": task_id,
+                "worker_id": self.worker_id,
+                "status": TaskStatus.PROCESSING.value,
+            },
+            {"$set": {"lease_expires_at": self._lease_expiry()}},
+        )
+        # a renewal in the same millisecond as the claim writes the same value, modified_count is 0 then
+        return result.matched_count == 1
+
+    def fail_exhausted(self):
+        """Fails tasks whose lease expired too many times, they likely crash the worker"""
+        self.tasks.update_many(
+            {
+                "status": TaskStatus.PROCESSING.value,
+                "lease_expires_at": {"$lt": datetime.utcnow()},
+                "attempts": {"$gte": TASK_MAX_ATTEMPTS},
+            },
+            {
+                "$set": {
+                    "status": TaskStatus.FAILED.value,
+                    "error": "Task lease expired too many times",
+                    "updated_at": datetime.utcnow(),
+                }
+            },
+        )
+
+    @contextmanager
+    def lease(self, task: dict, on_lost: Callable | None = None):
+        """
+        Renews the lease of the task in background while the block runs.
+        Yields an event which is set once the lease is lost, on_lost is called then.
+        """
+        done = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    if not self.renew(task["_id"]):
+                        logging.warning(f"Lease of task {task['_id']} lost")
+                        lost.set()
+                        if on_lost:
+                            on_lost()
+                        return
+                except PyMongoError as e:
+                    logging.warning(f"Failed to renew lease of task {task['_id']}: {e}")
+
+        thread = threading.Thread(target=heartbeat, name=f"lease-{task['_id']}", daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            done.set()
+            thread.join()
+
+    def start_watching(self):
+        """Wakes up the worker on new pending tasks, no-op without change streams"""
+        thread = threading.Thread(target=self._watch, name="task-watcher", daemon=True)
+        thread.start()
+
+    def _watch(self):
+        pipeline = [
+            {
+                "$match": {
+                    "$or": [
+                        {"operationType": {"$in": ["insert", "replace"]}},
+                        {"updateDescription.updatedFields.status": TaskStatus.PENDING.value},
+                    ]
+                }
+            }
+        ]
+        try:
+            with self.tasks.watch(pipeline) as stream:
+                logging.info("Watching tasks with a change stream")
+                for _ in stream:
+                    self._wakeup.set()
+        except PyMongoError as e:
+            logging.warning(
+                f"Change streams are not available ({e}), "
+                f"polling tasks every {self.poll_interval}s"
+            )
+
+    def wake(self):
+        """Interrupts wait"""
+        self._wakeup.set()
+
+    def wait(self):
+        """Blocks until a task may be available or the poll interval passed"""
+        self._wakeup.wait(self.poll_interval)
+        self._wakeup.clear()
@@ -0,0 +1,238 @@
+import json
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from config import ANALYSIS_MAX_COLUMNS, ANALYSIS_MAX_GROUPS
+from models.query_result import QueryResult
+from tools.result_store import result_store
+from tools.sql_query import execute_sql_query
+
+
+def _round(value, digits: int = 4):
+    """Json friendly value with a few significant digits"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return float(f"{value:.{digits}g}")
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return str(value)
+
+
+def _columns(frame: pd.DataFrame, names: List[str] | None) -> List[str]:
+    if not names:
+        return list(frame.columns)[:ANALYSIS_MAX_COLUMNS]
+    missing = [name for name in names if name not in frame.columns]
+    if missing:
+        raise ValueError(f"Unknown columns {missing}, the result has {list(frame.columns)}")
+    return names[:ANALYSIS_MAX_COLUMNS]
+
+
+def _numeric(frame: pd.DataFrame, names: List[str]) -> pd.DataFrame:
+    """Columns converted to numbers, columns without any number are dropped"""
+    numeric = frame[names].apply(pd.to_numeric, errors="coerce")
+    return numeric.loc[:, numeric.notna().any()]
+
+
+def _require(value, name: str, analysis: str):
+    if not value:
+        raise ValueError(f"{analysis} needs {name}")
+    return value
+
+
+def describe(frame: pd.DataFrame, columns: List[str] | None = None, **_) -> Dict:
+    stats_by_column = {}
+    for name in _columns(frame, columns):
+        column = frame[name]
+        numeric = pd.to_numeric(column, errors="coerce")
+        if numeric.notna().sum() and numeric.notna().sum() >= column.notna().sum():
+            q = numeric.quantile([0.25, 0.5, 0.75])
+            stats_by_column[name] = {
+                "count": int(numeric.count()),
+                "nulls": int(numeric.isna().sum()),
+                "mean": _round(numeric.mean()),
+                "std": _round(numeric.std()),
+                "min": _round(numeric.min()),
+                "p25": _round(q[0.25]),
+                "p50": _round(q[0.5]),
+                "p75": _round(q[0.75]),
+                "max": _round(numeric.max()),
+            }
+        else:
+            counts = column.value_counts()
+            stats_by_column[name] = {
+                "count": int(column.count()),
+                "nulls": int(column.isna().sum()),
+                "unique": int(counts.size),
+                "top": _round(counts.index[0]) if counts.size else None,
+                "freq": int(counts.iloc[0]) if counts.size else 0,
+            }
+    return stats_by_column
+
+
+def correlation(frame: pd.DataFrame, columns: List[str] | None = None, **_) -> Dict:
+    numeric = _numeric(frame, _columns(frame, columns))
+    if numeric.shape[1] < 2:
+        raise ValueError("correlation needs at least two numeric columns")
+    matrix = numeric.corr(method="pearson")
+    names = list(matrix.columns)
+    # upper triangle only, strongest first
+    pairs = [
+        (a, b, matrix.loc[a, b])
+        for i, a in enumerate(names)
+        for b in names[i + 1:]
+        if not np.isnan(matrix.loc[a, b])
+    ]
+    pairs.sort(key=lambda pair: -abs(pair[2]))
+    return {"pearson": [{"a": a, "b": b, "r": _round(r, 3)} for a, b, r in pairs]}
+
+
+def groupby(frame: pd.DataFrame, group_by: str | None = None, columns: List[str] | None = None, **_) -> Dict:
+    _require(group_by, "groupBy", "groupby")
+    _columns(frame, [group_by])
+    values = [name for name in _columns(frame, columns) if name != group_by]
+    numeric = _numeric(frame, values)
+    numeric[group_by] = frame[group_by].astype(str)
+    grouped = numeric.groupby(group_by)
+    sizes = grouped.size().sort_values(ascending=False)
+    means = grouped.mean()
+    groups = [
+        {
+            "group": group,
+            "count": int(count),
+            **{f"mean_{name}": _round(means.loc[group, name]) for name in means.columns},
+        }
+        for group, count in sizes.head(ANALYSIS_MAX_GROUPS).items()
+    ]
+    return {"groups": int(sizes.size), "largest": groups}
+
+
+def ttest(frame: pd.DataFrame, group_by: str | None = None, target: str | None = None, **_) -> Dict:
+    """Welch's t-test of target between the two largest groups"""
+    _require(group_by, "groupBy", "ttest")
+    _require(target, "target", "ttest")
+    _columns(frame, [group_by, target])
+    values = pd.to_numeric(frame[target], errors="coerce")
+    groups = frame[group_by].astype(str)
+    largest = groups[values.notna()].value_counts().index[:2]
+    if len(largest) < 2:
+        raise ValueError(f"ttest needs two groups in {group_by} with numeric {target}")
+    a = values[(groups == largest[0]) & values.notna()]
+    b = values[(groups == largest[1]) & values.notna()]
+    result = stats.ttest_ind(a, b, equal_var=False)
+    return {
+        "groups": {str(largest[0]): {"n": int(a.size), "mean": _round(a.mean())},
+                   str(largest[1]): {"n": int(b.size), "mean": _round(b.mean())}},
+        "other_groups": int(groups.nunique() - 2),
+        "t": _round(result.statistic),
+        "p": _round(result.pvalue, 3),
+    }
+
+
+def chi2(frame: pd.DataFrame, group_by: str | None = None, target: str | None = None, **_) -> Dict:
+    """Independence of two categorical columns"""
+    _require(group_by, "groupBy", "chi2")
+    _require(target, "target", "chi2")
+    _columns(frame, [group_by, target])
+    table = pd.crosstab(frame[group_by].astype(str), frame[target].astype(str))
+    if min(table.shape) < 2:
+        raise ValueError(f"chi2 needs at least two values in both {group_by} and {target}")
+    result = stats.chi2_contingency(table)
+    n = table.to_numpy().sum()
+    cramers_v = np.sqrt(result.statistic / (n * (min(table.shape) - 1)))
+    return {
+        "shape": list(table.shape),
+        "n": int(n),
+        "chi2": _round(result.statistic),
+        "dof": int(result.dof),
+        "p": _round(result.pvalue, 3),
+        "cramers_v": _round(cramers_v, 3),
+    }
+
+
+def regression(frame: pd.DataFrame, target: str | None = None, columns: List[str] | None = None, **_) -> Dict:
+    """Ordinary least squares of target on the numeric columns, with an intercept"""
+    _require(target, "target", "regression")
+    _columns(frame, [target])
+    predictors = [name for name in _columns(frame, columns) if name != target]
+    data = _numeric(frame, predictors + [target])
+    if target not in data.columns:
+        raise ValueError(f"regression needs a numeric target, {target} is not")
+    data = data.dropna()
+    predictors = [name for name in predictors if name in data.columns]
+    if not predictors:
+        raise ValueError("regression needs at least one numeric predictor column")
+    n, k = len(data), len(predictors) + 1
+    if n <= k:
+        raise ValueError(f"regression needs more than {k} complete rows, got {n}")
+
+    x = np.column_stack([np.ones(n), data[predictors].to_numpy(dtype=float)])
+    y = data[target].to_numpy(dtype=float)
+    coefficients, _, rank, _ = np.linalg.lstsq(x, y, rcond=None)
+    residuals = y - x @ coefficients
+    dof = n - rank
+    sigma2 = residuals @ residuals / dof
+    errors = np.sqrt(np.diag(sigma2 * np.linalg.pinv(x.T @ x)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_values = coefficients / errors
+    p_values = 2 * stats.t.sf(np.abs(t_values), dof)
+    total = ((y - y.mean()) ** 2).sum()
+    return {
+        "n": n,
+        "r2": _round(1 - (residuals @ residuals) / total if total else float("nan"), 3),
+        "coefficients": {
+            name: {"coef": _round(c), "se": _round(se), "p": _round(p, 3)}
+            for name, c, se, p in zip(["intercept"] + predictors, coefficients, errors, p_values)
+        },
+    }
+
+
+ANALYSIS_FUNCTIONS = {
+    "describe": describe,
+    "correlation": correlation,
+    "groupby": groupby,
+    "ttest": ttest,
+    "chi2": chi2,
+    "regression": regression,
+}
+
+
+def analyze_data(
+    analysis: str,
+    query: str | None = None,
+    resultId: str | None = None,
+    columns: List[str] | None = None,
+    groupBy: str | None = None,
+    target: str | None = None,
+    **kwargs,
+) -> str:
+    """
+    Runs a statistical analysis over a query result (the sql query or a stored result)
+    and returns only the summary as compact json.
+    """
+    if analysis not in ANALYSIS_FUNCTIONS:
+        raise ValueError(f"Unknown analysis {analysis}, use one of {list(ANALYSIS_FUNCTIONS)}")
+    if resultId:
+        result = result_store.load(resultId)
+        if result is None:
+            raise ValueError(f"Unknown resultId {resultId}")
+    elif query:
+        result = execute_sql_query(query, **kwargs)
+    else:
+        raise ValueError("Provide a query or a resultId")
+
+    summary = ANALYSIS_FUNCTIONS[analysis](
+        result.to_frame(), columns=columns or None, group_by=groupBy, target=target
+    )
+    return json.dumps({"rows": _rows(result), analysis: summary}, separators=(",", ":"))
+
+
+def _rows(result: QueryResult):
+    if result.truncated:
+        return f"first {result.row_count} rows, the result was cut at the fetch limit"
+    return result.row_count
@@ -0,0 +1,348 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import mysql.connector
+import psycopg2
+from clickhouse_driver import Client
+from pymongo import MongoClient
+
+from config import (
+    CLICKHOUSE_COMPRESSION,
+    POOL_CHECKOUT_TIMEOUT,
+    POOL_IDLE_TIMEOUT,
+    POOL_MAX_SIZE,
+    QUERY_TIMEOUT_SECONDS,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_IMMUTABLE,
+    SQLITE_MMAP_SIZE,
+)
+from models.datasource import DataSource, DataSourceType
+
+
+def _connect_sqlite(datasource):
+    """
+    Read only connection, an immutable file is read without locks or change checks
+    (a changed file gets a new pool, see datasource_fingerprint).
+    """
+    mode = "ro&immutable=1" if SQLITE_IMMUTABLE else "ro"
+    uri = f"{Path(datasource.path).resolve().as_uri()}?mode={mode}"
+    # connections are handed between threads by the pool, never used concurrently
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    return conn
+
+
+def _connect_postgres(datasource):
+    return psycopg2.connect(
+        host=datasource.host,
+        user=datasource.username,
+        password=datasource.password,
+        database=datasource.database,
+        options=f"-c statement_timeout={QUERY_TIMEOUT_SECONDS * 1000}",
+    )
+
+
+def _connect_mysql(datasource):
+    conn = mysql.connector.connect(
+        host=datasource.host,
+        user=datasource.username,
+        password=datasource.password,
+        database=datasource.database,
+    )
+    cursor = conn.cursor()
+    try:
+        # applies to SELECT statements only
+        cursor.execute(f"SET SESSION max_execution_time = {QUERY_TIMEOUT_SECONDS * 1000}")
+    finally:
+        cursor.close()
+    return conn
+
+
+def kill_mysql_query(datasource, connection_id: int):
+    """Stops the statement running on another connection, it can't be interrupted from its own"""
+    conn = mysql.connector.connect(
+        host=datasource.host,
+        user=datasource.username,
+        password=datasource.password,
+        database=datasource.database,
+    )
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"KILL QUERY {int(connection_id)}")
+        cursor.close()
+    finally:
+        conn.close()
+
+
+# queries whose rows are used as python values (catalog, EXPLAIN) read columns
+# without numpy, see _connect_clickhouse
+CLICKHOUSE_ROW_SETTINGS = {"use_numpy": False}
+
+
+def _connect_clickhouse(datasource):
+    """
+    Columns are read into numpy arrays, the client setting also makes columnar
+    results come back as arrays instead of tuples (see execute_clickhouse)
+    """
+    return Client(
+        host=datasource.host,
+        user=datasource.username,
+        password=datasource.password,
+        database=datasource.database,
+        compression=CLICKHOUSE_COMPRESSION or False,
+        settings={"use_numpy": True},
+    )
+
+
+def _connect_mongodb(datasource):
+    options = {"authSource": datasource.auth_source} if datasource.auth_source else {}
+    # host may be a whole connection string (mongodb+srv://...)
+    if datasource.host.startswith("mongodb"):
+        return MongoClient(datasource.host, maxPoolSize=1, **options)
+    return MongoClient(
+        host=datasource.host,
+        port=int(datasource.port) if datasource.port else None,
+        username=datasource.username or None,
+        password=datasource.password or None,
+        maxPoolSize=1,
+        **options,
+    )
+
+
+def _ping_cursor(conn) -> bool:
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        return True
+    finally:
+        cursor.close()
+
+
+def _ping_postgres(conn) -> bool:
+    if conn.closed:
+        return False
+    alive = _ping_cursor(conn)
+    conn.rollback()
+    return alive
+
+
+def _ping_mysql(conn) -> bool:
+    conn.ping(reconnect=False)
+    return True
+
+
+def _ping_clickhouse(client) -> bool:
+    client.execute("SELECT 1")
+    return True
+
+
+def _ping_mongodb(client) -> bool:
+    client.admin.command("ping")
+    return True
+
+
+def _close_clickhouse(client):
+    client.disconnect()
+
+
+def _close(conn):
+    conn.close()
+
+
+# type -> (connect, ping, close)
+CONNECTORS: Dict[DataSourceType, tuple[Callable, Callable, Callable]] = {
+    DataSourceType.SQLITE: (_connect_sqlite, _ping_cursor, _close),
+    DataSourceType.POSTGRES: (_connect_postgres, _ping_postgres, _close),
+    DataSourceType.MYSQL: (_connect_mysql, _ping_mysql, _close),
+    DataSourceType.CLICKHOUSE: (_connect_clickhouse, _ping_clickhouse, _close_clickhouse),
+    DataSourceType.MONGODB: (_connect_mongodb, _ping_mongodb, _close),
+}
+
+
+def datasource_fingerprint(datasource: DataSource) -> str:
+    """
+    Hash of the fields that define how to connect to the datasource,
+    for sqlite files also of the file version (immutable connections don't see changes)
+    """
+    data = datasource.model_dump(exclude={"meta", "name", "position", "schema_index"})
+    if datasource.type == DataSourceType.SQLITE:
+        data["file_version"] = _file_version(datasource.path)
+    raw = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _file_version(path: str) -> str | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class _IdleConnection:
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.released_at = time.monotonic()
+
+
+class DatasourcePool:
+    """
+    Bounded pool of connections for a single datasource.
+    Idle connections are reused LIFO, so the warmest connection is handed out first.
+    """
+
+    def __init__(self, datasource: DataSource, max_size: int, idle_timeout: float):
+        self.datasource = datasource
+        self.fingerprint = datasource_fingerprint(datasource)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._connect, self._ping, self._close = CONNECTORS[datasource.type]
+        self._idle: List[_IdleConnection] = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _discard(self, conn: Any):
+        try:
+            self._close(conn)
+        except Exception as e:
+            logging.warning(f"Error closing connection to {self.datasource.id}: {e}")
+
+    def _evict_idle(self) -> List[Any]:
+        """Drop connections idle for longer than idle_timeout. Must hold the lock."""
+        now = time.monotonic()
+        expired = [c for c in self._idle if now - c.released_at > self.idle_timeout]
+        if expired:
+            self._idle = [c for c in self._idle if c not in expired]
+            self._size -= len(expired)
+        return [c.conn for c in expired]
+
+    def _is_healthy(self, conn: Any) -> bool:
+        try:
+            return self._ping(conn)
+        except Exception:
+            return False
+
+    def acquire(self, timeout: float = POOL_CHECKOUT_TIMEOUT) -> Any:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                expired = self._evict_idle()
+                candidate = None
+                if self._idle:
+                    candidate = self._idle.pop().conn
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        raise TimeoutError(
+                            f"No free connection for datasource {self.datasource.id}"
+                        )
+                    continue
+
+            for conn in expired:
+                self._discard(conn)
+
+            if candidate is None:
+                try:
+                    return self._connect(self.datasource)
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(candidate):
+                return candidate
+
+            logging.info(f"Dropping dead connection to datasource {self.datasource.id}")
+            self._discard(candidate)
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, conn: Any, broken: bool = False):
+        with self._cond:
+            if not broken and not self._closed:
+                self._idle.append(_IdleConnection(conn))
+                self._cond.notify()
+                return
+        self._discard(conn)
+        self._release_slot()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for c in idle:
+            self._discard(c.conn)
+
+
+class ConnectionPoolManager:
+    """Keeps one DatasourcePool per datasource id"""
+
+    def __init__(self, max_size: int = POOL_MAX_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._pools: Dict[str, DatasourcePool] = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, datasource: DataSource) -> DatasourcePool:
+        fingerprint = datasource_fingerprint(datasource)
+        stale = None
+        with self._lock:
+            pool = self._pools.get(datasource.id)
+            if pool is None or pool.fingerprint != fingerprint:
+                # datasource document changed (host, credentials, path...)
+                stale = pool
+                pool = DatasourcePool(datasource, self.max_size, self.idle_timeout)
+                self._pools[datasource.id] = pool
+        if stale:
+            logging.info(f"Datasource {datasource.id} changed, recreating its pool")
+            stale.close()
+        return pool
+
+    @contextmanager
+    def connection(self, datasource: DataSource):
+        """
+        Check out a healthy connection for the datasource.
+        The connection is dropped instead of returned to the pool if the block raises.
+        """
+        pool = self._get_pool(datasource)
+        conn = pool.acquire()
+        try:
+            yield conn
+        except BaseException:
+            pool.release(conn, broken=True)
+            raise
+        else:
+            pool.release(conn)
+
+    def invalidate(self, datasource_id: str):
+        """Close all pooled connections of the datasource"""
+        with self._lock:
+            pool = self._pools.pop(str(datasource_id), None)
+        if pool:
+            pool.close()
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+connection_pool = ConnectionPoolManager()
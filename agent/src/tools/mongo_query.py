@@ -0,0 +1,158 @@
+import datetime
+import time
+from typing import Callable, Dict, List
+
+from bson import ObjectId, json_util
+from bson.decimal128 import Decimal128
+from pymongo.errors import ExecutionTimeout, PyMongoError
+
+import cancellation
+from config import FETCH_BATCH_SIZE, MAX_FETCH_BYTES, MAX_FETCH_ROWS, QUERY_TIMEOUT_SECONDS
+from metrics import QUERY_CACHE_LOOKUPS, observe
+from models.datasource import DataSourceType, MongoDBDataSource
+from models.query_result import QueryResult
+from tools.connection_pool import connection_pool
+from tools.query_cache import query_cache
+from tools.sql_query import QueryTimeout, RowBudget
+
+# stages which write, the agent only reads
+WRITE_STAGES = ("$out", "$merge")
+# nested documents are flattened into dotted columns up to this depth
+FLATTEN_DEPTH = 2
+
+
+def parse_pipeline(pipeline: str | List[Dict]) -> List[Dict]:
+    """Pipeline from (extended) json, write stages are rejected"""
+    if isinstance(pipeline, str):
+        try:
+            pipeline = json_util.loads(pipeline)
+        except ValueError as e:
+            raise ValueError(f"pipeline is not valid json: {e}")
+    if isinstance(pipeline, dict):
+        pipeline = [pipeline]
+    if not isinstance(pipeline, list) or not all(isinstance(stage, dict) and len(stage) == 1 for stage in pipeline):
+        raise ValueError('pipeline must be a json array of stages like [{"$match": {...}}, {"$group": {...}}]')
+    for stage in pipeline:
+        if next(iter(stage)) in WRITE_STAGES:
+            raise ValueError(f"{next(iter(stage))} is not allowed, the datasource is read only")
+    return pipeline
+
+
+def _value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, (dict, list)):
+        return json_util.dumps(value, json_options=json_util.RELAXED_JSON_OPTIONS)
+    if isinstance(value, (str, int, float, bool, datetime.datetime)) or value is None:
+        return value
+    return str(value)
+
+
+def flatten(document: Dict, convert: Callable = _value, prefix: str = "", depth: int = 0) -> Dict:
+    """
+    {"a": {"b": 1}} -> {"a.b": 1}, values are converted for a QueryResult
+    (deeper documents and arrays become json strings)
+    """
+    flat = {}
+    for key, value in document.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and value and depth < FLATTEN_DEPTH:
+            flat.update(flatten(value, convert, f"{name}.", depth + 1))
+        else:
+            flat[name] = convert(value)
+    return flat
+
+
+def execute_mongodb(
+    datasource: MongoDBDataSource,
+    collection: str,
+    pipeline: List[Dict],
+    hint: str | None = None,
+    max_rows=MAX_FETCH_ROWS,
+    max_bytes=MAX_FETCH_BYTES,
+) -> QueryResult:
+    """
+    Runs the aggregation on the server, documents are read in batches
+    until the fetch budget is exhausted. A $limit stage is appended so the server
+    never produces more documents than the budget.
+    """
+    options = {"batchSize": FETCH_BATCH_SIZE, "maxTimeMS": QUERY_TIMEOUT_SECONDS * 1000}
+    if hint:
+        options["hint"] = hint
+    with connection_pool.connection(datasource) as client:
+        cursor = client[datasource.database][collection].aggregate(
+            pipeline + [{"$limit": max_rows + 1}], **options
+        )
+        try:
+            budget = RowBudget(max_rows, max_bytes)
+            while True:
+                # closing the cursor kills it on the server
+                cancellation.check()
+                batch = [flatten(document) for document in _next_batch(cursor)]
+                if not budget.add_batch(batch) or len(batch) < FETCH_BATCH_SIZE:
+                    break
+        finally:
+            cursor.close()
+    # fields in the order of their first appearance, missing fields are null
+    columns: Dict[str, None] = {}
+    for document in budget.rows:
+        columns.update(dict.fromkeys(document))
+    names = list(columns)
+    rows = [tuple(document.get(name) for name in names) for document in budget.rows]
+    return QueryResult.from_rows(
+        names, rows, total_rows=None if budget.truncated else len(rows), truncated=budget.truncated
+    )
+
+
+def _next_batch(cursor) -> List[Dict]:
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= FETCH_BATCH_SIZE:
+            break
+    return batch
+
+
+def aggregate_mongodb(collection: str, pipeline: str, hint: str | None = None, **kwargs) -> QueryResult:
+    """
+    Runs an aggregation pipeline on a collection of a MongoDB datasource.
+
+    Args:
+    collection (str): The collection to aggregate.
+    pipeline (str): Json array of pipeline stages.
+    hint (str, optional): Name of the index to use.
+
+    Returns:
+    QueryResult: one column per (flattened) field, the documents that fit into the fetch budget.
+    """
+    datasource_id = kwargs.get("datasourceId")
+    datasource = next((ds for ds in kwargs.get("datasources") or [] if ds.id == datasource_id), None)
+    if datasource is None:
+        raise ValueError(f"Unknown datasourceId {datasource_id}")
+    if datasource.type != DataSourceType.MONGODB:
+        raise ValueError(f"{datasource.type.value} datasources are queried with execute_sql_query")
+    stages = parse_pipeline(pipeline)
+
+    key = query_cache.key(
+        datasource, json_util.dumps(stages), None, collection=collection, hint=hint
+    )
+    cached = query_cache.get(key)
+    QUERY_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    error = True
+    try:
+        result = execute_mongodb(datasource, collection, stages, hint)
+        error = False
+    except ExecutionTimeout:
+        raise QueryTimeout()
+    except PyMongoError as e:
+        raise ValueError(f"MongoDB error: {e}")
+    finally:
+        observe("mongo_query", time.perf_counter() - start, datasource.type.value, error=error)
+    query_cache.set(key, datasource.id, result)
+    return result
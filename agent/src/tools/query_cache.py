@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from bson import Binary
+from pymongo.database import Database
+
+from config import (
+    QUERY_CACHE_MAX_BYTES,
+    QUERY_CACHE_MAX_ENTRIES,
+    QUERY_CACHE_SHARED_MAX_BYTES,
+    QUERY_CACHE_TTL,
+)
+from models.datasource import DataSource
+from models.query_result import QueryResult
+from tools.connection_pool import datasource_fingerprint
+
+# string literals and quoted identifiers are kept as is while normalizing
+QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)""")
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace outside of quotes and drops the trailing semicolon"""
+    parts = QUOTED_RE.split(query.strip().rstrip(";").strip())
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)
+    )
+
+
+class _Entry:
+    def __init__(self, datasource_id: str, result: QueryResult, size: int, ttl: float):
+        self.datasource_id = datasource_id
+        self.result = result
+        self.size = size
+        self.expires_at = time.monotonic() + ttl
+
+
+class QueryCache:
+    """
+    Cache of query results keyed by datasource + normalized query + params.
+    In-process LRU tier bounded by entries and bytes,
+    optional tier shared between processes in the mongodb `query-cache` collection.
+    """
+
+    def __init__(
+        self,
+        ttl: float = QUERY_CACHE_TTL,
+        max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+        max_bytes: int = QUERY_CACHE_MAX_BYTES,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._collection = None
+
+    def attach_mongodb(self, mongodb: Database):
+        """Enables the shared tier, entries expire by the ttl index"""
+        self._collection = mongodb["query-cache"]
+        self._collection.create_index("expires_at", expireAfterSeconds=0)
+        self._collection.create_index("datasource_id")
+
+    @staticmethod
+    def key(datasource: DataSource, query: str, params=None, **options) -> str:
+        raw = json.dumps(
+            [
+                datasource.id,
+                datasource_fingerprint(datasource),
+                normalize_query(query),
+                params,
+                options,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> QueryResult | None:
+        """
+        A copy of the cached result: callers set result_id on it, which belongs
+        to their conversation. The column arrays are shared, never modified.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry.result.model_copy()
+            if entry:
+                self._pop(key)
+
+        if self._collection is None:
+            return None
+        try:
+            doc = self._collection.find_one(
+                {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+            )
+        except Exception as e:
+            logging.warning(f"Query cache lookup failed: {e}")
+            return None
+        if not doc:
+            return None
+        result = QueryResult.from_npz(
+            doc["result"], total_rows=doc.get("total_rows"), truncated=doc.get("truncated", False)
+        )
+        self._put(key, doc["datasource_id"], result, result.nbytes)
+        return result.model_copy()
+
+    def set(self, key: str, datasource_id: str, result: QueryResult):
+        self._put(key, datasource_id, result.model_copy(), result.nbytes)
+
+        if self._collection is None or result.nbytes > QUERY_CACHE_SHARED_MAX_BYTES:
+            return
+        try:
+            self._collection.replace_one(
+                {"_id": key},
+                {
+                    "datasource_id": datasource_id,
+                    "result": Binary(result.to_npz()),
+                    "total_rows": result.total_rows,
+                    "truncated": result.truncated,
+                    "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl),
+                },
+                upsert=True,
+            )
+        except Exception as e:
+            logging.warning(f"Query cache write failed: {e}")
+
+    def _put(self, key: str, datasource_id: str, result: QueryResult, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = _Entry(datasource_id, result, size, self.ttl)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str):
+        """Must hold the lock"""
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def invalidate(self, datasource_id: str):
+        """Drops all cached results of the datasource"""
+        datasource_id = str(datasource_id)
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.datasource_id == datasource_id]:
+                self._pop(key)
+        if self._collection is not None:
+            self._collection.delete_many({"datasource_id": datasource_id})
+
+
+query_cache = QueryCache()
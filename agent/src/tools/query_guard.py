@@ -0,0 +1,333 @@
+import json
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, List
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.tokens import TokenType
+
+from config import MAX_FETCH_ROWS, QUERY_GUARD_MAX_COST, QUERY_GUARD_MAX_ROWS
+from models.datasource import DataSource, DataSourceType
+from tools.connection_pool import CLICKHOUSE_ROW_SETTINGS, connection_pool
+
+DIALECTS = {
+    DataSourceType.SQLITE: "sqlite",
+    DataSourceType.POSTGRES: "postgres",
+    DataSourceType.MYSQL: "mysql",
+    DataSourceType.CLICKHOUSE: "clickhouse",
+}
+
+READ_STATEMENTS = (exp.Query, exp.Describe, exp.Show)
+READ_COMMANDS = ("SHOW", "DESCRIBE", "DESC", "EXISTS")
+WRITE_NODES = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Create, exp.Drop, exp.Command, exp.Into)
+# functions with side effects or which hold a connection
+DENIED_FUNCTIONS = {
+    "pg_sleep", "pg_terminate_backend", "pg_cancel_backend", "pg_read_file", "lo_import",
+    "lo_export", "dblink", "dblink_exec", "sleep", "benchmark", "load_file",
+}
+# used when sqlglot can't parse the dialect specific sql
+WRITE_KEYWORDS_RE = re.compile(
+    r"\b(insert|update|delete|merge|replace|upsert|create|drop|alter|truncate|grant|revoke|"
+    r"attach|detach|copy|vacuum|pragma|call|exec|execute|set|lock|optimize|system|kill)\b",
+    re.IGNORECASE,
+)
+READ_RE = re.compile(r"^\s*(\(|select\b|with\b|values\b|table\b|show\b|describe\b|desc\b)", re.IGNORECASE)
+QUOTED_RE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`""")
+SQLITE_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\S+)")
+
+# rows above the fetch budget are never read, one more row tells that the result was cut
+LIMIT = MAX_FETCH_ROWS + 1
+# clauses which follow LIMIT, it is put before them
+TAIL_CLAUSES = ("OFFSET", "SETTINGS", "FORMAT")
+
+
+class QueryRejected(Exception):
+    """The query is not executed, the message tells the llm how to fix it"""
+
+
+class GuardedQuery:
+    def __init__(self, sql: str, expression: exp.Expression | None):
+        self.sql = sql
+        # None when sqlglot couldn't parse the query
+        self.expression = expression
+
+    def table_aliases(self) -> Dict[str, str]:
+        """alias (or name) -> table name"""
+        if self.expression is None:
+            return {}
+        return {table.alias_or_name: table.name for table in self.expression.find_all(exp.Table)}
+
+
+def prepare(datasource: DataSource, query: str) -> GuardedQuery:
+    """
+    Rejects everything but a single read statement and limits it to the fetch budget.
+    sqlglot only validates and locates the clauses, the statement is sent as written,
+    with the outer LIMIT added or lowered when it is missing or above the budget.
+    """
+    dialect = DIALECTS.get(datasource.type)
+    if dialect is None:
+        return GuardedQuery(query, None)
+    try:
+        # a comment after the last semicolon comes back as a Semicolon
+        statements = [
+            s for s in sqlglot.parse(query, read=dialect) if s is not None and not isinstance(s, exp.Semicolon)
+        ]
+    except SqlglotError as e:
+        logging.info(f"Query guard can't parse the query ({e}), checking keywords only")
+        return GuardedQuery(_check_keywords(query), None)
+
+    if len(statements) != 1:
+        raise QueryRejected("Send exactly one SQL statement per call.")
+    expression = statements[0]
+    if isinstance(expression, exp.Command) and expression.name.upper() in READ_COMMANDS:
+        # SHOW ... in dialects sqlglot has no grammar for
+        return GuardedQuery(query, expression)
+    if not isinstance(expression, READ_STATEMENTS):
+        raise QueryRejected(
+            f"Only read queries (SELECT) are allowed, got {expression.key.upper()}. The datasource is read only."
+        )
+    write = expression.find(*WRITE_NODES)
+    if write is not None:
+        raise QueryRejected(
+            f"The query contains {write.key.upper()}, only read queries are allowed. The datasource is read only."
+        )
+    if expression.find(exp.Lock):
+        raise QueryRejected("Locking reads (FOR UPDATE/FOR SHARE) are not allowed, remove the locking clause.")
+    for function in expression.find_all(exp.Anonymous):
+        if function.name.lower() in DENIED_FUNCTIONS:
+            raise QueryRejected(f"The function {function.name} is not allowed.")
+
+    if not isinstance(expression, exp.Query) or _has_small_limit(expression):
+        return GuardedQuery(query, expression)
+    return GuardedQuery(_limited(query, expression, dialect), expression)
+
+
+def _row_limit(expression: exp.Query) -> exp.Limit | None:
+    """The outer LIMIT, clickhouse LIMIT n BY columns limits rows per group and doesn't count"""
+    limit = expression.args.get("limit")
+    if isinstance(limit, exp.Limit) and limit.expressions:
+        return None
+    return limit
+
+
+def _has_small_limit(expression: exp.Query) -> bool:
+    limit = _row_limit(expression)
+    if limit is None:
+        return False
+    value = limit.expression
+    # parameters, expressions and FETCH FIRST are left as they are
+    return not (isinstance(value, exp.Literal) and value.is_int) or int(value.name) <= LIMIT
+
+
+def _limited(query: str, expression: exp.Query, dialect: str) -> str:
+    """
+    The statement with the outer LIMIT set to the fetch budget. The text is edited
+    at the positions of the tokens: rendering the tree back to sql would transpile
+    dialect functions (toStartOfMonth -> dateTrunc...).
+    """
+    tokens = [token for token in sqlglot.Dialect.get_or_raise(dialect).tokenize(query)
+              if token.token_type != TokenType.SEMICOLON]
+    # without the trailing semicolon and comments, a LIMIT appended after them would be lost
+    start, end = tokens[0].start, tokens[-1].end + 1
+    statement = query[start:end]
+    outer = _outer_tokens(tokens)
+
+    limit = _row_limit(expression)
+    if limit is not None:
+        count = _limit_count(outer, int(limit.expression.name))
+        if count is not None:
+            return f"{query[start:count.start]}{LIMIT}{query[count.end + 1:end]}"
+    elif isinstance(expression, exp.Select) or (
+        # a LIMIT after UNION applies to the last select in clickhouse
+        dialect != "clickhouse" and isinstance(expression, (exp.Union, exp.Subquery))
+    ):
+        clause = next((token for token in outer if token.token_type.name in TAIL_CLAUSES), None)
+        if clause is None:
+            return f"{statement}\nLIMIT {LIMIT}"
+        return f"{query[start:clause.start]}LIMIT {LIMIT} {query[clause.start:end]}"
+
+    if _can_wrap(expression):
+        return f"SELECT * FROM (\n{statement}\n) AS guarded LIMIT {LIMIT}"
+    # the executors still read no more rows than the fetch budget
+    return statement
+
+
+def _outer_tokens(tokens: list) -> list:
+    """Tokens outside of parentheses"""
+    outer = []
+    depth = 0
+    for token in tokens:
+        if token.token_type == TokenType.L_PAREN:
+            depth += 1
+        elif token.token_type == TokenType.R_PAREN:
+            depth -= 1
+        elif depth == 0:
+            outer.append(token)
+    return outer
+
+
+def _limit_count(outer: list, value: int):
+    """Token of the row count of the last outer LIMIT: LIMIT n, LIMIT offset, n"""
+    count = None
+    for i, token in enumerate(outer):
+        following = outer[i + 1:i + 4]
+        if token.token_type != TokenType.LIMIT or not following or following[0].token_type != TokenType.NUMBER:
+            continue
+        if len(following) > 1 and following[1].text.upper() == "BY":
+            continue
+        if len(following) == 3 and following[1].token_type == TokenType.COMMA:
+            count = following[2]
+        else:
+            count = following[0]
+    if count is None or count.token_type != TokenType.NUMBER or int(count.text) != value:
+        return None
+    return count
+
+
+def _can_wrap(expression: exp.Query) -> bool:
+    """
+    Wrapping as a derived table fails with duplicate column names (mysql) and
+    doesn't keep the order of an inner ORDER BY on every engine
+    """
+    selects = expression.selects
+    names = expression.named_selects
+    return (
+        not expression.args.get("order")
+        and not any(select.is_star for select in selects)
+        and len(names) == len(selects) == len(set(names))
+    )
+
+
+def _check_keywords(query: str) -> str:
+    unquoted = QUOTED_RE.sub("''", query).strip().rstrip(";")
+    if ";" in unquoted:
+        raise QueryRejected("Send exactly one SQL statement per call.")
+    match = WRITE_KEYWORDS_RE.search(unquoted)
+    if not READ_RE.match(unquoted) or match:
+        keyword = match.group(1).upper() if match else unquoted.split(None, 1)[0].upper()
+        raise QueryRejected(
+            f"Only read queries (SELECT) are allowed, the query contains {keyword}. The datasource is read only."
+        )
+    return query
+
+
+def check_cost(datasource: DataSource, guarded: GuardedQuery, params=None):
+    """
+    Estimates the query with EXPLAIN and rejects it above the configured
+    rows / cost thresholds. An EXPLAIN which fails doesn't block the query.
+    """
+    explain = EXPLAINERS.get(datasource.type)
+    if explain is None or (guarded.expression is not None and not isinstance(guarded.expression, exp.Query)):
+        return
+    try:
+        problem = explain(datasource, guarded, params)
+    except Exception as e:
+        logging.warning(f"EXPLAIN of a query on {datasource.id} failed: {e}")
+        return
+    if problem:
+        raise QueryRejected(
+            f"The query is too expensive to run: {problem}. "
+            "Filter with WHERE on indexed or key columns, join on keys instead of producing a cross join, "
+            "aggregate with GROUP BY in the query, or query a smaller time range."
+        )
+
+
+def _fetch(datasource: DataSource, query: str, params=None) -> List[tuple]:
+    with connection_pool.connection(datasource) as conn:
+        cursor = conn.cursor()
+        try:
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            if datasource.type != DataSourceType.SQLITE:
+                conn.rollback()
+
+
+def _row_estimates(datasource: DataSource) -> Dict[str, int]:
+    if not datasource.schema_index:
+        return {}
+    return {
+        table.name: table.row_estimate
+        for table in datasource.schema_index.tables
+        if table.row_estimate is not None
+    }
+
+
+def _explain_sqlite(datasource, guarded: GuardedQuery, params=None) -> str | None:
+    """
+    Full scans of the same loop are nested, their rows multiply, loops of different
+    parents (subqueries, compound selects) add up. Every SCAN reads all rows, also
+    USING (COVERING) INDEX, which only reads them in the order of the index;
+    SEARCH is an index lookup. Rows of a table come from the schema index.
+    """
+    plan = _fetch(datasource, f"EXPLAIN QUERY PLAN {guarded.sql}", params)
+    estimates = _row_estimates(datasource)
+    aliases = guarded.table_aliases()
+    loops: Dict[int, List[tuple[str, int]]] = defaultdict(list)
+    for _, parent, _, detail in plan:
+        match = SQLITE_SCAN_RE.match(detail)
+        if match:
+            table = aliases.get(match.group(1), match.group(1))
+            loops[parent].append((table, estimates.get(table, 1)))
+    total = 0
+    for scans in loops.values():
+        rows = 1
+        for _, table_rows in scans:
+            rows *= table_rows
+        total += rows
+    if total > QUERY_GUARD_MAX_ROWS:
+        tables = ", ".join(table for scans in loops.values() for table, _ in scans)
+        return f"about {total:,} rows would be scanned in full scans of {tables} (limit {QUERY_GUARD_MAX_ROWS:,})"
+    return None
+
+
+def _explain_postgres(datasource, guarded: GuardedQuery, params=None) -> str | None:
+    rows = _fetch(datasource, f"EXPLAIN (FORMAT JSON) {guarded.sql}", params)
+    plan = rows[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]["Plan"]
+    if top["Total Cost"] > QUERY_GUARD_MAX_COST:
+        return (
+            f"planner cost {top['Total Cost']:,.0f} (limit {QUERY_GUARD_MAX_COST:,}), "
+            f"top node {top['Node Type']} over about {top.get('Plan Rows', 0):,} rows"
+        )
+    return None
+
+
+def _explain_mysql(datasource, guarded: GuardedQuery, params=None) -> str | None:
+    rows = _fetch(datasource, f"EXPLAIN FORMAT=JSON {guarded.sql}", params)
+    raw = rows[0][0]
+    plan = json.loads(raw.decode() if isinstance(raw, (bytes, bytearray)) else raw)
+    cost = float(plan.get("query_block", {}).get("cost_info", {}).get("query_cost", 0))
+    if cost > QUERY_GUARD_MAX_COST:
+        return f"optimizer cost {cost:,.0f} (limit {QUERY_GUARD_MAX_COST:,})"
+    return None
+
+
+def _explain_clickhouse(datasource, guarded: GuardedQuery, params=None) -> str | None:
+    with connection_pool.connection(datasource) as client:
+        # database, table, parts, rows, marks
+        estimate = client.execute(
+            f"EXPLAIN ESTIMATE {guarded.sql}", params or {}, settings=CLICKHOUSE_ROW_SETTINGS
+        )
+    total = sum(row[3] for row in estimate)
+    if total > QUERY_GUARD_MAX_ROWS:
+        tables = ", ".join(f"{row[1]} ({row[3]:,})" for row in estimate)
+        return f"about {total:,} rows would be read from {tables} (limit {QUERY_GUARD_MAX_ROWS:,})"
+    return None
+
+
+EXPLAINERS = {
+    DataSourceType.SQLITE: _explain_sqlite,
+    DataSourceType.POSTGRES: _explain_postgres,
+    DataSourceType.MYSQL: _explain_mysql,
+    DataSourceType.CLICKHOUSE: _explain_clickhouse,
+}
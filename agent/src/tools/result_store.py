@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs import GridFSBucket, NoFile
+from pymongo.database import Database
+
+from config import MAX_RESULT_BYTES, MAX_RESULT_ROWS, RESULT_STORE_MAX_AGE
+from models.query_result import QueryResult
+
+BUCKET_NAME = "query_results"
+# expired results are removed at most this often
+PURGE_INTERVAL = 3600
+
+
+class ResultStore:
+    """
+    Whole query results in a GridFS bucket as compressed npz (QueryResult.to_npz),
+    the llm sees only the first rows, the ui downloads the rest by result id.
+    Disabled until attach_mongodb is called.
+    """
+
+    def __init__(self, max_age: float = RESULT_STORE_MAX_AGE):
+        self.max_age = max_age
+        self._bucket: GridFSBucket | None = None
+        self._db: Database | None = None
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+
+    def attach_mongodb(self, mongodb: Database):
+        self._db = mongodb
+        self._bucket = GridFSBucket(mongodb, bucket_name=BUCKET_NAME)
+        mongodb[f"{BUCKET_NAME}.files"].create_index("uploadDate")
+
+    @staticmethod
+    def needs_store(result: QueryResult) -> bool:
+        """Results which don't fit into the prompt"""
+        return (
+            result.truncated
+            or result.row_count > MAX_RESULT_ROWS
+            or result.nbytes > MAX_RESULT_BYTES
+        )
+
+    def save(self, result: QueryResult) -> str | None:
+        """Stores the result, returns its id, None when the store is disabled or the write failed"""
+        if self._bucket is None:
+            return None
+        try:
+            result_id = self._bucket.upload_from_stream(
+                "result.npz",
+                result.to_npz(),
+                metadata={
+                    "columns": result.columns,
+                    "rows": result.row_count,
+                    "total_rows": result.total_rows,
+                    "truncated": result.truncated,
+                },
+            )
+        except Exception as e:
+            logging.warning(f"Storing a query result failed: {e}")
+            return None
+        self._purge_expired()
+        return str(result_id)
+
+    def load(self, result_id: str) -> QueryResult | None:
+        if self._bucket is None:
+            return None
+        try:
+            stream = self._bucket.open_download_stream(ObjectId(result_id))
+        except (InvalidId, NoFile):
+            return None
+        metadata = stream.metadata or {}
+        result = QueryResult.from_npz(
+            stream.read(),
+            total_rows=metadata.get("total_rows"),
+            truncated=metadata.get("truncated", False),
+        )
+        result.result_id = result_id
+        return result
+
+    def _purge_expired(self):
+        with self._lock:
+            if time.monotonic() - self._last_purge < PURGE_INTERVAL:
+                return
+            self._last_purge = time.monotonic()
+        expired = datetime.utcnow() - timedelta(seconds=self.max_age)
+        try:
+            for doc in self._db[f"{BUCKET_NAME}.files"].find({"uploadDate": {"$lt": expired}}, {"_id": 1}):
+                self._bucket.delete(doc["_id"])
+        except Exception as e:
+            logging.warning(f"Purging stored query results failed: {e}")
+
+
+result_store = ResultStore()
@@ -0,0 +1,485 @@
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List
+
+from bson import ObjectId
+from pymongo.database import Database
+
+from config import (
+    MONGO_SCHEMA_SAMPLE_SIZE,
+    SCHEMA_REFRESH_INTERVAL,
+    SCHEMA_SAMPLE_COLUMNS,
+    SCHEMA_SAMPLE_MAX_LENGTH,
+    SCHEMA_SAMPLE_VALUES,
+)
+from models.datasource import DataSource, DataSourceType
+from models.schema import ColumnSchema, ForeignKey, SchemaIndex, TableSchema
+from tools.connection_pool import CLICKHOUSE_ROW_SETTINGS, connection_pool
+from tools.mongo_query import flatten
+
+SCHEMAS_COLLECTION = "datasource-schemas"
+
+TEXT_TYPES = ("char", "text", "string", "enum", "varchar")
+
+
+def _signature(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+def _is_text(column_type: str) -> bool:
+    return any(t in column_type.lower() for t in TEXT_TYPES)
+
+
+def _samples(values) -> List[str]:
+    samples = []
+    for value in values:
+        if value is None:
+            continue
+        value = str(value)
+        if len(value) > SCHEMA_SAMPLE_MAX_LENGTH or value in samples:
+            continue
+        samples.append(value)
+        if len(samples) >= SCHEMA_SAMPLE_VALUES:
+            break
+    return samples
+
+
+class Introspector(ABC):
+    """
+    Reads the catalog of one datasource type.
+
+    table_signatures is cheap and called on every refresh,
+    describe_table only for tables whose signature changed.
+    """
+
+    quote_char = '"'
+
+    def __init__(self, datasource: DataSource):
+        self.datasource = datasource
+
+    def quote(self, name: str) -> str:
+        q = self.quote_char
+        return ".".join(q + part.replace(q, q + q) + q for part in name.split("."))
+
+    def fetch(self, query: str, params=None) -> List[tuple]:
+        with connection_pool.connection(self.datasource) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or ())
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+                if self.datasource.type != DataSourceType.SQLITE:
+                    conn.rollback()
+
+    @abstractmethod
+    def table_signatures(self) -> Dict[str, str]:
+        """Table name -> hash of its catalog entry"""
+
+    @abstractmethod
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        """Columns, keys, row estimate and samples of one table"""
+
+    def sample_values(self, table: str, column: str) -> List[str]:
+        rows = self.fetch(
+            f"SELECT DISTINCT {self.quote(column)} FROM {self.quote(table)} "
+            f"WHERE {self.quote(column)} IS NOT NULL LIMIT {SCHEMA_SAMPLE_VALUES * 2}"
+        )
+        return _samples(row[0] for row in rows)
+
+    def add_samples(self, table: str, columns: List[ColumnSchema]):
+        """Samples of the first text columns, skipped on error (permissions, huge views...)"""
+        text_columns = [c for c in columns if _is_text(c.type) and not c.samples]
+        for column in text_columns[:SCHEMA_SAMPLE_COLUMNS]:
+            try:
+                column.samples = self.sample_values(table, column.name)
+            except Exception as e:
+                logging.warning(f"Can't sample {table}.{column.name}: {e}")
+
+
+class SQLiteIntrospector(Introspector):
+    def table_signatures(self) -> Dict[str, str]:
+        rows = self.fetch(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+        )
+        return {name: _signature(sql) for name, sql in rows}
+
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        columns = [
+            ColumnSchema(
+                name=name,
+                type=column_type or "ANY",
+                nullable=not notnull,
+                primary_key=bool(pk),
+            )
+            for _, name, column_type, notnull, _, pk in self.fetch(
+                f"PRAGMA table_info({self.quote(table)})"
+            )
+        ]
+        foreign_keys = [
+            ForeignKey(column=row[3], ref_table=row[2], ref_column=row[4] or "")
+            for row in self.fetch(f"PRAGMA foreign_key_list({self.quote(table)})")
+        ]
+        try:
+            # rowid is monotonic in practice, good enough as an estimate and O(1)
+            row_estimate = self.fetch(f"SELECT MAX(rowid) FROM {self.quote(table)}")[0][0] or 0
+        except Exception:
+            row_estimate = None
+        self.add_samples(table, columns)
+        return TableSchema(
+            name=table,
+            columns=columns,
+            foreign_keys=foreign_keys,
+            row_estimate=row_estimate,
+            signature=signature,
+        )
+
+
+class PostgresIntrospector(Introspector):
+    SYSTEM_SCHEMAS = ("pg_catalog", "information_schema")
+
+    def table_signatures(self) -> Dict[str, str]:
+        rows = self.fetch(
+            "SELECT table_schema || '.' || table_name, "
+            "string_agg(column_name || ':' || data_type || ':' || is_nullable, ',' "
+            "ORDER BY ordinal_position) "
+            "FROM information_schema.columns "
+            "WHERE table_schema NOT IN %s AND table_schema NOT LIKE 'pg_toast%%' "
+            "GROUP BY 1",
+            (self.SYSTEM_SCHEMAS,),
+        )
+        return {name: _signature(columns) for name, columns in rows}
+
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        schema, name = table.split(".", 1)
+        primary_keys = {
+            row[0]
+            for row in self.fetch(
+                "SELECT kcu.column_name FROM information_schema.table_constraints tc "
+                "JOIN information_schema.key_column_usage kcu "
+                "ON tc.constraint_name = kcu.constraint_name AND tc.table_schema = kcu.table_schema "
+                "WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = %s AND tc.table_name = %s",
+                (schema, name),
+            )
+        }
+        columns = [
+            ColumnSchema(
+                name=column,
+                type=data_type,
+                nullable=is_nullable == "YES",
+                primary_key=column in primary_keys,
+            )
+            for column, data_type, is_nullable in self.fetch(
+                "SELECT column_name, data_type, is_nullable FROM information_schema.columns "
+                "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+                (schema, name),
+            )
+        ]
+        foreign_keys = [
+            ForeignKey(column=column, ref_table=ref_table, ref_column=ref_column)
+            for column, ref_table, ref_column in self.fetch(
+                "SELECT kcu.column_name, ccu.table_schema || '.' || ccu.table_name, ccu.column_name "
+                "FROM information_schema.table_constraints tc "
+                "JOIN information_schema.key_column_usage kcu "
+                "ON tc.constraint_name = kcu.constraint_name AND tc.table_schema = kcu.table_schema "
+                "JOIN information_schema.constraint_column_usage ccu "
+                "ON tc.constraint_name = ccu.constraint_name AND tc.table_schema = ccu.table_schema "
+                "WHERE tc.constraint_type = 'FOREIGN KEY' AND tc.table_schema = %s AND tc.table_name = %s",
+                (schema, name),
+            )
+        ]
+        rows = self.fetch(
+            "SELECT c.reltuples::bigint FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = %s AND c.relname = %s",
+            (schema, name),
+        )
+        # -1 for tables never analyzed
+        row_estimate = rows[0][0] if rows and rows[0][0] >= 0 else None
+
+        # most common values collected by ANALYZE, no table scan
+        by_name = {column.name: column for column in columns}
+        for column, values in self.fetch(
+            "SELECT attname, most_common_vals::text FROM pg_stats "
+            "WHERE schemaname = %s AND tablename = %s AND most_common_vals IS NOT NULL",
+            (schema, name),
+        ):
+            if column in by_name and _is_text(by_name[column].type):
+                by_name[column].samples = _samples(values.strip("{}").split(","))
+        self.add_samples(table, columns)
+        return TableSchema(
+            name=table,
+            columns=columns,
+            foreign_keys=foreign_keys,
+            row_estimate=row_estimate,
+            signature=signature,
+        )
+
+
+class MySQLIntrospector(Introspector):
+    quote_char = "`"
+
+    def table_signatures(self) -> Dict[str, str]:
+        rows = self.fetch(
+            "SELECT table_name, GROUP_CONCAT(CONCAT(column_name, ':', column_type, ':', is_nullable) "
+            "ORDER BY ordinal_position SEPARATOR ',') "
+            "FROM information_schema.columns WHERE table_schema = DATABASE() GROUP BY table_name"
+        )
+        return {name: _signature(columns) for name, columns in rows}
+
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        columns = [
+            ColumnSchema(
+                name=column,
+                type=column_type,
+                nullable=is_nullable == "YES",
+                primary_key=column_key == "PRI",
+            )
+            for column, column_type, is_nullable, column_key in self.fetch(
+                "SELECT column_name, column_type, is_nullable, column_key "
+                "FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = %s ORDER BY ordinal_position",
+                (table,),
+            )
+        ]
+        foreign_keys = [
+            ForeignKey(column=column, ref_table=ref_table, ref_column=ref_column)
+            for column, ref_table, ref_column in self.fetch(
+                "SELECT column_name, referenced_table_name, referenced_column_name "
+                "FROM information_schema.key_column_usage "
+                "WHERE table_schema = DATABASE() AND table_name = %s "
+                "AND referenced_table_name IS NOT NULL",
+                (table,),
+            )
+        ]
+        rows = self.fetch(
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s",
+            (table,),
+        )
+        row_estimate = rows[0][0] if rows else None
+        self.add_samples(table, columns)
+        return TableSchema(
+            name=table,
+            columns=columns,
+            foreign_keys=foreign_keys,
+            row_estimate=row_estimate,
+            signature=signature,
+        )
+
+
+class ClickhouseIntrospector(Introspector):
+    def fetch(self, query: str, params=None) -> List[tuple]:
+        with connection_pool.connection(self.datasource) as client:
+            return client.execute(query, params or {}, settings=CLICKHOUSE_ROW_SETTINGS)
+
+    def table_signatures(self) -> Dict[str, str]:
+        rows = self.fetch(
+            "SELECT table, groupArray(concat(name, ':', type)) FROM "
+            "(SELECT table, name, type FROM system.columns "
+            "WHERE database = currentDatabase() ORDER BY table, position) "
+            "GROUP BY table"
+        )
+        return {name: _signature(columns) for name, columns in rows}
+
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        columns = [
+            ColumnSchema(
+                name=name,
+                type=column_type,
+                nullable=column_type.startswith("Nullable("),
+                primary_key=bool(is_in_primary_key),
+            )
+            for name, column_type, is_in_primary_key in self.fetch(
+                "SELECT name, type, is_in_primary_key FROM system.columns "
+                "WHERE database = currentDatabase() AND table = %(table)s ORDER BY position",
+                {"table": table},
+            )
+        ]
+        rows = self.fetch(
+            "SELECT total_rows FROM system.tables "
+            "WHERE database = currentDatabase() AND name = %(table)s",
+            {"table": table},
+        )
+        row_estimate = rows[0][0] if rows else None
+        self.add_samples(table, columns)
+        return TableSchema(
+            name=table,
+            columns=columns,
+            row_estimate=row_estimate,
+            signature=signature,
+        )
+
+
+class MongoDBIntrospector(Introspector):
+    """
+    Collections have no catalog of fields, they are inferred from a sample of documents.
+    The signature covers the indexes and the fields of the newest documents,
+    so a collection is sampled again when new fields appear.
+    """
+
+    def _database(self, client):
+        return client[self.datasource.database]
+
+    def table_signatures(self) -> Dict[str, str]:
+        signatures = {}
+        with connection_pool.connection(self.datasource) as client:
+            database = self._database(client)
+            for name in database.list_collection_names(filter={"type": "collection"}):
+                if name.startswith("system."):
+                    continue
+                collection = database[name]
+                fields = set()
+                for document in collection.find().sort("_id", -1).limit(SCHEMA_SAMPLE_VALUES * 2):
+                    fields.update(_fields(document))
+                signatures[name] = _signature(sorted(fields), sorted(collection.index_information()))
+        return signatures
+
+    def describe_table(self, table: str, signature: str) -> TableSchema:
+        with connection_pool.connection(self.datasource) as client:
+            collection = self._database(client)[table]
+            documents = list(collection.aggregate([{"$sample": {"size": MONGO_SCHEMA_SAMPLE_SIZE}}]))
+            indexes = [name for name in collection.index_information() if name != "_id_"]
+            row_estimate = collection.estimated_document_count()
+
+        # field -> (types, values), in the order of first appearance
+        fields: Dict[str, tuple[Dict[str, None], list]] = {}
+        for document in documents:
+            for name, value in _fields(document).items():
+                types, values = fields.setdefault(name, ({}, []))
+                types[type(value).__name__ if value is not None else "null"] = None
+                if isinstance(value, str):
+                    values.append(value)
+
+        columns = []
+        sampled = 0
+        for name, (types, values) in fields.items():
+            present = sum(1 for document in documents if _has_field(document, name))
+            samples = []
+            if values and sampled < SCHEMA_SAMPLE_COLUMNS:
+                samples = _samples(values)
+                sampled += 1
+            columns.append(
+                ColumnSchema(
+                    name=name,
+                    type="|".join(t for t in types if t != "null") or "null",
+                    nullable="null" in types or present < len(documents),
+                    primary_key=name == "_id",
+                    samples=samples,
+                )
+            )
+        return TableSchema(
+            name=table,
+            columns=columns,
+            row_estimate=row_estimate,
+            indexes=indexes,
+            signature=signature,
+        )
+
+
+def _fields(document: Dict) -> Dict:
+    """Dotted field -> raw value"""
+    return flatten(document, convert=lambda value: value)
+
+
+def _has_field(document: Dict, name: str) -> bool:
+    for part in name.split("."):
+        if not isinstance(document, dict) or part not in document:
+            return False
+        document = document[part]
+    return True
+
+
+INTROSPECTORS = {
+    DataSourceType.SQLITE: SQLiteIntrospector,
+    DataSourceType.POSTGRES: PostgresIntrospector,
+    DataSourceType.MYSQL: MySQLIntrospector,
+    DataSourceType.CLICKHOUSE: ClickhouseIntrospector,
+    DataSourceType.MONGODB: MongoDBIntrospector,
+}
+
+
+class SchemaIndexer:
+    """
+    Keeps the schema index of each datasource up to date in `datasource-schemas`.
+
+    A refresh reads only the catalog signatures of the tables, tables are
+    introspected again only when their signature changed. The version of
+    the index is bumped on every change, concurrent refreshes of the same
+    datasource don't overwrite each other.
+    """
+
+    def __init__(self, mongodb: Database, interval: float = SCHEMA_REFRESH_INTERVAL):
+        self.collection = mongodb[SCHEMAS_COLLECTION]
+        self.mongodb = mongodb
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def load(self, datasource_id: str) -> SchemaIndex | None:
+        doc = self.collection.find_one({"_id": ObjectId(datasource_id)})
+        return SchemaIndex(**doc) if doc else None
+
+    def refresh(self, datasource: DataSource, force: bool = False) -> SchemaIndex | None:
+        """Returns the current index, None for datasources without an introspector"""
+        introspector_class = INTROSPECTORS.get(datasource.type)
+        if introspector_class is None:
+            return None
+        introspector = introspector_class(datasource)
+
+        current = self.load(datasource.id)
+        known = {} if current is None or force else {t.name: t for t in current.tables}
+        signatures = introspector.table_signatures()
+
+        tables = []
+        changed = set(known) != set(signatures)
+        for name in sorted(signatures):
+            table = known.get(name)
+            if table is None or table.signature != signatures[name]:
+                table = introspector.describe_table(name, signatures[name])
+                changed = True
+            tables.append(table)
+        if current is not None and not changed:
+            return current
+
+        version = current.version if current else 0
+        index = SchemaIndex(
+            _id=datasource.id,
+            version=version + 1,
+            tables=tables,
+            updated_at=datetime.utcnow(),
+        )
+        doc = index.model_dump(by_alias=True)
+        doc["_id"] = ObjectId(datasource.id)
+        if current is None:
+            self.collection.update_one({"_id": doc["_id"]}, {"$setOnInsert": doc}, upsert=True)
+        else:
+            result = self.collection.replace_one({"_id": doc["_id"], "version": version}, doc)
+            if result.matched_count == 0:
+                # refreshed by another worker meanwhile
+                return self.load(datasource.id)
+        logging.info(f"Schema of datasource {datasource.id} is at version {index.version}")
+        return index
+
+    def refresh_all(self, datasources: List[DataSource]):
+        for datasource in datasources:
+            try:
+                self.refresh(datasource)
+            except Exception as e:
+                logging.warning(f"Schema introspection of {datasource.id} failed: {e}")
+
+    def start(self, get_datasources):
+        """Refreshes the datasources returned by get_datasources every interval in background"""
+
+        def loop():
+            while not self._stopping.is_set():
+                self.refresh_all(get_datasources())
+                self._stopping.wait(self.interval)
+
+        threading.Thread(target=loop, name="schema-indexer", daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
@@ -0,0 +1,166 @@
+import json
+import threading
+from typing import Dict, List
+
+from agents.history import estimate_tokens
+from agents.text_similarity import TfidfIndex, tokenize
+from config import (
+    DESCRIBE_TABLES_LIMIT,
+    SCHEMA_CONTEXT_MAX_COLUMNS,
+    SCHEMA_CONTEXT_TOKEN_BUDGET,
+    SCHEMA_CONTEXT_TOP_K,
+)
+from models.datasource import DataSource
+from models.schema import TableSchema
+
+# table name -> columns to show, None for all
+TableSelection = Dict[str, List[str] | None]
+
+
+class _TableDocs:
+    """Search index and prompt cost of the tables of one datasource version"""
+
+    def __init__(self, datasource: DataSource):
+        self.datasource = datasource
+        self.schemas: Dict[str, TableSchema] = (
+            {table.name: table for table in datasource.schema_index.tables}
+            if datasource.schema_index
+            else {}
+        )
+        self.contexts: Dict[str, dict] = {
+            table["tableName"]: table
+            for table in (datasource.meta or {}).get("tables") or []
+            if isinstance(table, dict) and table.get("tableName")
+        }
+        self.names = datasource.table_names()
+        self.index: TfidfIndex[str] = TfidfIndex()
+        for name in self.names:
+            self.index.add(self._text(name), name)
+        self.total_tokens = estimate_tokens(datasource.context_prompt())
+
+    def _text(self, name: str) -> str:
+        parts = [name, name]  # the name weighs more than columns
+        schema = self.schemas.get(name)
+        if schema:
+            for column in schema.columns:
+                parts.append(column.name)
+                parts.extend(column.samples)
+        context = self.contexts.get(name)
+        if context:
+            parts.append(str(context.get("tableDescription") or ""))
+            parts.append(str(context.get("tableOutputUserDescription") or ""))
+        return " ".join(parts)
+
+    def columns(self, name: str, question_tokens: set) -> List[str] | None:
+        """Keys and columns mentioned in the question first, None when the table is narrow"""
+        schema = self.schemas.get(name)
+        if schema is None or len(schema.columns) <= SCHEMA_CONTEXT_MAX_COLUMNS:
+            return None
+        foreign = {fk.column for fk in schema.foreign_keys}
+
+        def rank(column):
+            if column.primary_key or column.name in foreign:
+                return 0
+            if question_tokens & set(tokenize(column.name)):
+                return 1
+            return 2
+
+        ranked = sorted(schema.columns, key=rank)  # stable, keeps table order within a rank
+        return [column.name for column in ranked[:SCHEMA_CONTEXT_MAX_COLUMNS]]
+
+    def cost(self, name: str, columns: List[str] | None) -> int:
+        text = ""
+        if name in self.schemas:
+            text += self.schemas[name].to_prompt(columns)
+        if name in self.contexts:
+            text += json.dumps(self.contexts[name], default=str)
+        return estimate_tokens(text)
+
+    def related(self, name: str) -> List[str]:
+        schema = self.schemas.get(name)
+        return [fk.ref_table for fk in schema.foreign_keys] if schema else []
+
+
+class SchemaRetriever:
+    """
+    Selects the tables of a datasource relevant to a question.
+
+    Tables are ranked by tf-idf similarity of their name, columns, sample values
+    and descriptions to the question, tables referenced by foreign keys of
+    a selected table follow it. Tables are added until SCHEMA_CONTEXT_TOP_K
+    or the token budget is reached, wide tables are cut to their keys and
+    the columns mentioned in the question.
+    """
+
+    def __init__(self):
+        self._docs: Dict[str, _TableDocs] = {}
+        self._lock = threading.Lock()
+
+    def _table_docs(self, datasource: DataSource) -> _TableDocs:
+        # registry replaces the datasource object when it changes
+        with self._lock:
+            docs = self._docs.get(datasource.id)
+        if docs is None or docs.datasource is not datasource:
+            docs = _TableDocs(datasource)
+            with self._lock:
+                self._docs[datasource.id] = docs
+        return docs
+
+    def select(
+        self, datasource: DataSource, question: str, token_budget: int = SCHEMA_CONTEXT_TOKEN_BUDGET
+    ) -> TableSelection | None:
+        """None when the whole context fits the budget"""
+        docs = self._table_docs(datasource)
+        if docs.total_tokens <= token_budget or not docs.names:
+            return None
+
+        question_tokens = set(tokenize(question))
+        ranked = [name for _, name in docs.index.search(question, k=len(docs.names))]
+        if not ranked:
+            ranked = list(docs.names)
+
+        selection: TableSelection = {}
+        used = 0
+        candidates = list(ranked)
+        while candidates and len(selection) < SCHEMA_CONTEXT_TOP_K:
+            name = candidates.pop(0)
+            if name in selection or name not in docs.names:
+                continue
+            columns = docs.columns(name, question_tokens)
+            cost = docs.cost(name, columns)
+            if used + cost > token_budget and selection:
+                continue
+            selection[name] = columns
+            used += cost
+            candidates[0:0] = [t for t in docs.related(name) if t not in selection]
+        return selection
+
+    def context_prompt(self, datasource: DataSource, question: str) -> str | None:
+        """Pruned context, None when the whole context fits the budget"""
+        selection = self.select(datasource, question)
+        if selection is None:
+            return None
+        return datasource.context_prompt(selection)
+
+    def describe(self, datasource: DataSource, query: str) -> str:
+        """Full context of the tables named in the query, otherwise of the best matches"""
+        docs = self._table_docs(datasource)
+        wanted = {token.strip().lower() for token in query.replace(",", " ").split()}
+        names = [name for name in docs.names if name.lower() in wanted]
+        if not names:
+            names = [name for _, name in docs.index.search(query, k=DESCRIBE_TABLES_LIMIT)]
+        if not names:
+            listed = ", ".join(docs.names[:100])
+            return f"No tables match '{query}', tables are: {listed}"
+        return datasource.context_prompt({name: None for name in names})
+
+
+schema_retriever = SchemaRetriever()
+
+
+def describe_tables(query: str, **kwargs) -> str:
+    datasource_id = kwargs.get("datasourceId")
+    datasource = next((ds for ds in kwargs.get("datasources") or [] if ds.id == datasource_id), None)
+    if datasource is None:
+        raise ValueError(f"Unknown datasourceId {datasource_id}")
+    return schema_retriever.describe(datasource, query)
@@ -1,9 +1,23 @@
+import json
+import re
 import sqlite3
-import mysql.connector
-from mysql.connector import Error
-from clickhouse_driver import Client
-import psycopg2
+import time
+import uuid
 
+from clickhouse_driver.errors import ErrorCodes, ServerException
+from mysql.connector import Error, errorcode
+from psycopg2.errors import QueryCanceled
+
+import cancellation
+from config import (
+    CLICKHOUSE_BLOCK_SIZE,
+    FETCH_BATCH_SIZE,
+    MAX_FETCH_BYTES,
+    MAX_FETCH_ROWS,
+    QUERY_TIMEOUT_SECONDS,
+    SQLITE_PROGRESS_STEPS,
+)
+from metrics import QUERY_CACHE_LOOKUPS, observe
 from models.datasource import (
     DataSourceType,
     SQLiteDataSource,
@@ -11,100 +25,227 @@ from models.datasource import (
     ClickhouseDataSource,
     PostgresDataSource,
 )
+from models.query_result import QueryResult
+from tools import query_guard
+from tools.connection_pool import connection_pool, kill_mysql_query
+from tools.query_cache import query_cache
 
-
-def execute_sqllite(datasource: SQLiteDataSource, query, params=None):
-    conn = sqlite3.connect(datasource.path)
-    try:
-        cursor = conn.cursor()
-        if params:
-            cursor.execute(query, params)
-        else:
-            cursor.execute(query)
-        results = cursor.fetchall()
-        return results
-    finally:
-        conn.close()
+SELECT_RE = re.compile(r"^\s*(\(|select\b|with\b|values\b|table\b)", re.IGNORECASE)
 
 
-def execute_postgres(datasource: PostgresDataSource, query, params=None):
-    connection = None
-    cursor = None
-    try:
-        connection = psycopg2.connect(
-            host=datasource.host,
-            user=datasource.username,
-            password=datasource.password,
-            database=datasource.database,
+class QueryTimeout(Exception):
+    def __init__(self):
+        super().__init__(
+            f"The query was stopped after {QUERY_TIMEOUT_SECONDS}s. "
+            "Make it cheaper: filter with WHERE, aggregate in the query or select fewer columns."
         )
-        cursor = connection.cursor()
-        cursor.execute(query, params or ())
-        results = cursor.fetchall()
-        return results
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
 
 
-def execute_clickhouse(datasource: ClickhouseDataSource, query, params=None):
-    try:
-        client = Client(
-            host=datasource.host,
-            user=datasource.username,
-            password=datasource.password,
-            database=datasource.database,
-        )
-        results = client.execute(query, params or {})
-        return results
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
+def _stopped():
+    """A query interrupted by the database: cancelled by us or timed out"""
+    cancellation.check()
+    raise QueryTimeout()
 
 
-def execute_mysql(datasource: MySQLDataSource, query, params=None):
-    connection = None
-    cursor = None
-    try:
-        # Establish the connection
-        connection = mysql.connector.connect(
-            host=datasource.host,
-            user=datasource.username,
-            password=datasource.password,
-            database=datasource.database,
+class RowBudget:
+    """
+    Collects rows until the row or byte budget is exhausted.
+    The size of a batch is estimated from a sample of its rows.
+    """
+
+    SAMPLE_ROWS = 16
+
+    def __init__(self, max_rows: int, max_bytes: int):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = []
+        self.size = 0
+        self.truncated = False
+
+    def add_batch(self, batch) -> bool:
+        """Returns False when the batch doesn't fit, the result is truncated then"""
+        if not batch:
+            return True
+        sample = batch[: self.SAMPLE_ROWS]
+        row_size = max(1, len(json.dumps(sample, default=str)) // len(sample))
+        fits = min(len(batch), self.max_rows - len(self.rows), (self.max_bytes - self.size) // row_size)
+        if fits < len(batch):
+            batch = batch[: max(fits, 0)]
+            self.truncated = True
+        self.rows.extend(batch)
+        self.size += row_size * len(batch)
+        return not self.truncated
+
+    def result(self, columns) -> QueryResult:
+        return QueryResult.from_rows(
+            columns,
+            self.rows,
+            total_rows=None if self.truncated else len(self.rows),
+            truncated=self.truncated,
         )
 
-        if connection.is_connected():
+
+def _fetch_bounded(cursor, max_rows: int, max_bytes: int) -> QueryResult:
+    budget = RowBudget(max_rows, max_bytes)
+    while True:
+        cancellation.check()
+        batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+        # a short batch is the last one
+        if not budget.add_batch(batch) or len(batch) < FETCH_BATCH_SIZE:
+            break
+    columns = [column[0] for column in cursor.description or []]
+    return budget.result(columns)
+
+
+def execute_sqllite(
+    datasource: SQLiteDataSource,
+    query,
+    params=None,
+    max_rows=MAX_FETCH_ROWS,
+    max_bytes=MAX_FETCH_BYTES,
+):
+    token = cancellation.current()
+    deadline = time.monotonic() + QUERY_TIMEOUT_SECONDS
+
+    def interrupt() -> int:
+        # called by sqlite every SQLITE_PROGRESS_STEPS vm instructions, non zero aborts
+        return int(time.monotonic() > deadline or (token is not None and token.cancelled))
+
+    with connection_pool.connection(datasource) as conn:
+        cursor = conn.cursor()
+        conn.set_progress_handler(interrupt, SQLITE_PROGRESS_STEPS)
+        try:
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            return _fetch_bounded(cursor, max_rows, max_bytes)
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                _stopped()
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+            cursor.close()
+
+
+def execute_postgres(
+    datasource: PostgresDataSource,
+    query,
+    params=None,
+    max_rows=MAX_FETCH_ROWS,
+    max_bytes=MAX_FETCH_BYTES,
+):
+    with connection_pool.connection(datasource) as connection:
+        if SELECT_RE.match(query):
+            # server-side cursor, rows are transferred in batches as we read them
+            cursor = connection.cursor(name=f"agent_{uuid.uuid4().hex}")
+            cursor.itersize = FETCH_BATCH_SIZE
+        else:
             cursor = connection.cursor()
-            cursor.execute(query)
-            results = cursor.fetchall()
-            return results
+        try:
+            # statement_timeout is set on connect, see connection_pool
+            with cancellation.on_cancel(connection.cancel):
+                cursor.execute(query, params or ())
+                return _fetch_bounded(cursor, max_rows, max_bytes)
+        except QueryCanceled:
+            _stopped()
+        finally:
+            cursor.close()
+            # don't leave the pooled connection idle in a transaction
+            connection.rollback()
 
-    except Error as e:
-        print(f"Error: {e}")
-        return None
 
-    finally:
-        if connection and connection.is_connected():
-            if cursor:
+def execute_clickhouse(
+    datasource: ClickhouseDataSource,
+    query,
+    params=None,
+    max_rows=MAX_FETCH_ROWS,
+    max_bytes=MAX_FETCH_BYTES,
+):
+    """
+    Blocks are read as numpy columns and concatenated, rows are never built.
+    The server stops sending blocks once the fetch budget is exceeded
+    (result_overflow_mode=break), so the result is cut here to max_rows.
+    """
+    with connection_pool.connection(datasource) as client:
+        progress = client.execute_with_progress(
+            query,
+            params or {},
+            with_column_types=True,
+            columnar=True,
+            settings={
+                "max_block_size": CLICKHOUSE_BLOCK_SIZE,
+                "max_execution_time": QUERY_TIMEOUT_SECONDS,
+                "max_result_rows": max_rows + 1,
+                "max_result_bytes": max_bytes,
+                "result_overflow_mode": "break",
+            },
+        )
+        token = cancellation.current()
+        try:
+            # data blocks are collected while waiting for the progress packets
+            for _ in progress:
+                if token is not None and token.cancelled:
+                    # stops the query on the server, the client reconnects on the next checkout
+                    client.disconnect()
+                    token.check()
+            columns, column_types = progress.get_result()
+        except ServerException as e:
+            if e.code == ErrorCodes.TIMEOUT_EXCEEDED:
+                _stopped()
+            raise
+        result = QueryResult.from_columns(
+            [name for name, _ in column_types], [column[:max_rows] for column in columns]
+        )
+        # the server also breaks on its own count of the bytes, which is close to nbytes
+        truncated = (bool(columns) and len(columns[0]) > max_rows) or result.nbytes >= max_bytes
+        result.truncated = truncated
+        result.total_rows = None if truncated else result.row_count
+        return result
+
+
+def execute_mysql(
+    datasource: MySQLDataSource,
+    query,
+    params=None,
+    max_rows=MAX_FETCH_ROWS,
+    max_bytes=MAX_FETCH_BYTES,
+):
+    with connection_pool.connection(datasource) as connection:
+        cursor = connection.cursor()
+        result = None
+        try:
+            # max_execution_time is set on connect, see connection_pool
+            with cancellation.on_cancel(lambda: kill_mysql_query(datasource, connection.connection_id)):
+                cursor.execute(query, params)
+                result = _fetch_bounded(cursor, max_rows, max_bytes)
+            return result
+        except Error as e:
+            if e.errno in (errorcode.ER_QUERY_TIMEOUT, errorcode.ER_QUERY_INTERRUPTED):
+                _stopped()
+            raise
+        finally:
+            if result is None or result.truncated:
+                # the fetch didn't finish (error, cancel, budget), unread rows block the connection:
+                # close()/rollback() would raise "Unread result found", the pool replaces it on checkout
+                connection.disconnect()
+            else:
                 cursor.close()
-            connection.close()
+                # end the read snapshot so the next checkout sees fresh data
+                connection.rollback()
 
 
 def execute_sql_query(query, params=None, **kwargs):
     """
-    Execute a SQL query on the SQLite database.
+    Execute a SQL query on the datasource.
 
     Args:
     query (str): The SQL query to execute.
     params (tuple, optional): Parameters for the SQL query.
 
     Returns:
-    list: A list of tuples containing the query results.
+    QueryResult: columns and the rows that fit into the fetch budget.
     """
     datasourceId = kwargs.get("datasourceId")
     datasources = kwargs.get("datasources")
@@ -115,6 +256,34 @@ def execute_sql_query(query, params=None, **kwargs):
 
     datasource = next(filter(lambda x: str(x.id) == datasourceId, datasources))
 
+    # read only, limited to the fetch budget, raises QueryRejected
+    guarded = query_guard.prepare(datasource, query)
+    query = guarded.sql
+
+    cacheable = bool(SELECT_RE.match(query))
+    if cacheable:
+        key = query_cache.key(datasource, query, params)
+        cached = query_cache.get(key)
+        QUERY_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            return cached
+
+    query_guard.check_cost(datasource, guarded, params)
+
+    start = time.perf_counter()
+    error = True
+    try:
+        result = _execute(datasource, query, params)
+        error = False
+    finally:
+        # the error itself reaches the llm as the tool result
+        observe("sql", time.perf_counter() - start, datasource.type.value, error=error)
+    if cacheable:
+        query_cache.set(key, datasource.id, result)
+    return result
+
+
+def _execute(datasource, query, params=None):
     if datasource.type == DataSourceType.SQLITE:
         return execute_sqllite(datasource, query, params)
     elif datasource.type == DataSourceType.MYSQL:
@@ -123,5 +292,7 @@ def execute_sql_query(query, params=None, **kwargs):
         return execute_clickhouse(datasource, query, params)
     elif datasource.type == DataSourceType.POSTGRES:
         return execute_postgres(datasource, query, params)
+    elif datasource.type == DataSourceType.MONGODB:
+        raise Exception("MongoDB datasources are queried with the aggregate_mongodb tool, not SQL")
     else:
         raise Exception(f"{datasource.type} datasources are not supported")
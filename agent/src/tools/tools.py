@@ -1,22 +1,44 @@
+import asyncio
 import json
-from typing import Any, Generator
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Generator
 
+import cancellation
+from cancellation import Cancelled
 from chat_processor import Conversation
+from config import TOOL_CALL_WORKERS, MAX_CONCURRENT_QUERIES_PER_DATASOURCE
 from models.datasource import DataSource
+from models.query_result import QueryResult
+from tools.analysis import ANALYSIS_FUNCTIONS, analyze_data
+from tools.result_store import result_store
+from tools.mongo_query import aggregate_mongodb
+from tools.schema_retrieval import describe_tables
 from tools.sql_query import execute_sql_query
 
 
-def tavily_request(question: str, **_) -> str:
+def tavily_request(query: str, **_) -> str:
     from tavily import TavilyClient
 
     tavily_client = TavilyClient()
-    response = tavily_client.search(question)
+    response = tavily_client.search(query)
     return response
 
 
 SQL_QUERY_TOOL = "execute_sql_query"
+DESCRIBE_TABLES_TOOL = "describe_tables"
+ANALYZE_DATA_TOOL = "analyze_data"
+MONGODB_AGGREGATE_TOOL = "aggregate_mongodb"
 ASK_TAVILY_TOOL = "ask_tavily"
-TOOLS_MAPPING = {SQL_QUERY_TOOL: execute_sql_query, ASK_TAVILY_TOOL: tavily_request}
+TOOLS_MAPPING = {
+    SQL_QUERY_TOOL: execute_sql_query,
+    MONGODB_AGGREGATE_TOOL: aggregate_mongodb,
+    DESCRIBE_TABLES_TOOL: describe_tables,
+    ANALYZE_DATA_TOOL: analyze_data,
+    ASK_TAVILY_TOOL: tavily_request,
+}
 
 TOOLS = [
     {
@@ -24,7 +46,7 @@ TOOLS = [
         "tool_choice": "required",
         "function": {
             "name": SQL_QUERY_TOOL,
-            "description": "Executes a SQL query on the database",
+            "description": "Executes a SQL query on the database (all datasources except mongodb)",
             "parameters": {
                 "type": "object",
                 "required": ["query", "datasourceId"],
@@ -43,6 +65,102 @@ TOOLS = [
             "strict": True,
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": MONGODB_AGGREGATE_TOOL,
+            "description": (
+                "Runs an aggregation pipeline on a collection of a mongodb datasource. "
+                "Put $match first and $group/$project early so the server reduces the data, "
+                "nested fields come back as dotted columns."
+            ),
+            "parameters": {
+                "type": "object",
+                "required": ["collection", "pipeline", "hint", "datasourceId"],
+                "properties": {
+                    "collection": {"type": "string", "description": "Collection to aggregate"},
+                    "pipeline": {
+                        "type": "string",
+                        "description": 'Json array of stages, e.g. [{"$match": {"status": "paid"}}, {"$group": {"_id": "$country", "n": {"$sum": 1}}}]',
+                    },
+                    "hint": {
+                        "type": ["string", "null"],
+                        "description": "Name of an index of the collection to use, from its schema, or null",
+                    },
+                    "datasourceId": {
+                        "type": "string",
+                        "description": "datasourceId from the provided tool",
+                    },
+                },
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": DESCRIBE_TABLES_TOOL,
+            "description": "Returns columns, keys and sample values of tables which are not shown in the datasource context",
+            "parameters": {
+                "type": "object",
+                "required": ["query", "datasourceId"],
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Table names or keywords describing the data you are looking for",
+                    },
+                    "datasourceId": {
+                        "type": "string",
+                        "description": "datasourceId from the provided tool",
+                    },
+                },
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": ANALYZE_DATA_TOOL,
+            "description": (
+                "Runs a statistical analysis over all rows of a SQL query (or a stored result) on the server "
+                "and returns only the summary: describe, correlation (pearson), groupby (counts and means), "
+                "ttest (Welch, target between the two largest groups of groupBy), "
+                "chi2 (independence of groupBy and target), regression (OLS of target on columns). "
+                "Prefer it over reading raw rows when testing a hypothesis."
+            ),
+            "parameters": {
+                "type": "object",
+                "required": ["analysis", "query", "datasourceId", "resultId", "columns", "groupBy", "target"],
+                "properties": {
+                    "analysis": {"type": "string", "enum": list(ANALYSIS_FUNCTIONS)},
+                    "query": {
+                        "type": ["string", "null"],
+                        "description": "SQL query selecting the rows to analyze, null when resultId is given",
+                    },
+                    "datasourceId": {
+                        "type": ["string", "null"],
+                        "description": "datasourceId of the query",
+                    },
+                    "resultId": {
+                        "type": ["string", "null"],
+                        "description": "resultId of an earlier result which was cut, instead of the query",
+                    },
+                    "columns": {
+                        "type": ["array", "null"],
+                        "items": {"type": "string"},
+                        "description": "Columns to analyze (predictors for regression), null for all",
+                    },
+                    "groupBy": {"type": ["string", "null"], "description": "Group column for groupby, ttest and chi2"},
+                    "target": {"type": ["string", "null"], "description": "Value column for ttest, chi2 and regression"},
+                },
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    },
 ]
 
 # if os.getenv("TAVILY_API_KEY"):
@@ -69,6 +187,97 @@ TOOLS = [
 #     )
 
 
+# tool calls of one llm response are independent, so they run concurrently
+_executor = ThreadPoolExecutor(max_workers=TOOL_CALL_WORKERS, thread_name_prefix="tool-call")
+_datasource_slots: dict[str, threading.BoundedSemaphore] = defaultdict(
+    lambda: threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES_PER_DATASOURCE)
+)
+_datasource_slots_lock = threading.Lock()
+
+
+def _datasource_slot(datasource_id: str | None) -> threading.BoundedSemaphore:
+    with _datasource_slots_lock:
+        return _datasource_slots[datasource_id]
+
+
+def _run_tool_call(tool_call, function_args: dict, datasources: list[DataSource]) -> tuple[str, bool, str | None]:
+    """
+    Executes one tool call, limited by per-datasource concurrency.
+    Returns the content for the llm, whether the call succeeded
+    and the id of the whole result when the content shows only a part of it.
+    """
+    result_id = None
+    try:
+        tool_func = TOOLS_MAPPING[tool_call.function.name]
+        with _datasource_slot(function_args.get("datasourceId")):
+            # the turn may have been cancelled while waiting for the slot
+            cancellation.check()
+            results = tool_func(**function_args, datasources=datasources)
+        # Convert results to a readable format
+        if isinstance(results, QueryResult):
+            if result_store.needs_store(results):
+                results.result_id = result_store.save(results)
+                result_id = results.result_id
+            results_str = results.to_prompt()
+        elif isinstance(results, str):
+            results_str = results
+        else:
+            results_str = json.dumps(results, indent=2, default=str)
+        logging.debug(
+            f"Tool call {tool_call.function.name}: {function_args.get('query')}\n{results_str}"
+        )
+        return results_str, True, result_id
+    except Cancelled:
+        raise
+    except Exception as e:
+        logging.warning(f"Tool call {tool_call.function.name} failed: {e}")
+        return f"Error executing query: {str(e)}", False, None
+
+
+def _parse_tool_calls(message) -> list[tuple[Any, dict]]:
+    return [
+        (tool_call, json.loads(tool_call.function.arguments))
+        for tool_call in message.tool_calls
+    ]
+
+
+def _tool_call_records(calls: list[tuple[Any, dict]]) -> list[tuple[str, str, dict]]:
+    return [
+        (tool_call.id, tool_call.function.name, function_args)
+        for tool_call, function_args in calls
+    ]
+
+
+def run_tool_calls(calls: list[tuple[Any, dict]], datasources: list[DataSource]) -> list[tuple[str, bool, str | None]]:
+    """Runs the tool calls concurrently, results keep the order of calls"""
+    futures = [
+        _executor.submit(cancellation.in_context(_run_tool_call), tool_call, function_args, datasources)
+        for tool_call, function_args in calls
+    ]
+    return [future.result() for future in futures]
+
+
+async def arun_tool_calls(calls: list[tuple[Any, dict]], datasources: list[DataSource]) -> list[tuple[str, bool, str | None]]:
+    """async version of run_tool_calls"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                _executor, cancellation.in_context(_run_tool_call), tool_call, function_args, datasources
+            )
+            for tool_call, function_args in calls
+        )
+    )
+
+
+def _tool_message(tool_call, content: str) -> dict:
+    return {
+        "tool_call_id": tool_call.id,
+        "content": content,
+        "role": "tool",
+    }
+
+
 def handle_tools(resp, messages: list, datasources: list[DataSource]) -> list:
     """
     adds initial response.message and tool's results in input message parameter
@@ -82,53 +291,21 @@ def handle_tools(resp, messages: list, datasources: list[DataSource]) -> list:
     # we need to give llm his response for context
     messages.append(resp.choices[0].message)
 
-    for tool_call in resp.choices[0].message.tool_calls:
-        function_args = json.loads(tool_call.function.arguments)
+    calls = _parse_tool_calls(resp.choices[0].message)
+    results = run_tool_calls(calls, datasources)
 
-        try:
-            tool_func = TOOLS_MAPPING[tool_call.function.name]
-            results = tool_func(
-                function_args["query"],
-                datasourceId=function_args["datasourceId"],
-                datasources=datasources,
-            )
-            # Convert results to a readable format
-            results_str = json.dumps(results, indent=2, default=str)
-            print("execute query:")
-            print(function_args["query"])
-            print(results_str)
-
-            tool_result = {
-                "tool_call_id": tool_call.id,
-                "content": results_str,
-                "role": "tool",
-            }
-
-            messages.append(tool_result)
-
-            used_tools.append(
-                {
-                    "name": tool_call.function.name,
-                    "query": function_args["query"],
-                    **tool_result,
-                }
-            )
-        except Exception as e:
-            messages.append(
-                {
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": f"Error executing query: {str(e)}",
-                }
-            )
-            used_tools.append(
-                {
-                    "name": tool_call.function.name,
-                    "query": function_args["query"],
-                    "tool_call_id": tool_call.id,
-                    "content": f"Error executing query: {str(e)}",
-                }
-            )
+    for (tool_call, function_args), (content, ok, _) in zip(calls, results):
+        tool_result = _tool_message(tool_call, content)
+        messages.append(tool_result)
+
+        used_tool = {
+            "name": tool_call.function.name,
+            "query": function_args.get("query"),
+            **tool_result,
+        }
+        if not ok:
+            used_tool.pop("role")
+        used_tools.append(used_tool)
 
     return used_tools
 
@@ -136,72 +313,41 @@ def handle_tools(resp, messages: list, datasources: list[DataSource]) -> list:
 def handle_tools2(resp, messages: list, datasources: list[DataSource], conversation: Conversation, mongodb) -> Generator[Any, Any, Any]:
     """
     adds initial response.message and tool's results in input message parameter
-    return value used only for logging
+    yields ToolCallEvent for every call first, then ToolResultEvent in the same order
     """
     if not resp.choices[0].message.tool_calls:
         return []
 
-    used_tools = []
-
     # we need to give llm his response for context
     messages.append(resp.choices[0].message)
-    # event = conversation.add_message(mongodb, resp.choices[0].message)
-    # yield event
 
-    for tool_call in resp.choices[0].message.tool_calls:
-        function_args = json.loads(tool_call.function.arguments)
+    calls = _parse_tool_calls(resp.choices[0].message)
+    yield from conversation.add_tool_calls(mongodb, _tool_call_records(calls))
 
-        try:
-            tool_func = TOOLS_MAPPING[tool_call.function.name]
-            event = conversation.add_tool_call(mongodb, tool_call_id=tool_call.id, tool_name=tool_call.function.name, parameters=function_args)
-            yield event
+    results = run_tool_calls(calls, datasources)
 
-            results = tool_func(
-                function_args["query"],
-                datasourceId=function_args["datasourceId"],
-                datasources=datasources,
-            )
-            # Convert results to a readable format
-            results_str = json.dumps(results, indent=2, default=str)
-            print("execute query:")
-            print(function_args["query"])
-            print(results_str)
+    for (tool_call, _), (content, _, result_id) in zip(calls, results):
+        messages.append(_tool_message(tool_call, content))
+        yield conversation.add_tool_call_result(mongodb, tool_call_id=tool_call.id, tool_name=tool_call.function.name, output=content, result_id=result_id)
 
-            tool_result = {
-                "tool_call_id": tool_call.id,
-                "content": results_str,
-                "role": "tool",
-            }
 
-            messages.append(tool_result)
+async def ahandle_tools(resp, messages: list, datasources: list[DataSource], conversation: Conversation, mongodb) -> AsyncGenerator[Any, Any]:
+    """
+    async version of handle_tools2 for an async mongodb,
+    tools are executed in worker threads to keep the event loop free
+    """
+    if not resp.choices[0].message.tool_calls:
+        return
+
+    # we need to give llm his response for context
+    messages.append(resp.choices[0].message)
 
-            event = conversation.add_tool_call_result(mongodb, tool_call_id=tool_call.id, tool_name=tool_call.function.name, output=results_str)
-            yield event
+    calls = _parse_tool_calls(resp.choices[0].message)
+    for event in await conversation.add_tool_calls(mongodb, _tool_call_records(calls)):
+        yield event
 
+    results = await arun_tool_calls(calls, datasources)
 
-            used_tools.append(
-                {
-                    "name": tool_call.function.name,
-                    "query": function_args["query"],
-                    **tool_result,
-                }
-            )
-        except Exception as e:
-            messages.append(
-                {
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": f"Error executing query: {str(e)}",
-                }
-            )
-            event = conversation.add_tool_call_result(mongodb, tool_call_id=tool_call.id, tool_name=tool_call.function.name, output=f"Error executing query: {str(e)}")
-            yield event
-
-            used_tools.append(
-                {
-                    "name": tool_call.function.name,
-                    "query": function_args["query"],
-                    "tool_call_id": tool_call.id,
-                    "content": f"Error executing query: {str(e)}",
-                }
-            )
+    for (tool_call, _), (content, _, result_id) in zip(calls, results):
+        messages.append(_tool_message(tool_call, content))
+        yield await conversation.add_tool_call_result(mongodb, tool_call_id=tool_call.id, tool_name=tool_call.function.name, output=content, result_id=result_id)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+# modules of the agent import each other from src, like when running src/task_handler.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["research_db"]
+
+
+class _AsyncCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._cursor:
+            yield doc
+
+
+class _AsyncCollection:
+    """The AsyncMongoClient collection methods the agent uses, over a mongomock collection"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return _AsyncCursor(self._collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class AsyncDatabase:
+    def __init__(self, db):
+        self.sync = db
+
+    def __getitem__(self, name):
+        return _AsyncCollection(self.sync[name])
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+@pytest.fixture
+def async_db(db):
+    """Async view of the db fixture, like an AsyncMongoClient database"""
+    return AsyncDatabase(db)
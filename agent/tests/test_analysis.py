@@ -0,0 +1,110 @@
+import json
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from models.datasource import create_datasource
+from tools import analysis
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        "region": ["north", "north", "north", "south", "south", "south", "east"],
+        "amount": [10.0, 12.0, 11.0, 20.0, 22.0, None, 5.0],
+        "units": [1, 2, 1, 4, 4, 5, 1],
+        "status": ["paid", "paid", "open", "open", "open", "open", "paid"],
+    })
+
+
+def test_describe(frame):
+    stats = analysis.describe(frame)
+
+    assert stats["amount"] == {
+        "count": 6, "nulls": 1, "mean": 13.33, "std": 6.439, "min": 5.0,
+        "p25": 10.25, "p50": 11.5, "p75": 18.0, "max": 22.0,
+    }
+    assert stats["region"] == {"count": 7, "nulls": 0, "unique": 3, "top": "north", "freq": 3}
+
+
+def test_correlation(frame):
+    pairs = analysis.correlation(frame)["pearson"]
+
+    assert [(p["a"], p["b"]) for p in pairs] == [("amount", "units")]
+    assert pairs[0]["r"] == 0.942
+
+
+def test_groupby(frame):
+    result = analysis.groupby(frame, group_by="region", columns=["amount", "units"])
+
+    assert result["groups"] == 3
+    assert result["largest"][0] == {"group": "north", "count": 3, "mean_amount": 11.0, "mean_units": 1.333}
+
+
+def test_ttest(frame):
+    result = analysis.ttest(frame, group_by="region", target="amount")
+
+    assert result["groups"] == {"north": {"n": 3, "mean": 11.0}, "south": {"n": 2, "mean": 21.0}}
+    assert result["other_groups"] == 1
+    assert result["p"] < 0.05
+
+
+def test_chi2(frame):
+    result = analysis.chi2(frame, group_by="region", target="status")
+
+    assert result["shape"] == [3, 2]
+    assert result["n"] == 7
+    assert result["dof"] == 2
+    assert 0 < result["cramers_v"] <= 1
+
+
+def test_regression():
+    frame = pd.DataFrame({"x": [1, 2, 3, 4, 5, 6], "y": [3.1, 4.9, 7.2, 8.8, 11.1, 12.9]})
+
+    result = analysis.regression(frame, target="y")
+
+    assert result["n"] == 6
+    assert result["r2"] > 0.99
+    assert result["coefficients"]["x"]["coef"] == 1.977
+    assert result["coefficients"]["x"]["p"] < 0.001
+
+
+@pytest.mark.parametrize("function, kwargs, message", [
+    (analysis.groupby, {}, "needs groupBy"),
+    (analysis.ttest, {"group_by": "region"}, "needs target"),
+    (analysis.describe, {"columns": ["missing"]}, "Unknown columns"),
+    (analysis.correlation, {"columns": ["amount", "region"]}, "two numeric columns"),
+    (analysis.regression, {"target": "region"}, "numeric target"),
+])
+def test_invalid_arguments(frame, function, kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        function(frame, **kwargs)
+
+
+def test_analyze_data_runs_the_query(tmp_path):
+    path = tmp_path / "orders.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE orders (region TEXT, amount REAL)")
+        conn.executemany("INSERT INTO orders VALUES (?, ?)", [("north", 1.0), ("south", 3.0), ("south", 5.0)])
+    datasource = create_datasource({"_id": "s", "name": "s", "type": "sqlite", "position": 1, "path": str(path)})
+
+    output = analysis.analyze_data(
+        "groupby", query="SELECT region, amount FROM orders", groupBy="region",
+        datasourceId="s", datasources=[datasource],
+    )
+
+    assert json.loads(output) == {
+        "rows": 3,
+        "groupby": {"groups": 2, "largest": [
+            {"group": "south", "count": 2, "mean_amount": 4.0},
+            {"group": "north", "count": 1, "mean_amount": 1.0},
+        ]},
+    }
+
+
+def test_analyze_data_needs_a_source():
+    with pytest.raises(ValueError, match="query or a resultId"):
+        analysis.analyze_data("describe")
+    with pytest.raises(ValueError, match="Unknown analysis"):
+        analysis.analyze_data("anova", query="SELECT 1")
@@ -0,0 +1,143 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from chat_processor import (
+    EVENTS_COLLECTION,
+    Conversation,
+    LogEvent,
+    ToolCallEvent,
+    UserEvent,
+    ensure_event_indexes,
+    migrate_embedded_events,
+)
+
+
+def _log(i: int) -> LogEvent:
+    return LogEvent(id=f"e{i}", timestamp=datetime(2024, 1, 1), message=f"event {i}")
+
+
+def test_tool_call_parameters_keep_json_values(db):
+    conversation = Conversation.create(db, "c1")
+    parameters = {
+        "analysis": "groupby",
+        "query": "SELECT region, amount FROM orders",
+        "resultId": None,
+        "columns": ["amount", "discount"],
+        "groupBy": "region",
+        "target": None,
+        "datasourceId": "ds1",
+    }
+    events = conversation.add_tool_calls(db, [("call_1", "analyze_data", parameters)])
+
+    assert events[0].parameters == parameters
+    stored = Conversation.create(db, "c1").load_events(db)
+    assert isinstance(stored[0], ToolCallEvent)
+    assert stored[0].parameters == parameters
+
+
+def test_embedded_events_are_migrated(db):
+    ensure_event_indexes(db)
+    events = [_log(i).model_dump() for i in range(3)]
+    events.append(
+        UserEvent(id="u", timestamp=datetime(2024, 1, 1), message="hi", datasoruceIds=["ds1"]).model_dump()
+    )
+    db.conversations.insert_one({"_id": "c1", "created_at": datetime(2024, 1, 1), "events": events})
+    # a previous migration stopped after the first event
+    db[EVENTS_COLLECTION].insert_one({"conversation_id": "c1", "seq": 0, **events[0]})
+
+    conversation = Conversation.create(db, "c1")
+
+    assert "events" not in db.conversations.find_one({"_id": "c1"})
+    stored = conversation.load_events(db)
+    assert [e.id for e in stored] == ["e0", "e1", "e2", "u"]
+    assert isinstance(stored[3], UserEvent)
+    # new events continue after the migrated ones
+    assert conversation.next_seq == 4
+    migrate_embedded_events(db, "c1")
+    assert db[EVENTS_COLLECTION].count_documents({"conversation_id": "c1"}) == 4
+
+
+def test_load_older_pages_back(db):
+    conversation = Conversation.create(db, "c1")
+    conversation._push_events(db, [_log(i) for i in range(250)])
+
+    conversation = Conversation.create(db, "c1")
+    conversation.ensure_history(db)
+    conversation.ensure_history(db)
+    assert [conversation.first_seq, len(conversation.events)] == [150, 100]
+    assert conversation.events[0].id == "e150"
+
+    older = conversation.load_older(db)
+    assert [e.id for e in older[:1] + older[-1:]] == ["e50", "e149"]
+    older = conversation.load_older(db, limit=100)
+    assert [e.id for e in older] == [f"e{i}" for i in range(50)]
+    assert conversation.load_older(db) == []
+    assert conversation.first_seq == 0
+    assert [e.id for e in conversation.events] == [f"e{i}" for i in range(250)]
+
+
+def test_events_added_after_loading_keep_the_sequence(db):
+    conversation = Conversation.create(db, "c1")
+    conversation._push_events(db, [_log(i) for i in range(3)])
+    conversation = Conversation.create(db, "c1")
+    conversation._push_event(db, _log(3))
+    conversation.ensure_history(db)
+
+    assert [e.id for e in conversation.events] == ["e0", "e1", "e2", "e3"]
+
+
+def _with_summary(db, seq: int) -> Conversation:
+    conversation = Conversation.create(db, "c1")
+    conversation.add_tool_calls(db, [("call", "execute_sql_query", {"query": "SELECT 1"})])
+    conversation._push_events(db, [_log(i) for i in range(1, 6)])
+    conversation.save_history_summary(db, "summary", seq)
+    return conversation
+
+
+def test_summary_covering_edited_events_is_dropped(db):
+    conversation = _with_summary(db, 3)
+    conversation.remove_events_after(db, "e4")
+    assert conversation.history_summary(db) == {"text": "summary", "seq": 3}
+    conversation.remove_events_after(db, "e1")
+    assert conversation.history_summary(db) is None
+    assert [e.id for e in conversation.load_events(db)] == [conversation.events[0].id, "e1"]
+
+    conversation.save_history_summary(db, "summary", 2)
+    conversation.update_tool_call_query(db, conversation.events[0].id, "SELECT 2")
+    assert conversation.history_summary(db) is None
+    assert conversation.load_events(db)[0].parameters["query"] == "SELECT 2"
+
+
+def test_older_summary_doesnt_replace_a_newer_one(db):
+    conversation = _with_summary(db, 3)
+    conversation.save_history_summary(db, "stale", 2)
+
+    assert conversation.history_summary(db) == {"text": "summary", "seq": 3}
+
+
+def test_edits_are_awaitable_with_an_async_database(db, async_db):
+    conversation = _with_summary(db, 3)
+
+    async def edit():
+        await conversation.update_tool_call_query(async_db, conversation.events[0].id, "SELECT 2")
+        assert await conversation.ahistory_summary(async_db) is None
+        await conversation.save_history_summary(async_db, "summary", 3)
+        await conversation.remove_events_after(async_db, "e1")
+
+    asyncio.run(edit())
+
+    assert conversation.history_summary(db) is None
+    stored = conversation.load_events(db)
+    assert [e.id for e in stored] == [conversation.events[0].id, "e1"]
+    assert stored[0].parameters["query"] == "SELECT 2"
+
+
+def test_unknown_events_are_rejected(db):
+    conversation = _with_summary(db, 3)
+
+    with pytest.raises(ValueError):
+        conversation.remove_events_after(db, "missing")
+    with pytest.raises(ValueError):
+        conversation.update_tool_call_query(db, "e1", "SELECT 2")
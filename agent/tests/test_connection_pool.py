@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from models.datasource import DataSourceType, create_datasource
+from tools import connection_pool
+from tools.connection_pool import ConnectionPoolManager, DatasourcePool, datasource_fingerprint
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+
+
+class FakeConnector:
+    """connect/ping/close of CONNECTORS, keeps every connection it made"""
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, datasource):
+        conn = FakeConnection(len(self.connections))
+        self.connections.append(conn)
+        return conn
+
+    def ping(self, conn):
+        if not conn.alive:
+            raise ConnectionError("server has gone away")
+        return True
+
+    def close(self, conn):
+        conn.closed = True
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    connector = FakeConnector()
+    monkeypatch.setitem(
+        connection_pool.CONNECTORS, DataSourceType.MYSQL, (connector.connect, connector.ping, connector.close)
+    )
+    return connector
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(connection_pool, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def _datasource(host="db"):
+    return create_datasource({
+        "_id": "crm", "name": "crm", "type": "mysql", "position": 1,
+        "host": host, "port": "3306", "username": "u", "password": "p", "database": "crm",
+    })
+
+
+def test_idle_connections_are_reused_lifo(connector):
+    pool = DatasourcePool(_datasource(), max_size=2, idle_timeout=60)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    # the most recently released connection first
+    assert pool.acquire() is second
+    assert pool.acquire() is first
+    assert len(connector.connections) == 2
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted(connector):
+    pool = DatasourcePool(_datasource(), max_size=1, idle_timeout=60)
+    pool.acquire()
+
+    with pytest.raises(TimeoutError, match="crm"):
+        pool.acquire(timeout=0.05)
+
+
+def test_checkout_waits_for_a_released_connection(connector):
+    pool = DatasourcePool(_datasource(), max_size=1, idle_timeout=60)
+    conn = pool.acquire()
+    threading.Timer(0.05, pool.release, args=(conn,)).start()
+
+    assert pool.acquire(timeout=5) is conn
+
+
+def test_idle_connections_are_evicted(connector, clock):
+    pool = DatasourcePool(_datasource(), max_size=2, idle_timeout=60)
+    stale = pool.acquire()
+    pool.release(stale)
+    clock.now += 61
+
+    conn = pool.acquire()
+
+    assert conn is not stale
+    assert stale.closed
+    # the evicted connection gave its slot back
+    pool.acquire(timeout=0)
+
+
+def test_dead_connections_are_dropped(connector):
+    pool = DatasourcePool(_datasource(), max_size=1, idle_timeout=60)
+    dead = pool.acquire()
+    pool.release(dead)
+    dead.alive = False
+
+    conn = pool.acquire(timeout=0)
+
+    assert conn is not dead
+    assert dead.closed
+
+
+def test_broken_connections_are_not_returned(connector):
+    manager = ConnectionPoolManager(max_size=1)
+    with pytest.raises(RuntimeError):
+        with manager.connection(_datasource()) as conn:
+            raise RuntimeError("query failed")
+
+    assert conn.closed
+    with manager.connection(_datasource()) as fresh:
+        assert fresh is not conn
+
+
+def test_pool_is_recreated_when_the_datasource_changes(connector):
+    manager = ConnectionPoolManager()
+    with manager.connection(_datasource()) as old:
+        pass
+    with manager.connection(_datasource()) as same:
+        assert same is old
+
+    with manager.connection(_datasource(host="db2")) as new:
+        assert new is not old
+    assert old.closed
+
+
+@pytest.fixture
+def sqlite_file(tmp_path):
+    path = tmp_path / "shop.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE orders (id INTEGER)")
+        conn.execute("INSERT INTO orders VALUES (1)")
+    conn.close()
+    return create_datasource(
+        {"_id": "shop", "name": "shop", "type": "sqlite", "position": 1, "path": str(path)}
+    )
+
+
+@pytest.mark.parametrize("immutable", [True, False])
+def test_sqlite_connections_are_read_only(sqlite_file, monkeypatch, immutable):
+    monkeypatch.setattr(connection_pool, "SQLITE_IMMUTABLE", immutable)
+    conn = connection_pool._connect_sqlite(sqlite_file)
+    try:
+        assert conn.execute("SELECT id FROM orders").fetchall() == [(1,)]
+        assert conn.execute("PRAGMA mmap_size").fetchone()[0] > 0
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            conn.execute("INSERT INTO orders VALUES (2)")
+    finally:
+        conn.close()
+
+
+def test_changed_sqlite_file_gets_a_new_pool(sqlite_file):
+    manager = ConnectionPoolManager()
+    before = datasource_fingerprint(sqlite_file)
+    with manager.connection(sqlite_file) as old:
+        assert old.execute("SELECT COUNT(*) FROM orders").fetchone() == (1,)
+
+    with sqlite3.connect(sqlite_file.path) as conn:
+        conn.executemany("INSERT INTO orders VALUES (?)", [(i,) for i in range(2, 100)])
+    conn.close()
+    # the rows fit the same page and a coarse clock may keep the mtime
+    stat = os.stat(sqlite_file.path)
+    os.utime(sqlite_file.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert datasource_fingerprint(sqlite_file) != before
+    with manager.connection(sqlite_file) as new:
+        # an immutable connection to the old file wouldn't see the rows
+        assert new is not old
+        assert new.execute("SELECT COUNT(*) FROM orders").fetchone() == (99,)
+    manager.close_all()
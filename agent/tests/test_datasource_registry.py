@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import datasource_registry
+from datasource_registry import CHANGE_STREAMS_UNSUPPORTED, DatasourceRegistry
+
+
+class FakeStream:
+    def __init__(self, events, error=None):
+        self.events = events
+        self.error = error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        yield from self.events
+        if self.error:
+            raise self.error
+
+
+class FakeCollection:
+    """Hands out the scripted streams, one per watch() call"""
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.watches = []
+
+    def watch(self, **kwargs):
+        self.watches.append(kwargs)
+        return self.streams.pop(0)
+
+
+def _change(token, operation, ds_id=None):
+    change = {"_id": token, "operationType": operation}
+    if ds_id:
+        change["documentKey"] = {"_id": ds_id}
+    return change
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = SimpleNamespace(invalidated=[], closed_all=0)
+    pool.invalidate = pool.invalidated.append
+    pool.close_all = lambda: setattr(pool, "closed_all", pool.closed_all + 1)
+    monkeypatch.setattr(datasource_registry, "connection_pool", pool)
+    monkeypatch.setattr(datasource_registry, "DATASOURCE_WATCH_RETRY", 0)
+    return pool
+
+
+def _registry(collection):
+    registry = DatasourceRegistry({"datasources": collection})
+    invalidated = []
+    registry.invalidate = lambda datasource_id=None: invalidated.append(datasource_id)
+    return registry, invalidated
+
+
+def test_watch_survives_events_without_document_and_errors(pool):
+    unsupported = OperationFailure("not a replica set", code=CHANGE_STREAMS_UNSUPPORTED)
+    collection = FakeCollection([
+        FakeStream([_change("t1", "update", "a"), _change("t2", "drop"), _change("t3", "invalidate")]),
+        FakeStream([_change("t4", "insert", "b")], error=AutoReconnect("connection reset")),
+        FakeStream([], error=unsupported),
+    ])
+    registry, invalidated = _registry(collection)
+
+    registry._watch("datasources")
+
+    # the whole cache is dropped for events of the collection
+    assert invalidated == ["a", None, None, "b"]
+    assert pool.invalidated == ["a", "b"]
+    assert pool.closed_all == 2
+    # reopened after the invalidate event and the error
+    assert collection.watches == [{}, {"start_after": "t3"}, {"resume_after": "t4"}]
+
+
+def test_watch_without_resume_token_drops_the_cache(pool):
+    collection = FakeCollection([
+        FakeStream([], error=AutoReconnect("connection reset")),
+        FakeStream([], error=OperationFailure("not a replica set", code=CHANGE_STREAMS_UNSUPPORTED)),
+    ])
+    registry, invalidated = _registry(collection)
+
+    registry._watch("datasources")
+
+    # changes made while the stream was down could have been missed
+    assert invalidated == [None]
+    assert collection.watches == [{}, {}]
@@ -0,0 +1,167 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from agents.chat_agent import AsyncChatOpenAIDatasourceAgent, ChatOpenAIDatasourceAgent
+from chat_processor import Conversation
+
+# one answer of this size fills most of the history budget
+LONG_ANSWER = "Revenue by region. " * 700
+
+
+class FakeCompletions:
+    def __init__(self, fail=False):
+        self.requests = []
+        self.fail = fail
+
+    def create(self, messages, **kwargs):
+        self.requests.append(messages)
+        if self.fail:
+            raise RuntimeError("api down")
+        message = SimpleNamespace(content=f"summary {len(self.requests)}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    def transcript(self, i: int) -> str:
+        return self.requests[i][-1]["content"]
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    async def create(self, messages, **kwargs):
+        return super().create(messages, **kwargs)
+
+
+def add_turn(db, conversation, question, query=None, answer=LONG_ANSWER):
+    conversation.add_user_message(db, {"content": question, "datasourceIds": ["ds1"]})
+    if query:
+        conversation.add_tool_calls(db, [("call", "execute_sql_query", {"query": query, "datasourceId": "ds1"})])
+        conversation.add_tool_call_result(db, "call", "execute_sql_query", "region,total\nnorth,1200\n")
+    conversation.add_message(db, {"role": "assistant", "content": json.dumps({"answer": answer})})
+
+
+def agent(db, monkeypatch, completions, question="next question"):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    conversation = Conversation.create(db, "c1")
+    conversation.ensure_history(db)
+    if question:
+        conversation.add_user_message(db, {"content": question, "datasourceIds": ["ds1"]})
+    chat_agent = ChatOpenAIDatasourceAgent(db, conversation, registry=SimpleNamespace())
+    chat_agent.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return chat_agent
+
+
+def summarized(chat_agent):
+    chat_agent.summary_refresh.join()
+    return chat_agent
+
+
+@pytest.fixture
+def conversation(db):
+    conversation = Conversation.create(db, "c1")
+    add_turn(db, conversation, "revenue by region?", "SELECT region, SUM(amount) FROM orders GROUP BY region")
+    add_turn(db, conversation, "and by month?", "SELECT month, SUM(amount) FROM orders GROUP BY month")
+    return conversation
+
+
+def test_older_turns_are_summarized_in_background(db, monkeypatch, conversation):
+    completions = FakeCompletions()
+    first = agent(db, monkeypatch, completions)
+
+    # the turn doesn't wait for the summary, the older turn is left out
+    assert [m["content"] for m in first._history()] == ["and by month?", LONG_ANSWER]
+    summarized(first)
+    assert len(completions.requests) == 1
+    assert "SELECT region, SUM(amount) FROM orders GROUP BY region" in completions.transcript(0)
+    assert "north,1200" in completions.transcript(0)
+    assert conversation.history_summary(db) == {"text": "summary 1", "seq": 4}
+
+    # the same question, asked again
+    history = agent(db, monkeypatch, completions, question=None)._history()
+    assert history[0] == {"role": "system", "content": "Summary of the earlier conversation:\nsummary 1"}
+    assert [m["content"] for m in history[1:]] == ["and by month?", LONG_ANSWER]
+    assert len(completions.requests) == 1
+
+
+def test_summary_is_extended_after_answers(db, monkeypatch, conversation):
+    completions = FakeCompletions()
+    first = agent(db, monkeypatch, completions, question=None)
+    first._summarize_history()
+    summarized(first)
+    add_turn(db, conversation, "top customers?", "SELECT customer FROM orders LIMIT 10")
+
+    chat_agent = agent(db, monkeypatch, completions, question=None)
+    chat_agent._summarize_history()
+    summarized(chat_agent)
+
+    assert len(completions.requests) == 2
+    transcript = completions.transcript(1)
+    assert transcript.startswith("Summary so far:\nsummary 1")
+    assert "GROUP BY month" in transcript
+    assert "GROUP BY region" not in transcript
+    assert conversation.history_summary(db) == {"text": "summary 2", "seq": 8}
+
+
+def test_summarize_history_after_an_answer(db, monkeypatch, conversation):
+    completions = FakeCompletions()
+    chat_agent = agent(db, monkeypatch, completions, question=None)
+    chat_agent._summarize_history()
+    summarized(chat_agent)
+
+    # the first turn doesn't fit next to the second one
+    assert conversation.history_summary(db)["seq"] == 4
+
+
+def test_events_older_than_the_loaded_page_are_summarized(db, monkeypatch):
+    conversation = Conversation.create(db, "c1")
+    for i in range(130):
+        add_turn(db, conversation, f"question {i}", answer=f"answer {i}")
+
+    chat_agent = agent(db, monkeypatch, FakeCompletions(), question=None)
+    # the loaded page starts at seq 160, all of its short turns fit the budget
+    assert chat_agent.conversation.first_seq == 160
+    chat_agent._summarize_history()
+    summarized(chat_agent)
+
+    completions = chat_agent.client.chat.completions
+    # a page of events per llm call
+    assert len(completions.requests) == 2
+    assert "User: question 0\n" in completions.transcript(0)
+    assert "question 50" not in completions.transcript(0)
+    assert completions.transcript(1).startswith("Summary so far:\nsummary 1")
+    assert "Assistant: answer 79" in completions.transcript(1)
+    assert conversation.history_summary(db) == {"text": "summary 2", "seq": 160}
+
+
+def test_failed_summary_is_retried_by_the_next_turn(db, monkeypatch, conversation):
+    failed = agent(db, monkeypatch, FakeCompletions(fail=True))
+    failed._history()
+    summarized(failed)
+    assert conversation.history_summary(db) is None
+
+    completions = FakeCompletions()
+    retried = agent(db, monkeypatch, completions, question=None)
+    retried._history()
+    summarized(retried)
+    assert conversation.history_summary(db) == {"text": "summary 1", "seq": 4}
+
+
+def test_async_agent_summarizes_in_background(db, async_db, monkeypatch, conversation):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    completions = AsyncFakeCompletions()
+
+    async def turn():
+        conversation = await Conversation.acreate(async_db, "c1")
+        await conversation.aensure_history(async_db)
+        await conversation.add_user_message(async_db, {"content": "next question", "datasourceIds": ["ds1"]})
+        chat_agent = AsyncChatOpenAIDatasourceAgent(async_db, conversation, registry=SimpleNamespace())
+        chat_agent.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        history = await chat_agent._history()
+        if chat_agent.summary_refresh:
+            await chat_agent.summary_refresh
+        return history
+
+    assert asyncio.run(turn())[0]["content"] == "and by month?"
+    assert conversation.history_summary(db) == {"text": "summary 1", "seq": 4}
+    assert asyncio.run(turn())[0]["content"].endswith("summary 1")
+    assert len(completions.requests) == 1
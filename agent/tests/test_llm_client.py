@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from llm_client import LLMCacheMiss, LLMCacheMode, ResponseStore, _AsyncCompletions, _Completions
+
+REQUEST = {"model": "gpt-4o", "messages": [{"role": "user", "content": "revenue?"}]}
+
+
+def _completion(content="42"):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 1,
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    })
+
+
+def _chunks(*contents):
+    return [
+        ChatCompletionChunk.model_validate({
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-4o",
+            "choices": [{"index": 0, "delta": {"content": content}}],
+        })
+        for content in contents
+    ]
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        return iter(_chunks("4", "2")) if kwargs.get("stream") else _completion()
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    async def create(self, **kwargs):
+        self.calls += 1
+        if not kwargs.get("stream"):
+            return _completion()
+
+        async def stream():
+            for chunk in _chunks("4", "2"):
+                yield chunk
+
+        return stream()
+
+
+class ThreadRecordingStore(ResponseStore):
+    """Remembers the threads the files were read and written from"""
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.threads = []
+
+    def load(self, key):
+        self.threads.append(threading.current_thread())
+        return super().load(key)
+
+    def save(self, key, request, response):
+        self.threads.append(threading.current_thread())
+        super().save(key, request, response)
+
+
+def test_recorded_responses_are_replayed(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    completions = FakeCompletions()
+    recording = _Completions(completions, store, LLMCacheMode.RECORD)
+    assert recording.create(**REQUEST).choices[0].message.content == "42"
+    assert [c.choices[0].delta.content for c in recording.create(**REQUEST, stream=True)] == ["4", "2"]
+
+    replay = _Completions(completions, store, LLMCacheMode.REPLAY)
+    assert replay.create(**REQUEST).choices[0].message.content == "42"
+    assert [c.choices[0].delta.content for c in replay.create(**REQUEST, stream=True)] == ["4", "2"]
+    assert completions.calls == 2
+    with pytest.raises(LLMCacheMiss):
+        replay.create(**REQUEST, temperature=0)
+
+
+def test_async_store_io_runs_off_the_event_loop(tmp_path):
+    store = ThreadRecordingStore(str(tmp_path))
+    completions = AsyncFakeCompletions()
+
+    async def run():
+        cached = _AsyncCompletions(completions, store, LLMCacheMode.CACHE)
+        contents = []
+        for _ in range(2):
+            contents.append((await cached.create(**REQUEST)).choices[0].message.content)
+            stream = await cached.create(**REQUEST, stream=True)
+            contents.append("".join([chunk.choices[0].delta.content async for chunk in stream]))
+        return contents
+
+    assert asyncio.run(run()) == ["42", "42", "42", "42"]
+    # one miss and one hit of each request, both misses recorded
+    assert completions.calls == 2
+    assert len(store.threads) == 6
+    assert threading.main_thread() not in store.threads
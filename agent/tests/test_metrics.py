@@ -0,0 +1,36 @@
+import pytest
+
+from metrics import Counter, Histogram, Registry, _Metric
+
+
+def test_metric_without_samples_cant_be_created():
+    class Gauge(_Metric):
+        kind = "gauge"
+
+    with pytest.raises(TypeError, match="_samples"):
+        Gauge("agent_gauge", "gauge")
+
+
+def test_exposition_format():
+    registry = Registry()
+    errors = registry.register(Counter("agent_errors_total", "Errors", ["stage"]))
+    seconds = registry.register(Histogram("agent_seconds", "Durations", ["stage"], buckets=[0.1, 1]))
+    errors.inc(stage='sql "main"\n')
+    errors.inc(2, stage='sql "main"\n')
+    seconds.observe(0.05, stage="llm")
+    seconds.observe(0.5, stage="llm")
+    seconds.observe(5, stage="llm")
+
+    assert registry.render() == (
+        "# HELP agent_errors_total Errors\n"
+        "# TYPE agent_errors_total counter\n"
+        'agent_errors_total{stage="sql \\"main\\"\\n"} 3\n'
+        "# HELP agent_seconds Durations\n"
+        "# TYPE agent_seconds histogram\n"
+        'agent_seconds_bucket{stage="llm",le="0.1"} 1\n'
+        'agent_seconds_bucket{stage="llm",le="1.0"} 2\n'
+        'agent_seconds_bucket{stage="llm",le="+Inf"} 3\n'
+        'agent_seconds_sum{stage="llm"} 5.55\n'
+        'agent_seconds_count{stage="llm"} 3\n'
+    )
+    assert errors.value(stage='sql "main"\n') == 3
@@ -0,0 +1,72 @@
+import logging
+from types import SimpleNamespace
+
+from agents.prompt_builder import DATASOURCES_HEADER, RELEVANT_DATASOURCES_HEADER, build_messages, log_usage
+from metrics import cached_tokens
+from models.datasource import create_datasource
+from models.schema import ColumnSchema, SchemaIndex, TableSchema
+
+HISTORY = [{"role": "user", "content": "revenue?"}, {"role": "assistant", "content": "1200"}]
+
+
+def _datasource(ds_id, tables=1):
+    datasource = create_datasource(
+        {"_id": ds_id, "name": ds_id, "type": "sqlite", "position": 1, "path": f"{ds_id}.db"}
+    )
+    datasource.schema_index = SchemaIndex(
+        _id=ds_id,
+        tables=[
+            TableSchema(
+                name=f"table_{i}",
+                columns=[ColumnSchema(name=f"column_{j}", type="TEXT") for j in range(10)],
+                signature=str(i),
+            )
+            for i in range(tables)
+        ],
+    )
+    return datasource
+
+
+def test_stable_prefix_is_shared_by_questions():
+    a, b = _datasource("a"), _datasource("b")
+
+    first = build_messages("system", "revenue by region?", [a, b], history=HISTORY)
+    second = build_messages("system", "and by month?", [b, a], history=HISTORY)
+
+    # datasources sorted by id, only the question differs
+    assert first[:-1] == second[:-1]
+    assert first[1]["content"] == DATASOURCES_HEADER + a.context_prompt() + "\n" + b.context_prompt()
+    assert first[2:4] == HISTORY
+    assert first[-1] == {"role": "user", "content": "revenue by region?"}
+
+
+def test_pruned_context_follows_the_history():
+    small, large = _datasource("small"), _datasource("large", tables=400)
+
+    messages = build_messages("system", "column_1 of table_7", [small, large], history=HISTORY)
+
+    assert [m["role"] for m in messages] == ["system", "system", "user", "assistant", "system", "user"]
+    assert messages[1]["content"] == DATASOURCES_HEADER + small.context_prompt()
+    assert messages[4]["content"].startswith(RELEVANT_DATASOURCES_HEADER + "<datasource_large>")
+    assert "omittedTables" in messages[4]["content"]
+
+
+def test_stable_context_comes_from_the_registry():
+    registry = SimpleNamespace(context_prompt=lambda ds: f"cached {ds.id}")
+
+    messages = build_messages("system", "question", [_datasource("a")], registry)
+
+    assert messages[1]["content"] == DATASOURCES_HEADER + "cached a"
+
+
+def test_cached_tokens_are_logged(caplog):
+    usage = SimpleNamespace(
+        prompt_tokens=2000, completion_tokens=50, prompt_tokens_details=SimpleNamespace(cached_tokens=1536)
+    )
+
+    with caplog.at_level(logging.INFO):
+        log_usage(SimpleNamespace(usage=usage), "chat")
+
+    assert "chat: 2000 prompt tokens (1536 cached, 77%), 50 completion tokens" in caplog.text
+    assert cached_tokens(SimpleNamespace(prompt_tokens_details={"cached_tokens": 128})) == 128
+    assert cached_tokens(SimpleNamespace(prompt_tokens_details=None)) == 0
@@ -0,0 +1,98 @@
+import pytest
+
+from models.datasource import create_datasource
+from models.query_result import QueryResult
+from tools.query_cache import QueryCache, normalize_query
+
+
+def _datasource(id_="pg1", host="localhost"):
+    return create_datasource({
+        "_id": id_, "name": id_, "type": "postgres", "position": 1, "host": host,
+        "port": "5432", "username": "u", "password": "p", "database": "d",
+    })
+
+
+def _result():
+    return QueryResult.from_rows(["id", "name"], [(1, "a"), (2, "b")])
+
+
+def test_hits_dont_share_result_ids():
+    cache = QueryCache()
+    result = _result()
+    cache.set("k", "ds1", result)
+    # tools.py sets the id of the stored result on what it got
+    result.result_id = "conversation-1"
+
+    first = cache.get("k")
+    first.result_id = "conversation-2"
+    second = cache.get("k")
+
+    assert second.result_id is None
+    assert second.rows == [(1, "a"), (2, "b")]
+
+
+@pytest.mark.parametrize("query, normalized", [
+    ("SELECT a,\n\t b  FROM t ;", "SELECT a, b FROM t"),
+    ("  select a from t;;", "select a from t"),
+    ("SELECT 'a  b' FROM t WHERE c = \"x  y\"", "SELECT 'a  b' FROM t WHERE c = \"x  y\""),
+    ("SELECT `a  b`,  'it''s  ok' FROM t", "SELECT `a  b`, 'it''s  ok' FROM t"),
+])
+def test_normalize_query(query, normalized):
+    assert normalize_query(query) == normalized
+
+
+def test_key():
+    datasource = _datasource()
+    key = QueryCache.key(datasource, "SELECT a FROM t")
+
+    assert QueryCache.key(datasource, "SELECT a\n  FROM t;") == key
+    assert QueryCache.key(datasource, "SELECT a FROM t WHERE x = 'a  b'") != QueryCache.key(
+        datasource, "SELECT a FROM t WHERE x = 'a b'"
+    )
+    assert QueryCache.key(datasource, "SELECT a FROM t", params=(1,)) != key
+    assert QueryCache.key(datasource, "SELECT a FROM t", max_rows=10) != key
+    assert QueryCache.key(_datasource("pg2"), "SELECT a FROM t") != key
+    # another server behind the same datasource id
+    assert QueryCache.key(_datasource(host="replica"), "SELECT a FROM t") != key
+
+
+def test_invalidate_drops_only_the_datasource():
+    cache = QueryCache()
+    cache.set("k1", "ds1", _result())
+    cache.set("k2", "ds2", _result())
+
+    cache.invalidate("ds1")
+
+    assert cache.get("k1") is None
+    assert cache.get("k2") is not None
+
+
+def test_shared_tier(db):
+    writer = QueryCache()
+    writer.attach_mongodb(db)
+    writer.set("k1", "ds1", _result())
+    reader = QueryCache()
+    reader.attach_mongodb(db)
+
+    assert reader.get("k1").rows == [(1, "a"), (2, "b")]
+
+    writer.invalidate("ds1")
+    assert db["query-cache"].count_documents({}) == 0
+    assert writer.get("k1") is None
+
+
+def test_expired_entries_are_dropped():
+    cache = QueryCache(ttl=-1)
+    cache.set("k", "ds1", _result())
+
+    assert cache.get("k") is None
+    assert cache._size == 0
+
+
+def test_lru_eviction_by_entries():
+    cache = QueryCache(max_entries=2)
+    for key in ("k1", "k2", "k3"):
+        cache.set(key, "ds1", _result())
+
+    assert cache.get("k1") is None
+    assert cache.get("k3") is not None
@@ -0,0 +1,155 @@
+import pytest
+
+from models.datasource import create_datasource
+from models.schema import ColumnSchema, SchemaIndex, TableSchema
+from tools import query_guard
+from tools.query_guard import LIMIT, QueryRejected, prepare
+
+
+def _datasource(type_: str):
+    if type_ == "sqlite":
+        return create_datasource({"_id": "s", "name": "s", "type": "sqlite", "position": 1, "path": "/tmp/x.db"})
+    return create_datasource({
+        "_id": type_, "name": type_, "type": type_, "position": 1, "host": "localhost",
+        "port": "1", "username": "u", "password": "p", "database": "d",
+    })
+
+
+def _wrapped(statement: str) -> str:
+    return f"SELECT * FROM (\n{statement}\n) AS guarded LIMIT {LIMIT}"
+
+
+def _limited(statement: str) -> str:
+    return f"{statement}\nLIMIT {LIMIT}"
+
+
+@pytest.mark.parametrize("type_, query", [
+    ("sqlite", "SELECT strftime('%Y-%m', d) AS month, count(*) FROM t GROUP BY 1"),
+    ("postgres", "SELECT date_trunc('month', d)::date AS month, amount FROM t WHERE name ILIKE 'a%'"),
+    ("mysql", "SELECT DATE_FORMAT(d, '%Y-%m') AS month, IFNULL(amount, 0) FROM `t`"),
+    ("clickhouse", "SELECT toStartOfMonth(d) AS month, uniqExact(user_id) FROM t GROUP BY month"),
+    # duplicate column names, a derived table of this fails in mysql
+    ("mysql", "SELECT a.id, b.id FROM a JOIN b ON a.b_id = b.id ORDER BY a.id"),
+    ("postgres", "SELECT a FROM t UNION ALL SELECT a FROM u"),
+    ("postgres", "SELECT a FROM (SELECT a FROM t LIMIT 5000000) AS s WHERE a > (SELECT 1)"),
+    ("clickhouse", "SELECT user_id, ts FROM t ORDER BY ts DESC LIMIT 1 BY user_id"),
+])
+def test_limit_is_appended_to_the_original_text(type_, query):
+    assert prepare(_datasource(type_), query).sql == _limited(query)
+
+
+@pytest.mark.parametrize("type_, query, limited", [
+    ("postgres", "SELECT a FROM t ORDER BY a LIMIT 1000000", f"SELECT a FROM t ORDER BY a LIMIT {LIMIT}"),
+    ("mysql", "SELECT a FROM t LIMIT 5, 1000000", f"SELECT a FROM t LIMIT 5, {LIMIT}"),
+    ("postgres", "SELECT a FROM t LIMIT 1000000 OFFSET 5", f"SELECT a FROM t LIMIT {LIMIT} OFFSET 5"),
+    ("postgres", "SELECT a FROM t OFFSET 5", f"SELECT a FROM t LIMIT {LIMIT} OFFSET 5"),
+    ("clickhouse", "SELECT a FROM t SETTINGS max_threads = 1", f"SELECT a FROM t LIMIT {LIMIT} SETTINGS max_threads = 1"),
+    ("clickhouse", "SELECT a FROM t FORMAT CSV", f"SELECT a FROM t LIMIT {LIMIT} FORMAT CSV"),
+])
+def test_outer_limit_is_set_in_place(type_, query, limited):
+    assert prepare(_datasource(type_), query).sql == limited
+
+
+def test_clickhouse_union_is_wrapped():
+    # a LIMIT after the union would apply to its last select only
+    query = "SELECT a FROM t UNION ALL SELECT a FROM u"
+    assert prepare(_datasource("clickhouse"), query).sql == _wrapped(query)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT a.id, b.id FROM a JOIN b ON a.id = b.id UNION ALL SELECT 1, 2",
+    "SELECT * FROM t UNION ALL SELECT * FROM u",
+])
+def test_unsafe_shapes_are_not_wrapped(query):
+    assert prepare(_datasource("clickhouse"), query).sql == query
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT toStartOfMonth(d) FROM t;",
+    "SELECT toStartOfMonth(d) FROM t -- by month",
+    "  SELECT toStartOfMonth(d) FROM t ; -- done\n",
+])
+def test_trailing_semicolon_and_comments_are_dropped(query):
+    assert prepare(_datasource("clickhouse"), query).sql == _limited("SELECT toStartOfMonth(d) FROM t")
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT a FROM t LIMIT 10",
+    f"SELECT a FROM t LIMIT {LIMIT}",
+    "SHOW TABLES",
+])
+def test_queries_within_the_budget_are_unchanged(query):
+    assert prepare(_datasource("clickhouse"), query).sql == query
+
+
+def test_limited_queries_run(tmp_path):
+    import sqlite3
+
+    path = tmp_path / "t.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE t (a INTEGER)")
+        conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(5)])
+    datasource = create_datasource({"_id": "s", "name": "s", "type": "sqlite", "position": 1, "path": str(path)})
+    with sqlite3.connect(path) as conn:
+        guarded = prepare(datasource, "SELECT a FROM t ORDER BY a DESC -- newest")
+        assert conn.execute(guarded.sql).fetchall() == [(4,), (3,), (2,), (1,), (0,)]
+        guarded = prepare(datasource, "SELECT x.a, y.a FROM t AS x JOIN t AS y ON x.a = y.a ORDER BY x.a LIMIT 2000000 OFFSET 3")
+        assert conn.execute(guarded.sql).fetchall() == [(3, 3), (4, 4)]
+
+
+@pytest.mark.parametrize("type_, query, message", [
+    ("postgres", "DELETE FROM t WHERE a = 1", "DELETE"),
+    ("mysql", "UPDATE t SET a = 1", "UPDATE"),
+    ("sqlite", "DROP TABLE t", "DROP"),
+    ("postgres", "SELECT a FROM t; SELECT b FROM u", "exactly one"),
+    ("postgres", "WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d", "DELETE"),
+    ("postgres", "SELECT a INTO backup FROM t", "INTO"),
+    ("postgres", "SELECT a FROM t FOR UPDATE", "FOR UPDATE"),
+    ("postgres", "SELECT pg_sleep(10)", "pg_sleep"),
+    ("mysql", "SELECT SLEEP(10) FROM t", "SLEEP"),
+])
+def test_non_read_statements_are_rejected(type_, query, message):
+    with pytest.raises(QueryRejected, match=message):
+        prepare(_datasource(type_), query)
+
+
+def test_unparsable_queries_are_checked_by_keywords(monkeypatch):
+    def fail(*args, **kwargs):
+        raise query_guard.SqlglotError("unsupported")
+
+    monkeypatch.setattr(query_guard.sqlglot, "parse", fail)
+    datasource = _datasource("clickhouse")
+
+    assert prepare(datasource, "SELECT 'drop table' FROM t").sql == "SELECT 'drop table' FROM t"
+    with pytest.raises(QueryRejected, match="ALTER"):
+        prepare(datasource, "ALTER TABLE t DELETE WHERE 1")
+    with pytest.raises(QueryRejected, match="exactly one"):
+        prepare(datasource, "SELECT 1; SELECT 2")
+
+
+@pytest.fixture
+def indexed_sqlite(tmp_path):
+    import sqlite3
+
+    path = tmp_path / "t.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE t (a INTEGER, b INTEGER)")
+        conn.execute("CREATE INDEX t_b ON t (b)")
+    datasource = create_datasource({"_id": "s", "name": "s", "type": "sqlite", "position": 1, "path": str(path)})
+    columns = [ColumnSchema(name="a", type="INTEGER"), ColumnSchema(name="b", type="INTEGER")]
+    datasource.schema_index = SchemaIndex(
+        _id="s", tables=[TableSchema(name="t", columns=columns, row_estimate=10_000, signature="x")]
+    )
+    return datasource
+
+
+def test_covering_index_scans_are_full_scans(indexed_sqlite):
+    # SCAN x USING COVERING INDEX t_b reads every row of the index
+    guarded = prepare(indexed_sqlite, "SELECT x.b, y.b AS b2 FROM t AS x, t AS y")
+    with pytest.raises(QueryRejected, match="100,000,000 rows"):
+        query_guard.check_cost(indexed_sqlite, guarded)
+
+
+def test_index_searches_are_not_full_scans(indexed_sqlite):
+    guarded = prepare(indexed_sqlite, "SELECT x.a FROM t AS x JOIN t AS y ON y.b = x.a")
+    query_guard.check_cost(indexed_sqlite, guarded)
@@ -0,0 +1,67 @@
+import io
+from datetime import datetime
+
+import numpy as np
+
+from models.query_result import QueryResult
+
+
+def _result():
+    return QueryResult.from_rows(
+        ["id", "amount", "name", "created_at", "tags"],
+        [
+            (1, 1.5, "a", datetime(2024, 1, 1, 12, 30), ["x"]),
+            (2, None, None, None, None),
+            (3, 2.25, "c,\"quoted\"", datetime(2024, 3, 1), ["y", "z"]),
+        ],
+        total_rows=3,
+    )
+
+
+def test_npz_round_trip():
+    result = _result()
+    restored = QueryResult.from_npz(result.to_npz(), total_rows=3)
+
+    assert restored.columns == result.columns
+    assert restored.total_rows == 3
+    assert restored.data[0].dtype == np.int64
+    assert restored.data[0].tolist() == [1, 2, 3]
+    assert np.isnan(restored.data[1][1])
+    assert restored.data[1][[0, 2]].tolist() == [1.5, 2.25]
+    assert restored.data[2].tolist() == ["a", None, "c,\"quoted\""]
+    assert np.issubdtype(restored.data[3].dtype, np.datetime64)
+    assert np.isnat(restored.data[3][1])
+    assert restored.data[3][0] == np.datetime64("2024-01-01T12:30")
+    # objects other than strings come back as their text
+    assert restored.data[4].tolist() == ["['x']", None, "['y', 'z']"]
+
+
+def test_npz_round_trip_of_an_empty_result():
+    result = QueryResult.from_rows(["id", "name"], [])
+    restored = QueryResult.from_npz(result.to_npz(), truncated=True)
+
+    assert restored.columns == ["id", "name"]
+    assert restored.row_count == 0
+    assert restored.truncated
+
+
+def test_npz_has_no_pickled_objects():
+    raw = _result().to_npz()
+    # from_npz loads with allow_pickle=False, object arrays would fail to load
+    with np.load(io.BytesIO(raw), allow_pickle=False) as archive:
+        assert all(archive[key].dtype != object for key in archive.files)
+
+
+def test_prompt_notes_cut_results():
+    result = _result()
+    result.result_id = "r1"
+
+    text = result.to_prompt(max_rows=2)
+
+    assert text.splitlines()[:3] == [
+        "id,amount,name,created_at,tags",
+        "1,1.5,a,2024-01-01T12:30:00,['x']",
+        "2,,,,",
+    ]
+    assert "# Only the first 2 of 3 rows are shown." in text
+    assert text.endswith("# The whole result is stored with resultId r1.\n")
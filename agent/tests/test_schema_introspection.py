@@ -0,0 +1,148 @@
+import sqlite3
+
+import pytest
+from bson import ObjectId
+
+from models.datasource import DataSourceType, create_datasource
+from tools.connection_pool import connection_pool
+from tools.schema_introspection import INTROSPECTORS, Introspector, SchemaIndexer, SQLiteIntrospector
+
+
+@pytest.fixture
+def shop(tmp_path):
+    path = tmp_path / "shop.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(
+            """
+            CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT NOT NULL, country VARCHAR(2));
+            CREATE TABLE orders (
+                id INTEGER PRIMARY KEY,
+                customer_id INTEGER REFERENCES customers(id),
+                amount REAL
+            );
+            CREATE VIEW big_orders AS SELECT * FROM orders WHERE amount > 100;
+            """
+        )
+        conn.executemany(
+            "INSERT INTO customers (name, country) VALUES (?, ?)",
+            [("Ann", "CH"), ("Bob", "DE"), ("Cid", "CH")],
+        )
+        conn.execute("INSERT INTO orders (customer_id, amount) VALUES (1, 250)")
+    datasource = create_datasource(
+        {"_id": str(ObjectId()), "name": "shop", "type": "sqlite", "position": 1, "path": str(path)}
+    )
+    yield datasource, path
+    connection_pool.invalidate(datasource.id)
+
+
+class CountingIntrospector(SQLiteIntrospector):
+    described = []
+
+    def describe_table(self, table, signature):
+        self.described.append(table)
+        return super().describe_table(table, signature)
+
+
+@pytest.fixture
+def indexer(db, monkeypatch):
+    CountingIntrospector.described = []
+    monkeypatch.setitem(INTROSPECTORS, DataSourceType.SQLITE, CountingIntrospector)
+    return SchemaIndexer(db)
+
+
+def test_introspector_without_overrides_cant_be_created(shop):
+    class Incomplete(Introspector):
+        def table_signatures(self):
+            return {}
+
+    with pytest.raises(TypeError, match="describe_table"):
+        Incomplete(shop[0])
+
+
+def test_sqlite_tables_and_views(shop):
+    introspector = SQLiteIntrospector(shop[0])
+
+    signatures = introspector.table_signatures()
+    assert sorted(signatures) == ["big_orders", "customers", "orders"]
+
+    customers = introspector.describe_table("customers", signatures["customers"])
+    assert [(c.name, c.type, c.nullable, c.primary_key) for c in customers.columns] == [
+        ("id", "INTEGER", True, True),
+        ("name", "TEXT", False, False),
+        ("country", "VARCHAR(2)", True, False),
+    ]
+    assert customers.row_estimate == 3
+    assert customers.columns[1].samples == ["Ann", "Bob", "Cid"]
+    assert customers.columns[2].samples == ["CH", "DE"]
+
+    orders = introspector.describe_table("orders", signatures["orders"])
+    assert [(fk.column, fk.ref_table, fk.ref_column) for fk in orders.foreign_keys] == [
+        ("customer_id", "customers", "id")
+    ]
+
+
+def test_refresh_describes_only_changed_tables(shop, indexer):
+    datasource, path = shop
+
+    first = indexer.refresh(datasource)
+    assert first.version == 1
+    assert sorted(CountingIntrospector.described) == ["big_orders", "customers", "orders"]
+
+    CountingIntrospector.described = []
+    assert indexer.refresh(datasource).version == 1
+    assert CountingIntrospector.described == []
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("ALTER TABLE customers ADD COLUMN email TEXT")
+    second = indexer.refresh(datasource)
+    assert second.version == 2
+    assert CountingIntrospector.described == ["customers"]
+    assert [c.name for c in second.tables[1].columns][-1] == "email"
+    assert indexer.load(datasource.id).version == 2
+
+
+def test_dropped_table_bumps_the_version(shop, indexer):
+    datasource, path = shop
+    indexer.refresh(datasource)
+    with sqlite3.connect(path) as conn:
+        conn.execute("DROP VIEW big_orders")
+
+    index = indexer.refresh(datasource)
+
+    assert index.version == 2
+    assert [t.name for t in index.tables] == ["customers", "orders"]
+
+
+def test_concurrent_refresh_keeps_the_other_version(shop, indexer, db, monkeypatch):
+    datasource, path = shop
+    indexer.refresh(datasource)
+    with sqlite3.connect(path) as conn:
+        conn.execute("ALTER TABLE orders ADD COLUMN note TEXT")
+
+    # another worker stores version 2 between our read of version 1 and our write
+    load = indexer.load
+
+    def load_then_bump(datasource_id):
+        current = load(datasource_id)
+        db["datasource-schemas"].update_one(
+            {"_id": ObjectId(datasource_id)}, {"$set": {"version": 2, "tables": []}}
+        )
+        return current
+
+    monkeypatch.setattr(indexer, "load", load_then_bump)
+    index = indexer.refresh(datasource)
+
+    assert index.version == 2
+    assert index.tables == []
+
+
+def test_forced_refresh_describes_everything(shop, indexer):
+    datasource, _ = shop
+    indexer.refresh(datasource)
+    CountingIntrospector.described = []
+
+    index = indexer.refresh(datasource, force=True)
+
+    # samples and row estimates are read again
+    assert index.version == 2
+    assert len(CountingIntrospector.described) == 3
@@ -0,0 +1,103 @@
+import pytest
+
+from models.datasource import create_datasource
+from models.schema import ColumnSchema, ForeignKey, SchemaIndex, TableSchema
+from tools import schema_retrieval
+from tools.schema_retrieval import SchemaRetriever
+
+FILLER = ["inventory", "shipments", "suppliers", "warehouses", "invoices", "refunds", "campaigns", "sessions"]
+
+
+def _table(name, columns, foreign_keys=(), pk="id"):
+    return TableSchema(
+        name=name,
+        columns=[ColumnSchema(name=pk, type="INTEGER", primary_key=True)]
+        + [ColumnSchema(name=column, type="TEXT") for column in columns],
+        foreign_keys=list(foreign_keys),
+        signature=name,
+    )
+
+
+def _datasource(tables, meta=None):
+    datasource = create_datasource(
+        {"_id": "shop", "name": "shop", "type": "sqlite", "position": 1, "path": "shop.db"}
+    )
+    datasource.meta = meta or {}
+    datasource.schema_index = SchemaIndex(_id="shop", version=1, tables=tables)
+    return datasource
+
+
+@pytest.fixture
+def shop():
+    tables = [
+        _table(f"{name}_{i}", [f"{name}_code", "created_at", "status", "note"])
+        for name in FILLER
+        for i in range(25)
+    ]
+    tables += [
+        _table(
+            "orders",
+            ["customer_id", "amount", "ordered_at"],
+            [ForeignKey(column="customer_id", ref_table="customers", ref_column="id")],
+        ),
+        _table("customers", ["full_name", "country"]),
+    ]
+    return _datasource(tables)
+
+
+def test_small_context_is_not_pruned():
+    datasource = _datasource([_table("orders", ["amount"]), _table("customers", ["country"])])
+
+    assert SchemaRetriever().select(datasource, "revenue by country") is None
+
+
+def test_relevant_tables_and_their_references_are_selected(shop):
+    selection = SchemaRetriever().select(shop, "total amount of orders per customer", token_budget=300)
+
+    # customers follows orders through the foreign key
+    assert list(selection)[:2] == ["orders", "customers"]
+    assert all(columns is None for columns in selection.values())
+
+
+def test_selection_respects_top_k_and_budget(shop, monkeypatch):
+    monkeypatch.setattr(schema_retrieval, "SCHEMA_CONTEXT_TOP_K", 3)
+    retriever = SchemaRetriever()
+
+    assert len(retriever.select(shop, "orders status note", token_budget=1000)) <= 3
+    # the first table is kept even when it alone exceeds the budget
+    assert list(retriever.select(shop, "orders amount", token_budget=1)) == ["orders"]
+
+
+def test_wide_tables_keep_keys_and_mentioned_columns(monkeypatch):
+    monkeypatch.setattr(schema_retrieval, "SCHEMA_CONTEXT_MAX_COLUMNS", 3)
+    columns = [f"metric_{i}" for i in range(20)] + ["customer_id", "discount_rate"]
+    wide = _table("orders", columns, [ForeignKey(column="customer_id", ref_table="customers", ref_column="id")])
+    datasource = _datasource([wide, _table("customers", ["country"])])
+
+    selection = SchemaRetriever().select(datasource, "average discount rate", token_budget=50)
+
+    assert selection["orders"] == ["id", "customer_id", "discount_rate"]
+
+
+def test_pruned_context_mentions_omitted_tables(shop):
+    prompt = SchemaRetriever().context_prompt(shop, "orders per customer")
+
+    assert "orders" in prompt and "customers" in prompt
+    assert "less relevant tables are not shown, call describe_tables" in prompt
+
+
+def test_describe_named_tables_or_best_matches(shop):
+    retriever = SchemaRetriever()
+
+    named = retriever.describe(shop, "customers, refunds_3")
+    assert "customers: id INTEGER PK" in named and "refunds_3: " in named and "orders: " not in named
+    assert "orders: " in retriever.describe(shop, "amount ordered")
+    assert retriever.describe(shop, "zzz").startswith("No tables match 'zzz', tables are: inventory_0")
+
+
+def test_index_is_rebuilt_for_a_changed_datasource(shop):
+    retriever = SchemaRetriever()
+    retriever.describe(shop, "orders")
+    changed = _datasource(shop.schema_index.tables + [_table("payments", ["paid_amount"])])
+
+    assert "payments: " in retriever.describe(changed, "paid amount")
@@ -0,0 +1,239 @@
+import sqlite3
+
+import mysql.connector
+import numpy as np
+import pytest
+from clickhouse_driver.errors import ErrorCodes, ServerException
+
+import cancellation
+from config import FETCH_BATCH_SIZE
+from metrics import STAGE_ERRORS
+from models.datasource import DataSourceType, create_datasource
+from models.query_result import QueryResult
+from tools import connection_pool, sql_query
+from tools.sql_query import QueryTimeout, execute_clickhouse, execute_mysql, execute_sql_query
+
+
+@pytest.fixture
+def sqlite_datasource(tmp_path):
+    path = tmp_path / "shop.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE orders (id INTEGER, amount REAL)")
+        conn.executemany("INSERT INTO orders VALUES (?, ?)", [(i, i * 1.5) for i in range(10)])
+    return create_datasource({"_id": "shop", "name": "shop", "type": "sqlite", "position": 1, "path": str(path)})
+
+
+def _run(datasource, query):
+    return execute_sql_query(query, datasourceId=datasource.id, datasources=[datasource])
+
+
+def test_query_returns_result(sqlite_datasource):
+    result = _run(sqlite_datasource, "SELECT id, amount FROM orders WHERE id < 3")
+    assert isinstance(result, QueryResult)
+    assert result.rows == [(0, 0.0), (1, 1.5), (2, 3.0)]
+
+
+def test_failed_query_raises_and_is_counted(sqlite_datasource):
+    before = STAGE_ERRORS.value(stage="sql", target="sqlite")
+    with pytest.raises(sqlite3.OperationalError, match="no such column"):
+        _run(sqlite_datasource, "SELECT missing FROM orders")
+    assert STAGE_ERRORS.value(stage="sql", target="sqlite") == before + 1
+
+
+class FakeMySQLConnection:
+    """Refuses to close or roll back while rows are left unread, like mysql-connector"""
+
+    connection_id = 42
+
+    def __init__(self, rows, on_fetch=None):
+        self.rows = rows
+        self.on_fetch = on_fetch
+        self.description = [("id",)]
+        self.disconnected = False
+        self.rolled_back = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchmany(self, size):
+        if self.on_fetch:
+            self.on_fetch()
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def _unread(self):
+        if self.rows:
+            raise mysql.connector.InternalError("Unread result found")
+
+    def close(self):
+        self._unread()
+
+    def rollback(self):
+        self._unread()
+        self.rolled_back = True
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def mysql_datasource(monkeypatch):
+    connections = []
+    monkeypatch.setitem(
+        connection_pool.CONNECTORS,
+        DataSourceType.MYSQL,
+        (lambda datasource: connections.pop(), lambda conn: True, lambda conn: None),
+    )
+    monkeypatch.setattr(sql_query, "connection_pool", connection_pool.ConnectionPoolManager())
+    datasource = create_datasource({
+        "_id": "crm", "name": "crm", "type": "mysql", "position": 1,
+        "host": "db", "port": "3306", "username": "u", "password": "p", "database": "crm",
+    })
+    return datasource, connections
+
+
+def test_mysql_cancelled_mid_fetch_disconnects(mysql_datasource, monkeypatch):
+    datasource, connections = mysql_datasource
+    token = cancellation.CancellationToken()
+    killed = []
+    monkeypatch.setattr(sql_query, "kill_mysql_query", lambda ds, connection_id: killed.append(connection_id))
+    connection = FakeMySQLConnection([(i,) for i in range(FETCH_BATCH_SIZE * 3)], on_fetch=token.cancel)
+    connections.append(connection)
+
+    # the cancellation, not "Unread result found" from the cleanup
+    with cancellation.bind(token), pytest.raises(cancellation.Cancelled):
+        execute_mysql(datasource, "SELECT id FROM customers")
+
+    assert killed == [42]
+    assert connection.disconnected
+    assert not connection.rolled_back
+
+
+def test_mysql_full_read_is_rolled_back(mysql_datasource):
+    datasource, connections = mysql_datasource
+    connection = FakeMySQLConnection([(1,), (2,)])
+    connections.append(connection)
+
+    result = execute_mysql(datasource, "SELECT id FROM customers")
+
+    assert result.rows == [(1,), (2,)]
+    assert connection.rolled_back
+    assert not connection.disconnected
+
+
+class FakeProgress:
+    """Progress packets of execute_with_progress, the blocks arrive meanwhile"""
+
+    def __init__(self, columns, column_types, packets=3, on_packet=None, error=None):
+        self.result = (columns, column_types)
+        self.packets = packets
+        self.on_packet = on_packet
+        self.error = error
+
+    def __iter__(self):
+        for i in range(self.packets):
+            if self.on_packet:
+                self.on_packet()
+            yield i, self.packets
+        if self.error:
+            raise self.error
+
+    def get_result(self):
+        return self.result
+
+
+class FakeClickhouseClient:
+    def __init__(self, progress):
+        self.progress = progress
+        self.calls = []
+        self.disconnected = False
+
+    def execute_with_progress(self, query, params, **kwargs):
+        self.calls.append((query, kwargs))
+        return self.progress
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def clickhouse_datasource(monkeypatch):
+    clients = []
+    monkeypatch.setitem(
+        connection_pool.CONNECTORS,
+        DataSourceType.CLICKHOUSE,
+        (lambda datasource: clients.pop(), lambda client: True, lambda client: None),
+    )
+    monkeypatch.setattr(sql_query, "connection_pool", connection_pool.ConnectionPoolManager())
+    datasource = create_datasource({
+        "_id": "events", "name": "events", "type": "clickhouse", "position": 1,
+        "host": "ch", "port": "9000", "username": "u", "password": "p", "database": "events",
+    })
+    return datasource, clients
+
+
+COLUMN_TYPES = [("id", "UInt64"), ("name", "String")]
+
+
+def _columns(n):
+    return [np.arange(n, dtype=np.uint64), np.array([f"user {i}" for i in range(n)], dtype=object)]
+
+
+def test_clickhouse_result_is_read_as_columns(clickhouse_datasource):
+    datasource, clients = clickhouse_datasource
+    client = FakeClickhouseClient(FakeProgress(_columns(3), COLUMN_TYPES))
+    clients.append(client)
+
+    result = execute_clickhouse(datasource, "SELECT id, name FROM users", max_rows=10)
+
+    assert result.columns == ["id", "name"]
+    assert result.rows == [(0, "user 0"), (1, "user 1"), (2, "user 2")]
+    assert (result.truncated, result.total_rows) == (False, 3)
+    query, kwargs = client.calls[0]
+    assert kwargs["columnar"] and kwargs["with_column_types"]
+    # the server stops after one row over the budget
+    assert kwargs["settings"]["max_result_rows"] == 11
+    assert kwargs["settings"]["result_overflow_mode"] == "break"
+
+
+def test_clickhouse_result_over_the_budget_is_truncated(clickhouse_datasource):
+    datasource, clients = clickhouse_datasource
+    clients.append(FakeClickhouseClient(FakeProgress(_columns(11), COLUMN_TYPES)))
+
+    result = execute_clickhouse(datasource, "SELECT id, name FROM users", max_rows=10)
+
+    assert result.row_count == 10
+    assert (result.truncated, result.total_rows) == (True, None)
+
+
+def test_clickhouse_empty_result(clickhouse_datasource):
+    datasource, clients = clickhouse_datasource
+    clients.append(FakeClickhouseClient(FakeProgress([], [])))
+
+    result = execute_clickhouse(datasource, "SELECT id FROM users WHERE 0")
+
+    assert result.row_count == 0
+    assert (result.truncated, result.total_rows) == (False, 0)
+
+
+def test_clickhouse_cancelled_query_disconnects(clickhouse_datasource):
+    datasource, clients = clickhouse_datasource
+    token = cancellation.CancellationToken()
+    client = FakeClickhouseClient(FakeProgress(_columns(3), COLUMN_TYPES, on_packet=token.cancel))
+    clients.append(client)
+
+    with cancellation.bind(token), pytest.raises(cancellation.Cancelled):
+        execute_clickhouse(datasource, "SELECT id, name FROM users")
+    assert client.disconnected
+
+
+def test_clickhouse_timeout(clickhouse_datasource):
+    datasource, clients = clickhouse_datasource
+    error = ServerException("Timeout exceeded", code=ErrorCodes.TIMEOUT_EXCEEDED)
+    clients.append(FakeClickhouseClient(FakeProgress(_columns(3), COLUMN_TYPES, error=error)))
+
+    with pytest.raises(QueryTimeout):
+        execute_clickhouse(datasource, "SELECT id, name FROM users")
@@ -0,0 +1,116 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+from openai.types.completion_usage import CompletionUsage
+
+from agents.chat_agent import ChatOpenAIDatasourceAgent
+from agents.streaming import ChatCompletionAccumulator, JsonFieldStream
+from chat_processor import Conversation, MessageDeltaEvent
+
+ANSWER = 'Revenue grew by 12% "year over year".\nTop region: Zürich 😀 \\ north'
+CONTENT = json.dumps(
+    {"chain_of_thoughts": 'I compared "answer": totals {by [year]}', "question_title": "Revenue", "answer": ANSWER}
+)
+
+
+def _chunk(content=None, tool_calls=None, finish_reason=None, usage=None):
+    choices = [] if usage else [
+        {"index": 0, "delta": {"content": content, "tool_calls": tool_calls}, "finish_reason": finish_reason}
+    ]
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1,
+        "model": "gpt-4o",
+        "choices": choices,
+        "usage": usage,
+    })
+
+
+def _pieces(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(CONTENT)])
+def test_field_is_decoded_across_chunk_boundaries(size):
+    stream = JsonFieldStream("answer")
+
+    assert "".join(stream.feed(piece) for piece in _pieces(CONTENT, size)) == ANSWER
+
+
+def test_unescaped_unicode_is_kept():
+    stream = JsonFieldStream("answer")
+    content = json.dumps({"title": "x", "answer": ANSWER}, ensure_ascii=False)
+
+    assert "".join(stream.feed(char) for char in content) == ANSWER
+
+
+def test_nested_fields_of_the_same_name_are_skipped():
+    stream = JsonFieldStream("answer")
+    content = json.dumps({"meta": {"answer": "nested"}, "list": [{"answer": "x"}], "answer": "top"})
+
+    assert stream.feed(content) == "top"
+
+
+def test_accumulator_streams_the_field_and_keeps_the_whole_content():
+    accumulator = ChatCompletionAccumulator("answer")
+    deltas = [accumulator.add(_chunk(piece)) for piece in _pieces(CONTENT, 5)]
+    accumulator.add(_chunk(finish_reason="stop"))
+    accumulator.add(_chunk(usage=CompletionUsage(prompt_tokens=10, completion_tokens=5, total_tokens=15)))
+
+    assert "".join(deltas) == ANSWER
+    # nothing is streamed before the answer starts
+    assert not any(deltas[: CONTENT.index('"answer"') // 5])
+    completion = accumulator.completion()
+    assert completion.choices[0].message.content == CONTENT
+    assert completion.usage.total_tokens == 15
+
+
+def test_accumulator_without_field_streams_the_raw_content():
+    accumulator = ChatCompletionAccumulator()
+
+    assert accumulator.add(_chunk('{"answer": "a')) == '{"answer": "a'
+
+
+def test_accumulator_assembles_tool_calls():
+    accumulator = ChatCompletionAccumulator("answer")
+    fragments = [
+        [{"index": 0, "id": "call_1", "type": "function", "function": {"name": "execute_sql_query", "arguments": ""}}],
+        [{"index": 1, "id": "call_2", "type": "function", "function": {"name": "analyze_data", "arguments": "{}"}}],
+        [{"index": 0, "function": {"arguments": '{"query": '}}],
+        [{"index": 0, "function": {"arguments": '"SELECT 1"}'}}],
+    ]
+    for tool_calls in fragments:
+        assert accumulator.add(_chunk(tool_calls=tool_calls)) == ""
+    accumulator.add(_chunk(finish_reason="tool_calls"))
+
+    message = accumulator.completion().choices[0].message
+    assert message.content is None
+    assert [(c.id, c.function.name, c.function.arguments) for c in message.tool_calls] == [
+        ("call_1", "execute_sql_query", '{"query": "SELECT 1"}'),
+        ("call_2", "analyze_data", "{}"),
+    ]
+
+
+def test_agent_yields_answer_deltas(db, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    chunks = [_chunk(piece) for piece in _pieces(CONTENT, 4)] + [_chunk(finish_reason="stop")]
+    agent = ChatOpenAIDatasourceAgent(db, Conversation.create(db, "c1"), registry=SimpleNamespace())
+    completions = SimpleNamespace(create=lambda **kwargs: iter(chunks))
+    agent.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    complete = agent._complete([{"role": "user", "content": "revenue?"}])
+    events = []
+    try:
+        while True:
+            events.append(next(complete))
+    except StopIteration as stop:
+        response = stop.value
+
+    assert all(isinstance(event, MessageDeltaEvent) for event in events)
+    # deltas of one message share the id, the ui glues them together by it
+    assert len({event.id for event in events}) == 1
+    assert "".join(event.delta for event in events) == ANSWER
+    assert response.choices[0].message.content == CONTENT
@@ -0,0 +1,76 @@
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from agents import task_categorizer
+from agents.task_categorizer import TaskCategorizer
+from schemes.task_categorizer import TaskCategories
+
+
+@pytest.fixture
+def categorizer(db, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    categorizer = TaskCategorizer(db)
+    # unknown words: every task reaches the llm fallback, which adds it to the shared corpus
+    monkeypatch.setattr(categorizer, "_categorize_with_llm", lambda _: TaskCategories.GENERAL_QUESTION)
+    return categorizer
+
+
+@pytest.fixture
+def frequent_thread_switches():
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_concurrent_categorize(categorizer, frequent_thread_switches):
+    errors = []
+
+    def work(worker: int):
+        try:
+            for i in range(100):
+                categorizer.categorize(f"zq{worker} xv{i} wq{worker * 1000 + i}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(categorizer._corpus) == 800
+
+
+def test_corpus_holds_the_newest_llm_tasks(categorizer, db, monkeypatch):
+    monkeypatch.setattr(task_categorizer, "CATEGORIZER_CORPUS_SIZE", 2)
+    start = datetime(2026, 1, 1)
+    # the _id order differs from the categorization order
+    for i, (key, query) in enumerate([("c", "oldest task"), ("a", "middle task"), ("b", "newest task")]):
+        db["task-categories"].insert_one({
+            "_id": key,
+            "query": query,
+            "category": TaskCategories.HYPOTHESIS.value,
+            "source": "llm",
+            "created_at": start + timedelta(minutes=i),
+        })
+
+    corpus = categorizer._load_corpus()
+
+    assert len(corpus) == 2
+    assert corpus.search("oldest") == []
+    assert corpus.search("newest")
+
+
+def test_categorized_tasks_are_timestamped(categorizer, db):
+    categorizer.ensure_indexes()
+    categorizer.categorize("zq xv")
+
+    doc = db["task-categories"].find_one({"query": "zq xv"})
+    assert doc["source"] == "llm"
+    assert isinstance(doc["created_at"], datetime)
+    assert "source_1_created_at_-1" in db["task-categories"].index_information()
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import pytest
+
+import cancellation
+import task_handler
+from config import TaskStatus
+from schemes.task_categorizer import TaskCategories
+
+
+@pytest.fixture
+def monitor(db, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(task_handler, "MongoClient", lambda uri: db.client)
+    monkeypatch.setattr(task_handler.result_store, "attach_mongodb", lambda mongodb: None)
+    monitor = task_handler.TaskMonitor()
+    monkeypatch.setattr(
+        monitor.categorizer, "categorize", lambda query, task_type=None: TaskCategories.GENERAL_QUESTION
+    )
+    return monitor
+
+
+class Processor:
+    """Tracks how many tasks run at once, in total and per datasource"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = defaultdict(int)
+        self.peak = defaultdict(int)
+        self.done = []
+
+    def process(self, task):
+        keys = ["all"] + task.get("datasourceIds", [])
+        with self.lock:
+            for key in keys:
+                self.running[key] += 1
+                self.peak[key] = max(self.peak[key], self.running[key])
+        time.sleep(self.delay)
+        with self.lock:
+            for key in keys:
+                self.running[key] -= 1
+            self.done.append(task["_id"])
+        return {"answer": f"answer {task['_id']}"}
+
+
+def _add_tasks(db, datasource_ids):
+    for i, ds_ids in enumerate(datasource_ids):
+        db.tasks.insert_one({
+            "_id": i,
+            "query": f"question {i}",
+            "datasourceIds": ds_ids,
+            "status": TaskStatus.PENDING.value,
+            "attempts": 0,
+        })
+
+
+def test_tasks_run_concurrently_up_to_the_limit(monitor, db, monkeypatch):
+    monkeypatch.setattr(task_handler, "TASK_CONCURRENCY", 3)
+    monkeypatch.setattr(task_handler, "TASK_CONCURRENCY_PER_DATASOURCE", 3)
+    monkeypatch.setattr(task_handler.signal, "signal", lambda *args: None)
+    monkeypatch.setattr(monitor.queue, "start_watching", lambda: None)
+    monkeypatch.setattr(monitor.registry, "start_watching", lambda: None)
+    monkeypatch.setattr(monitor.schema_indexer, "start", lambda get_datasources: None)
+    processor = Processor()
+    monkeypatch.setattr(monitor, "question_processor", processor)
+    _add_tasks(db, [["ds1"]] * 6)
+
+    def stop_when_done():
+        while len(processor.done) < 6:
+            time.sleep(0.01)
+        monitor.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    monitor.run()
+
+    assert processor.peak["all"] == 3
+    statuses = [(t["status"], t["answer"]) for t in db.tasks.find().sort("_id", 1)]
+    assert statuses == [(TaskStatus.COMPLETED.value, f"answer {i}") for i in range(6)]
+
+
+def test_tasks_of_one_datasource_are_limited(monitor, db, monkeypatch):
+    monkeypatch.setattr(task_handler, "TASK_CONCURRENCY_PER_DATASOURCE", 1)
+    processor = Processor()
+    monkeypatch.setattr(monitor, "question_processor", processor)
+    _add_tasks(db, [["ds1"], ["ds1", "ds2"], ["ds2"], ["ds3"]])
+
+    threads = [threading.Thread(target=monitor._run_task, args=(monitor.queue.claim(),)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(processor.done) == [0, 1, 2, 3]
+    assert processor.peak["ds1"] == processor.peak["ds2"] == 1
+    assert processor.peak["all"] >= 2
+
+
+def test_lost_lease_abandons_the_task(monitor, db, monkeypatch):
+    _add_tasks(db, [["ds1"]])
+    task = monitor.queue.claim()
+
+    @contextmanager
+    def lost_lease(task, on_lost):
+        # another worker reclaimed the task
+        on_lost()
+        yield
+
+    def process(task):
+        cancellation.check()
+        return {"answer": "too late"}
+
+    monkeypatch.setattr(monitor.queue, "lease", lost_lease)
+    monkeypatch.setattr(monitor.question_processor, "process", process)
+
+    monitor._run_task(task)
+
+    # left to the worker which owns it now, neither completed nor failed
+    stored = db.tasks.find_one({"_id": task["_id"]})
+    assert stored["status"] == TaskStatus.PROCESSING.value
+    assert "answer" not in stored and "error" not in stored
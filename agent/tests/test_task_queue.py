@@ -0,0 +1,81 @@
+import threading
+import time
+
+from config import TASK_MAX_ATTEMPTS, TaskStatus
+from task_queue import TaskQueue
+
+
+def _add_task(db, task_id):
+    db.tasks.insert_one({"_id": task_id, "status": TaskStatus.PENDING.value, "attempts": 0})
+
+
+def test_claim_takes_each_pending_task_once(db):
+    _add_task(db, 1)
+    _add_task(db, 2)
+    a = TaskQueue(db, worker_id="a")
+    b = TaskQueue(db, worker_id="b")
+
+    first = a.claim()
+    second = b.claim()
+
+    assert (first["_id"], first["worker_id"], first["attempts"]) == (1, "a", 1)
+    assert (second["_id"], second["worker_id"]) == (2, "b")
+    assert first["status"] == TaskStatus.PROCESSING.value
+    assert a.claim() is None
+
+
+def test_expired_lease_is_claimed_again(db):
+    _add_task(db, 1)
+    crashed = TaskQueue(db, worker_id="crashed", lease_seconds=-1)
+    other = TaskQueue(db, worker_id="other")
+    crashed.claim()
+
+    task = other.claim()
+
+    assert (task["_id"], task["worker_id"], task["attempts"]) == (1, "other", 2)
+    # the first worker lost the task
+    assert not crashed.renew(1)
+    assert other.renew(1)
+    assert other.claim() is None
+
+
+def test_live_lease_is_not_claimed(db):
+    _add_task(db, 1)
+    TaskQueue(db, worker_id="a").claim()
+
+    assert TaskQueue(db, worker_id="b").claim() is None
+
+
+def test_tasks_expiring_too_often_fail(db):
+    _add_task(db, 1)
+    queue = TaskQueue(db, worker_id="a", lease_seconds=-1)
+    for _ in range(TASK_MAX_ATTEMPTS):
+        assert queue.claim()["_id"] == 1
+
+    assert queue.claim() is None
+    queue.fail_exhausted()
+    assert db.tasks.find_one({"_id": 1})["status"] == TaskStatus.FAILED.value
+
+
+def test_lease_is_renewed_while_processing(db):
+    _add_task(db, 1)
+    queue = TaskQueue(db, worker_id="a", lease_seconds=0.3)
+    task = queue.claim()
+
+    with queue.lease(task) as lost:
+        time.sleep(0.5)
+        assert not lost.is_set()
+        assert TaskQueue(db, worker_id="b").claim() is None
+
+
+def test_lost_lease_calls_on_lost(db):
+    _add_task(db, 1)
+    queue = TaskQueue(db, worker_id="a", lease_seconds=0.3)
+    task = queue.claim()
+    called = threading.Event()
+
+    with queue.lease(task, on_lost=called.set) as lost:
+        db.tasks.update_one({"_id": 1}, {"$set": {"worker_id": "b"}})
+        assert lost.wait(1)
+
+    assert called.is_set()
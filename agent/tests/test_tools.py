@@ -0,0 +1,190 @@
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+import cancellation
+from chat_processor import Conversation, ToolCallEvent, ToolResultEvent
+from models.datasource import create_datasource
+from models.query_result import QueryResult
+from tools import tools
+from tools import connection_pool
+
+
+def _tool_call(call_id: str, name: str, arguments: dict):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+
+def _response(name: str, arguments: dict):
+    return _responses([(name, arguments)])
+
+
+def _responses(calls: list):
+    tool_calls = [_tool_call(f"call_{i + 1}", name, arguments) for i, (name, arguments) in enumerate(calls)]
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=tool_calls))])
+
+
+def test_aggregate_mongodb_call_is_recorded(db, monkeypatch):
+    calls = []
+
+    def aggregate(**kwargs):
+        calls.append(kwargs)
+        return QueryResult.from_rows(["_id", "n"], [("DE", 3), ("FR", 2)])
+
+    monkeypatch.setitem(tools.TOOLS_MAPPING, tools.MONGODB_AGGREGATE_TOOL, aggregate)
+    arguments = {
+        "collection": "orders",
+        "pipeline": [{"$group": {"_id": "$country", "n": {"$sum": 1}}}],
+        "hint": None,
+        "datasourceId": "ds1",
+    }
+    conversation = Conversation.create(db, "c1")
+    messages = []
+
+    events = list(
+        tools.handle_tools2(
+            _response(tools.MONGODB_AGGREGATE_TOOL, arguments), messages, [], conversation, db
+        )
+    )
+
+    assert [type(e) for e in events] == [ToolCallEvent, ToolResultEvent]
+    assert events[0].parameters == arguments
+    assert events[1].output.startswith("_id,n\nDE,3\nFR,2")
+    assert calls[0]["pipeline"] == arguments["pipeline"] and calls[0]["hint"] is None
+    assert messages[-1]["content"] == events[1].output
+
+
+def _mongodb(**fields):
+    return create_datasource({
+        "_id": "m1", "name": "m", "type": "mongodb", "position": 1, "host": "localhost",
+        "port": "27017", "username": "reader", "password": "secret", "database": "shop", **fields,
+    })
+
+
+@pytest.mark.parametrize("fields, options", [({}, {}), ({"authSource": "users"}, {"authSource": "users"})])
+def test_mongodb_auth_source(monkeypatch, fields, options):
+    monkeypatch.setattr(connection_pool, "MongoClient", lambda **kwargs: kwargs)
+    kwargs = connection_pool._connect_mongodb(_mongodb(**fields))
+    # without authSource the driver authenticates against admin, not the queried database
+    assert {k: v for k, v in kwargs.items() if k == "authSource"} == options
+
+
+def _queries(*queries, datasource_id="ds1"):
+    calls = []
+    for i, query in enumerate(queries):
+        arguments = {"query": query, "datasourceId": datasource_id}
+        calls.append((_tool_call(f"call_{i + 1}", tools.SQL_QUERY_TOOL, arguments), arguments))
+    return calls
+
+
+def test_tool_calls_run_concurrently_in_order(monkeypatch):
+    # every call waits for the others, sequential calls would time out
+    barrier = threading.Barrier(3, timeout=5)
+
+    def query(query, **kwargs):
+        barrier.wait()
+        if query == "bad":
+            raise ValueError("syntax error")
+        return query.lower()
+
+    monkeypatch.setitem(tools.TOOLS_MAPPING, tools.SQL_QUERY_TOOL, query)
+
+    results = tools.run_tool_calls(_queries("A", "bad", "C", datasource_id=None), [])
+
+    assert results == [
+        ("a", True, None),
+        ("Error executing query: syntax error", False, None),
+        ("c", True, None),
+    ]
+
+
+def test_calls_of_one_datasource_are_limited(monkeypatch):
+    monkeypatch.setattr(tools, "_datasource_slots", defaultdict(lambda: threading.BoundedSemaphore(2)))
+    running = defaultdict(int)
+    peak = defaultdict(int)
+    lock = threading.Lock()
+
+    def query(query, datasourceId, **kwargs):
+        with lock:
+            running[datasourceId] += 1
+            peak[datasourceId] = max(peak[datasourceId], running[datasourceId])
+        time.sleep(0.02)
+        with lock:
+            running[datasourceId] -= 1
+        return query
+
+    monkeypatch.setitem(tools.TOOLS_MAPPING, tools.SQL_QUERY_TOOL, query)
+
+    tools.run_tool_calls(_queries(*"abcdef") + _queries("g", datasource_id="ds2"), [])
+
+    assert peak == {"ds1": 2, "ds2": 1}
+
+
+def test_cancelled_turn_stops_waiting_calls(monkeypatch):
+    monkeypatch.setattr(tools, "_datasource_slots", defaultdict(lambda: threading.BoundedSemaphore(1)))
+    token = cancellation.CancellationToken()
+    started = []
+
+    def query(query, **kwargs):
+        started.append(query)
+        token.cancel("client disconnected")
+        return query
+
+    monkeypatch.setitem(tools.TOOLS_MAPPING, tools.SQL_QUERY_TOOL, query)
+
+    with cancellation.bind(token), pytest.raises(cancellation.Cancelled):
+        tools.run_tool_calls(_queries("a", "b"), [])
+    # the other call found the turn cancelled once it got the slot
+    assert len(started) == 1
+
+
+def _slow_first(monkeypatch):
+    def query(query, **kwargs):
+        if query == "slow":
+            time.sleep(0.05)
+        return f"result of {query}"
+
+    monkeypatch.setitem(tools.TOOLS_MAPPING, tools.SQL_QUERY_TOOL, query)
+    return _responses([
+        (tools.SQL_QUERY_TOOL, {"query": "slow", "datasourceId": "ds1"}),
+        (tools.SQL_QUERY_TOOL, {"query": "fast", "datasourceId": "ds1"}),
+    ])
+
+
+def test_tool_events_keep_the_order_of_calls(db, monkeypatch):
+    response = _slow_first(monkeypatch)
+    conversation = Conversation.create(db, "c1")
+    messages = []
+
+    events = list(tools.handle_tools2(response, messages, [], conversation, db))
+
+    assert [(type(e), e.tool_call_id) for e in events] == [
+        (ToolCallEvent, "call_1"),
+        (ToolCallEvent, "call_2"),
+        (ToolResultEvent, "call_1"),
+        (ToolResultEvent, "call_2"),
+    ]
+    assert [m["content"] for m in messages[1:]] == ["result of slow", "result of fast"]
+
+
+def test_async_tool_events_keep_the_order_of_calls(async_db, monkeypatch):
+    response = _slow_first(monkeypatch)
+    messages = []
+
+    async def run():
+        conversation = await Conversation.acreate(async_db, "c1")
+        return [event async for event in tools.ahandle_tools(response, messages, [], conversation, async_db)]
+
+    events = asyncio.run(run())
+
+    assert [(type(e), e.tool_call_id) for e in events] == [
+        (ToolCallEvent, "call_1"),
+        (ToolCallEvent, "call_2"),
+        (ToolResultEvent, "call_1"),
+        (ToolResultEvent, "call_2"),
+    ]
+    assert [m["content"] for m in messages[1:]] == ["result of slow", "result of fast"]